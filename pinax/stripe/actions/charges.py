@@ -1,10 +1,14 @@
+import collections
 import decimal
 
 
 from django.conf import settings
+from django.db import transaction
 
 import stripe
 
+from . import rollups
+from .. import cache
 from .. import hooks
 from .. import models
 from .. import utils
@@ -86,6 +90,39 @@ def sync_charges_for_customer(customer):
         sync_charge_from_stripe_data(charge)
 
 
+def _charge_defaults(customer, invoice, data):
+    currency = data["currency"]
+    defaults = dict(
+        customer=customer,
+        source=data["source"]["id"],
+        currency=currency,
+        invoice=invoice,
+        amount=utils.convert_amount_for_db(data["amount"], currency),
+        paid=data["paid"],
+        refunded=data["refunded"],
+        captured=data["captured"],
+        disputed=data["dispute"] is not None,
+        charge_created=utils.convert_tstamp(data, "created")
+    )
+    if data.get("description"):
+        defaults["description"] = data["description"]
+    if data.get("amount_refunded"):
+        defaults["amount_refunded"] = utils.convert_amount_for_db(data["amount_refunded"], currency)
+    if data["refunded"]:
+        defaults["amount_refunded"] = defaults["amount"]
+    return defaults
+
+
+def _upsert_charges(rows):
+    if not settings.PINAX_STRIPE_ROLLUPS:
+        return utils.bulk_upsert(models.Charge.objects, rows)
+    with transaction.atomic():
+        before = list(rollups.locked(models.Charge.objects.filter(stripe_id__in=list(rows))).only(*rollups.CHARGE_FIELDS))
+        objs = utils.bulk_upsert(models.Charge.objects, rows)
+        rollups.apply_charge_changes(before, objs.values())
+    return objs
+
+
 def sync_charge_from_stripe_data(data):
     """
     Create or update the charge represented by the data from a Stripe API query.
@@ -96,25 +133,39 @@ def sync_charge_from_stripe_data(data):
     Returns:
         a pinax.stripe.models.Charge object
     """
-    customer = models.Customer.objects.get(stripe_id=data["customer"])
-    obj, _ = models.Charge.objects.get_or_create(
-        customer=customer,
-        stripe_id=data["id"]
-    )
-    obj.source = data["source"]["id"]
-    obj.currency = data["currency"]
-    obj.invoice = next(iter(models.Invoice.objects.filter(stripe_id=data["invoice"])), None)
-    obj.amount = utils.convert_amount_for_db(data["amount"], obj.currency)
-    obj.paid = data["paid"]
-    obj.refunded = data["refunded"]
-    obj.captured = data["captured"]
-    obj.disputed = data["dispute"] is not None
-    obj.charge_created = utils.convert_tstamp(data, "created")
-    if data.get("description"):
-        obj.description = data["description"]
-    if data.get("amount_refunded"):
-        obj.amount_refunded = utils.convert_amount_for_db(data["amount_refunded"], obj.currency)
-    if data["refunded"]:
-        obj.amount_refunded = obj.amount
-    obj.save()
-    return obj
+    customer = cache.customer(data["customer"])
+    invoice = next(iter(models.Invoice.objects.filter(stripe_id=data["invoice"])), None)
+    defaults = _charge_defaults(customer, invoice, data)
+    return _upsert_charges({data["id"]: defaults})[data["id"]]
+
+
+def sync_charges_from_stripe_data(charges):
+    """
+    Create or update a batch of charges in a constant number of queries
+
+    Charges for customers that do not exist locally are skipped.
+
+    Args:
+        charges: data representing charge objects in the Stripe API
+
+    Returns:
+        a list of the pinax.stripe.models.Charge objects created or updated
+    """
+    customers = {
+        customer.stripe_id: customer
+        for customer in models.Customer.objects.filter(
+            stripe_id__in=set(charge["customer"] for charge in charges if charge["customer"])
+        )
+    }
+    charges = [charge for charge in charges if charge["customer"] in customers]
+    invoices = {
+        invoice.stripe_id: invoice
+        for invoice in models.Invoice.objects.filter(
+            stripe_id__in=set(charge["invoice"] for charge in charges if charge["invoice"])
+        )
+    }
+    objs = _upsert_charges(collections.OrderedDict(
+        (charge["id"], _charge_defaults(customers[charge["customer"]], invoices.get(charge["invoice"]), charge))
+        for charge in charges
+    ))
+    return [objs[charge["id"]] for charge in charges]
@@ -1,3 +1,5 @@
+import collections
+
 import stripe
 
 from .. import utils
@@ -13,8 +15,8 @@ def sync_coupons():
     except AttributeError:
         coupons = iter(stripe.Coupon.all().data)
 
-    for coupon in coupons:
-        defaults = dict(
+    utils.bulk_upsert(models.Coupon.objects, collections.OrderedDict(
+        (coupon["id"], dict(
             amount_off=(
                 utils.convert_amount_for_db(coupon["amount_off"], coupon["currency"])
                 if coupon["amount_off"]
@@ -29,9 +31,6 @@ def sync_coupons():
             redeem_by=utils.convert_tstamp(coupon["redeem_by"]) if coupon["redeem_by"] else None,
             times_redeemed=coupon["times_redeemed"],
             valid=coupon["valid"],
-        )
-        obj, created = models.Coupon.objects.get_or_create(
-            stripe_id=coupon["id"],
-            defaults=defaults
-        )
-        utils.update_with_defaults(obj, defaults, created)
+        ))
+        for coupon in coupons
+    ))
@@ -97,6 +97,7 @@ def purge(customer):
             # The exception was thrown because the customer was already
             # deleted on the stripe side, ignore the exception
             raise
+    subscriptions.invalidate_active_subscription(customer)
     customer.user = None
     customer.date_purged = timezone.now()
     customer.save()
@@ -151,12 +152,54 @@ def sync_customer(customer, cu=None):
     """
     if cu is None:
         cu = customer.stripe_customer
-    customer.account_balance = utils.convert_amount_for_db(cu["account_balance"], cu["currency"])
-    customer.currency = cu["currency"] or ""
-    customer.delinquent = cu["delinquent"]
-    customer.default_source = cu["default_source"] or ""
-    customer.save()
-    for source in cu["sources"]["data"]:
-        sources.sync_payment_source_from_stripe_data(customer, source)
-    for subscription in cu["subscriptions"]["data"]:
-        subscriptions.sync_subscription_from_stripe_data(customer, subscription)
+    sync_customer_details(customer, cu=cu)
+    sources.sync_payment_sources_from_stripe_data(customer, cu["sources"]["data"])
+    subscriptions.sync_subscriptions_from_stripe_data(customer, cu["subscriptions"]["data"])
+
+
+def sync_customer_details(customer, cu=None):
+    """
+    Syncronizes only the fields of a local Customer object, such as the
+    account balance and delinquency, leaving its payment sources and
+    subscriptions alone
+
+    Args:
+        customer: a Customer object
+        cu: optionally, data from the Stripe API representing the customer
+    """
+    if cu is None:
+        cu = customer.stripe_customer
+    utils.update_with_defaults(customer, dict(
+        account_balance=utils.convert_amount_for_db(cu["account_balance"], cu["currency"]),
+        currency=cu["currency"] or "",
+        delinquent=cu["delinquent"],
+        default_source=cu["default_source"] or ""
+    ), False)
+
+
+def sync_customers_from_stripe_data(stripe_customers):
+    """
+    Syncronizes a batch of local Customer objects with details from the
+    Stripe API, looking them all up in a single query
+
+    Customers that do not exist locally are skipped.
+
+    Args:
+        stripe_customers: data from the Stripe API representing customers
+
+    Returns:
+        a list of the Customer objects that were syncronized
+    """
+    customers = {
+        customer.stripe_id: customer
+        for customer in models.Customer.objects.filter(
+            stripe_id__in=[cu["id"] for cu in stripe_customers]
+        )
+    }
+    synced = []
+    for cu in stripe_customers:
+        customer = customers.get(cu["id"])
+        if customer is not None:
+            sync_customer(customer, cu=cu)
+            synced.append(customer)
+    return synced
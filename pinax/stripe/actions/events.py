@@ -1,10 +1,43 @@
+import calendar
+import datetime
+import json
+
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import IntegrityError, connection, transaction
+from django.db.models import Q
+from django.utils import timezone
+
+import stripe
+
+from . import exceptions
 from .. import models
+from .. import utils
+from ..conf import settings
 from ..webhooks import registry
 
 
+CATCH_UP_CHECKPOINT = "events.catch_up"
+
+# How many seconds before the previous run's high-water mark catch_up lists
+# events from again, as events created in the same second can be listed late
+CATCH_UP_OVERLAP = 60
+
+
+def message_object_id(message):
+    """
+    Returns the ID of the object an event message is about, or "" if it has
+    none
+    """
+    try:
+        return message["data"]["object"].get("id") or ""
+    except (AttributeError, KeyError, TypeError):
+        return ""
+
+
 def add_event(stripe_id, kind, livemode, message, api_version="", request_id="", pending_webhooks=0):
     """
-    Adds and processes an event from a received webhook
+    Adds an event from a received webhook and hands it to the configured
+    PINAX_STRIPE_WEBHOOK_QUEUE for processing
 
     Args:
         stripe_id: the stripe id of the event
@@ -14,17 +47,39 @@ def add_event(stripe_id, kind, livemode, message, api_version="", request_id="",
         api_version: the version of the Stripe API used
         request_id: the id of the request that initiated the webhook
         pending_webhooks: the number of pending webhooks
+
+    Returns:
+        the pinax.stripe.models.Event object that was created, or None if an
+        event with the same stripe id was already added
     """
-    event = models.Event.objects.create(
-        stripe_id=stripe_id,
-        kind=kind,
-        livemode=livemode,
-        webhook_message=message,
-        api_version=api_version,
-        request=request_id,
-        pending_webhooks=pending_webhooks
-    )
-    WebhookClass = registry.get(kind)
+    try:
+        # The unique stripe_id makes the insert the duplicate check, which
+        # also holds when Stripe delivers an event more than once at a time
+        with transaction.atomic():
+            event = models.Event.objects.create(
+                stripe_id=stripe_id,
+                kind=kind,
+                livemode=livemode,
+                webhook_message=message,
+                api_version=api_version,
+                request=request_id,
+                pending_webhooks=pending_webhooks,
+                object_id=message_object_id(message)
+            )
+    except IntegrityError:
+        return None
+    settings.PINAX_STRIPE_WEBHOOK_QUEUE.enqueue(event)
+    return event
+
+
+def process_event(event):
+    """
+    Processes an event with the webhook handler registered for its kind
+
+    Args:
+        event: the pinax.stripe.models.Event object to process
+    """
+    WebhookClass = registry.get(event.kind)
     if WebhookClass is not None:
         webhook = WebhookClass(event)
         webhook.process()
@@ -41,3 +96,268 @@ def dupe_event_exists(stripe_id):
         True, if the event already exists, otherwise, False
     """
     return models.Event.objects.filter(stripe_id=stripe_id).exists()
+
+
+def pending_events():
+    """
+    Returns the events that have been received but not processed yet, oldest
+    first. Events that failed validation are left out.
+    """
+    return models.Event.objects.filter(
+        processed=False
+    ).exclude(
+        valid=False
+    ).order_by("created_at", "pk")
+
+
+def _claim(qs):
+    if getattr(connection.features, "has_select_for_update_skip_locked", False):
+        qs = qs.select_for_update(skip_locked=True)
+    elif connection.features.has_select_for_update:
+        qs = qs.select_for_update()
+    return next(iter(qs[:1]), None)
+
+
+def _process_claimed(event):
+    try:
+        with transaction.atomic():
+            process_event(event)
+    except Exception as e:
+        # Logged rather than raised so one failing event, which
+        # stays pending, does not hold up the ones after it
+        exceptions.log_exception(data="", exception=e, event=event)
+
+
+def process_next_pending_event(exclude=None):
+    """
+    Claims the oldest pending event and processes it
+
+    The event row stays locked until it has been processed. Where the database
+    supports it, other workers skip locked rows instead of waiting on them, so
+    several workers can drain the pending events at once without processing
+    the same event twice. An error processing the event is logged as an
+    EventProcessingException and the event is left pending.
+
+    Args:
+        exclude: optionally, primary keys of events not to claim, such as
+                 events that were already attempted in this run
+
+    Returns:
+        the pinax.stripe.models.Event object that was processed, or None if
+        there was nothing left to claim
+    """
+    with transaction.atomic():
+        qs = pending_events()
+        if exclude:
+            qs = qs.exclude(pk__in=exclude)
+        event = _claim(qs)
+        if event is not None:
+            _process_claimed(event)
+    return event
+
+
+def process_pending_event(pk):
+    """
+    Claims a pending event by primary key and processes it, the same way as
+    process_next_pending_event does
+
+    Args:
+        pk: the primary key of the event
+
+    Returns:
+        the pinax.stripe.models.Event object that was processed, or None if
+        it was already processed or is being processed by another worker
+    """
+    with transaction.atomic():
+        event = _claim(pending_events().filter(pk=pk))
+        if event is not None:
+            _process_claimed(event)
+    return event
+
+
+def _request_id(evt):
+    request = evt.get("request")
+    # Newer API versions give the request as an object
+    if isinstance(request, dict):
+        request = request.get("id")
+    return request or ""
+
+
+def _catch_up_since():
+    checkpoint = models.Checkpoint.objects.filter(name=CATCH_UP_CHECKPOINT).first()
+    if checkpoint is not None and checkpoint.value:
+        return int(checkpoint.value) - CATCH_UP_OVERLAP
+    # Without a previous run, since the newest event received rather than
+    # the whole history Stripe keeps
+    newest = models.Event.objects.order_by("-created_at").values_list("created_at", flat=True).first()
+    if newest is not None:
+        return calendar.timegm(newest.utctimetuple()) - CATCH_UP_OVERLAP
+    return None
+
+
+def _add_missing(page):
+    existing = set(models.Event.objects.filter(
+        stripe_id__in=[evt["id"] for evt in page]
+    ).values_list("stripe_id", flat=True))
+    added = []
+    # Stripe lists the newest events first
+    for evt in sorted(page, key=lambda evt: evt["created"]):
+        if evt["id"] in existing:
+            continue
+        event = add_event(
+            stripe_id=evt["id"],
+            kind=evt["type"],
+            livemode=evt["livemode"],
+            message=json.loads(json.dumps(evt, sort_keys=True, cls=stripe.StripeObjectEncoder)),
+            api_version=evt.get("api_version") or "",
+            request_id=_request_id(evt),
+            pending_webhooks=evt.get("pending_webhooks") or 0
+        )
+        # None when the webhook delivered it in the meantime
+        if event is not None:
+            added.append(event)
+    return added
+
+
+def catch_up(since=None):
+    """
+    Replays events that were missed, for instance because webhooks were
+    dropped, by listing the events created since the last run and adding
+    those that have not been received yet
+
+    The created time of the newest event seen is stored as a high-water mark
+    in a Checkpoint, so each run only lists the gap since the previous one,
+    starting CATCH_UP_OVERLAP seconds before it so that events Stripe lists
+    late within the same second are not missed. The first run starts from
+    the newest event received instead. Missing events are added a page at a
+    time, oldest first within each page, and processed by the configured
+    PINAX_STRIPE_WEBHOOK_QUEUE like events received through the webhook.
+
+    Args:
+        since: optionally, a datetime or Unix timestamp to list events created
+               from instead
+
+    Returns:
+        a list of the pinax.stripe.models.Event objects that were added
+    """
+    if since is None:
+        since = _catch_up_since()
+    elif isinstance(since, datetime.datetime):
+        since = calendar.timegm(since.utctimetuple())
+    params = {"created": {"gte": since}} if since is not None else {}
+    high_water_mark = None
+    added = []
+    for page in utils.iter_pages(stripe.Event, **params):
+        high_water_mark = max([high_water_mark or 0] + [evt["created"] for evt in page])
+        added.extend(_add_missing(page))
+    if high_water_mark is not None:
+        models.Checkpoint.objects.update_or_create(
+            name=CATCH_UP_CHECKPOINT,
+            defaults={"value": str(high_water_mark), "updated_at": timezone.now()}
+        )
+    return added
+
+
+def compact_events(batch_size=1000):
+    """
+    Compacts the events stored before PINAX_STRIPE_EVENT_COMPACT_STORAGE was
+    turned on, keeping only the difference of their validated message from
+    the webhook message
+
+    Args:
+        batch_size: the number of events to compact per transaction
+
+    Returns:
+        the number of events compacted
+    """
+    return utils.compact_events(models.Event, batch_size=batch_size)
+
+
+def archive_objects(archive, objs):
+    """
+    Writes model objects to a file as newline-delimited JSON, one object per
+    line with its model label and the values of its fields
+
+    Args:
+        archive: a file object opened for writing bytes
+        objs: the objects to write
+    """
+    for obj in objs:
+        row = dict(
+            (field.attname, getattr(obj, field.attname))
+            for field in obj._meta.concrete_fields
+        )
+        row["model"] = "{0}.{1}".format(obj._meta.app_label, obj._meta.model_name)
+        archive.write((json.dumps(row, sort_keys=True, cls=DjangoJSONEncoder) + "\n").encode("utf-8"))
+
+
+def _prune(qs, batch_size, archive, related):
+    count = 0
+    while True:
+        with transaction.atomic():
+            if archive is None:
+                pks = list(qs.order_by("created_at", "pk").values_list("pk", flat=True)[:batch_size])
+            else:
+                batch = list(qs.order_by("created_at", "pk")[:batch_size])
+                pks = [obj.pk for obj in batch]
+                archive_objects(archive, list(related(pks)) + batch)
+            if not pks:
+                return count
+            # Filtering again keeps anything that stopped matching since
+            qs.filter(pk__in=pks).delete()
+        count += len(pks)
+
+
+def prune_events(before, kinds=None, exclude_kinds=None, batch_size=1000, archive=None):
+    """
+    Deletes the events created before a given time, along with their
+    processing exceptions, oldest first and a batch at a time
+
+    Events still waiting to be processed are kept, as are events that
+    transfers were synced from, which deleting the event would delete too.
+
+    Args:
+        before: the datetime to delete events created before
+        kinds: optionally, only delete events of these kinds
+        exclude_kinds: optionally, kinds of events not to delete
+        batch_size: the number of events to delete per transaction
+        archive: optionally, a file object opened for writing bytes the
+                 events and their exceptions are written to before they are
+                 deleted, see archive_objects
+
+    Returns:
+        the number of events deleted
+    """
+    qs = models.Event.objects.filter(
+        Q(processed=True) | Q(valid=False),
+        created_at__lt=before,
+        transfers__isnull=True
+    )
+    if kinds is not None:
+        qs = qs.filter(kind__in=kinds)
+    if exclude_kinds:
+        qs = qs.exclude(kind__in=exclude_kinds)
+    return _prune(
+        qs,
+        batch_size,
+        archive,
+        lambda pks: models.EventProcessingException.objects.filter(event__in=pks).order_by("pk")
+    )
+
+
+def prune_event_exceptions(before, batch_size=1000, archive=None):
+    """
+    Deletes the event processing exceptions created before a given time,
+    oldest first and a batch at a time
+
+    Args:
+        before: the datetime to delete exceptions created before
+        batch_size: the number of exceptions to delete per transaction
+        archive: optionally, a file object opened for writing bytes the
+                 exceptions are written to before they are deleted
+
+    Returns:
+        the number of exceptions deleted
+    """
+    qs = models.EventProcessingException.objects.filter(created_at__lt=before)
+    return _prune(qs, batch_size, archive, lambda pks: [])
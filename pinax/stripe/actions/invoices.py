@@ -1,13 +1,22 @@
+import collections
+
+from django.db import transaction
+
 import stripe
 
 from . import charges
 from . import subscriptions
 from ..conf import settings
+from .. import cache
 from .. import hooks
 from .. import models
 from .. import utils
 
 
+# Used when listing invoices so syncing them needs no further API requests
+INVOICE_EXPAND = ["data.charge", "data.subscription"]
+
+
 def create(customer):
     """
     Creates a Stripe invoice
@@ -64,10 +73,36 @@ def pay(invoice, send_receipt=True):
     return False
 
 
+def _invoice_defaults(customer, stripe_invoice, charge, subscription):
+    return dict(
+        customer=customer,
+        attempted=stripe_invoice["attempted"],
+        attempt_count=stripe_invoice["attempt_count"],
+        amount_due=utils.convert_amount_for_db(stripe_invoice["amount_due"], stripe_invoice["currency"]),
+        closed=stripe_invoice["closed"],
+        paid=stripe_invoice["paid"],
+        period_end=utils.convert_tstamp(stripe_invoice, "period_end"),
+        period_start=utils.convert_tstamp(stripe_invoice, "period_start"),
+        subtotal=utils.convert_amount_for_db(stripe_invoice["subtotal"], stripe_invoice["currency"]),
+        total=utils.convert_amount_for_db(stripe_invoice["total"], stripe_invoice["currency"]),
+        currency=stripe_invoice["currency"],
+        date=utils.convert_tstamp(stripe_invoice, "date"),
+        charge=charge,
+        subscription=subscription
+    )
+
+
+def _expanded_id(value):
+    return value["id"] if isinstance(value, dict) else value
+
+
 def sync_invoice_from_stripe_data(stripe_invoice, send_receipt=settings.PINAX_STRIPE_SEND_EMAIL_RECEIPTS):
     """
     Syncronizes a local invoice with data from the Stripe API
 
+    The charge and subscription are used as they are if they were expanded
+    in stripe_invoice, otherwise they are retrieved.
+
     Args:
         stripe_invoice: data that represents the invoice from the Stripe API
         send_receipt: if True, send the receipt as a result of paying
@@ -75,64 +110,148 @@ def sync_invoice_from_stripe_data(stripe_invoice, send_receipt=settings.PINAX_ST
     Returns:
         the pinax.stripe.models.Invoice that was created or updated
     """
-    c = models.Customer.objects.get(stripe_id=stripe_invoice["customer"])
-    period_end = utils.convert_tstamp(stripe_invoice, "period_end")
-    period_start = utils.convert_tstamp(stripe_invoice, "period_start")
-    date = utils.convert_tstamp(stripe_invoice, "date")
-    sub_id = stripe_invoice.get("subscription")
-
-    if stripe_invoice.get("charge"):
-        charge = charges.sync_charge_from_stripe_data(stripe.Charge.retrieve(stripe_invoice["charge"]))
+    c = cache.customer(stripe_invoice["customer"])
+    stripe_charge = stripe_invoice.get("charge")
+    stripe_subscription = stripe_invoice.get("subscription")
+
+    if stripe_charge:
+        if not isinstance(stripe_charge, dict):
+            stripe_charge = stripe.Charge.retrieve(stripe_charge)
+        charge = charges.sync_charge_from_stripe_data(stripe_charge)
         if send_receipt:
             hooks.hookset.send_receipt(charge)
     else:
         charge = None
 
-    stripe_subscription = subscriptions.retrieve(c, sub_id)
+    if not isinstance(stripe_subscription, dict):
+        stripe_subscription = subscriptions.retrieve(c, stripe_subscription)
     subscription = subscriptions.sync_subscription_from_stripe_data(c, stripe_subscription) if stripe_subscription else None
 
-    defaults = dict(
-        customer=c,
-        attempted=stripe_invoice["attempted"],
-        attempt_count=stripe_invoice["attempt_count"],
-        amount_due=utils.convert_amount_for_db(stripe_invoice["amount_due"], stripe_invoice["currency"]),
-        closed=stripe_invoice["closed"],
-        paid=stripe_invoice["paid"],
-        period_end=period_end,
-        period_start=period_start,
-        subtotal=utils.convert_amount_for_db(stripe_invoice["subtotal"], stripe_invoice["currency"]),
-        total=utils.convert_amount_for_db(stripe_invoice["total"], stripe_invoice["currency"]),
-        currency=stripe_invoice["currency"],
-        date=date,
-        charge=charge,
-        subscription=subscription
-    )
-    invoice, created = models.Invoice.objects.get_or_create(
-        stripe_id=stripe_invoice["id"],
-        defaults=defaults
-    )
+    defaults = _invoice_defaults(c, stripe_invoice, charge, subscription)
+    invoice = utils.bulk_upsert(
+        models.Invoice.objects,
+        {stripe_invoice["id"]: defaults}
+    )[stripe_invoice["id"]]
     if charge is not None:
-        charge.invoice = invoice
-        charge.save()
+        utils.update_with_defaults(charge, {"invoice": invoice}, False)
 
-    invoice = utils.update_with_defaults(invoice, defaults, created)
-    sync_invoice_items(invoice, stripe_invoice["lines"].get("data", []))
+    sync_invoice_items(invoice, stripe_invoice["lines"].get("data", []), complete=_lines_complete(stripe_invoice))
 
     return invoice
 
 
+def _sync_invoice_charges(stripe_invoices):
+    expanded = [i["charge"] for i in stripe_invoices if isinstance(i.get("charge"), dict)]
+    synced = {charge.stripe_id: charge for charge in charges.sync_charges_from_stripe_data(expanded)}
+    synced.update({
+        charge.stripe_id: charge
+        for charge in models.Charge.objects.filter(
+            stripe_id__in=set(
+                i["charge"] for i in stripe_invoices
+                if i.get("charge") and not isinstance(i["charge"], dict)
+            )
+        )
+    })
+    return synced
+
+
+def _sync_invoice_subscriptions(stripe_invoices):
+    expanded = [i["subscription"] for i in stripe_invoices if isinstance(i.get("subscription"), dict)]
+    synced = {
+        subscription.stripe_id: subscription
+        for subscription in subscriptions.sync_account_subscriptions_from_stripe_data(expanded)
+    }
+    ids = set(
+        i["subscription"] for i in stripe_invoices
+        if i.get("subscription") and not isinstance(i["subscription"], dict)
+    )
+    ids.update(
+        item["id"]
+        for i in stripe_invoices
+        for item in i["lines"].get("data", [])
+        if item["type"] == "subscription" and item["id"] not in synced
+    )
+    synced.update({
+        subscription.stripe_id: subscription
+        for subscription in models.Subscription.objects.filter(stripe_id__in=ids)
+    })
+    return synced
+
+
+def sync_invoices_from_stripe_data(stripe_invoices):
+    """
+    Syncronizes a batch of invoices with data from the Stripe API, such as a
+    page of account-wide invoices
+
+    Charges and subscriptions expanded in the invoices are synced in bulk.
+    Those that were not expanded but have already been syncronized locally
+    are used as they are, and only the rest is retrieved from the API, once
+    each. Invoices for customers that do not exist locally are skipped and no
+    receipts are sent.
+
+    Args:
+        stripe_invoices: data that represents invoices from the Stripe API
+
+    Returns:
+        a list of the pinax.stripe.models.Invoice objects created or updated
+    """
+    customers = {
+        customer.stripe_id: customer
+        for customer in models.Customer.objects.filter(
+            stripe_id__in=set(stripe_invoice["customer"] for stripe_invoice in stripe_invoices)
+        )
+    }
+    stripe_invoices = [i for i in stripe_invoices if i["customer"] in customers]
+    known_charges = _sync_invoice_charges(stripe_invoices)
+    known_subscriptions = _sync_invoice_subscriptions(stripe_invoices)
+    rows = collections.OrderedDict()
+    for stripe_invoice in stripe_invoices:
+        c = customers[stripe_invoice["customer"]]
+        charge_id = _expanded_id(stripe_invoice.get("charge"))
+        charge = known_charges.get(charge_id)
+        if charge is None and charge_id:
+            charge = charges.sync_charge_from_stripe_data(stripe.Charge.retrieve(charge_id))
+        sub_id = _expanded_id(stripe_invoice.get("subscription"))
+        subscription = known_subscriptions.get(sub_id)
+        if subscription is None and sub_id:
+            stripe_subscription = subscriptions.retrieve(c, sub_id)
+            subscription = subscriptions.sync_subscription_from_stripe_data(c, stripe_subscription) if stripe_subscription else None
+            known_subscriptions[sub_id] = subscription
+        rows[stripe_invoice["id"]] = _invoice_defaults(c, stripe_invoice, charge, subscription)
+    invoices = utils.bulk_upsert(models.Invoice.objects, rows)
+    for stripe_invoice in stripe_invoices:
+        invoice = invoices[stripe_invoice["id"]]
+        if invoice.charge is not None:
+            utils.update_with_defaults(invoice.charge, {"invoice": invoice}, False)
+        sync_invoice_items(
+            invoice,
+            stripe_invoice["lines"].get("data", []),
+            known_subscriptions,
+            complete=_lines_complete(stripe_invoice)
+        )
+    return [invoices[stripe_invoice["id"]] for stripe_invoice in stripe_invoices]
+
+
 def sync_invoices_for_customer(customer):
     """
     Syncronizes all invoices for a customer
 
+    The invoices are listed a page at a time with their charges and
+    subscriptions expanded, so this costs one API request per page.
+
     Args:
         customer: the customer for whom to syncronize all invoices
     """
-    for invoice in customer.stripe_customer.invoices().data:
-        sync_invoice_from_stripe_data(invoice, send_receipt=False)
+    for page in utils.iter_pages(stripe.Invoice, customer=customer.stripe_id, expand=INVOICE_EXPAND):
+        sync_invoices_from_stripe_data(page)
 
 
-def sync_invoice_items(invoice, items):
+def _lines_complete(stripe_invoice):
+    # Invoices come with the first page of their lines only
+    return not stripe_invoice["lines"].get("has_more", False)
+
+
+def sync_invoice_items(invoice, items, known_subscriptions=None, complete=False):
     """
     Syncronizes all invoice line items for a particular invoice
 
@@ -146,19 +265,33 @@ def sync_invoice_items(invoice, items):
     Args:
         invoice_: the invoice objects to syncronize
         items: the data from the Stripe API representing the line items
+        known_subscriptions: optionally, a dict of Subscription objects (or
+                             None for ones that do not exist) keyed by Stripe
+                             ID to use instead of retrieving them. Subscriptions
+                             retrieved here are added to it.
+        complete: if True, items are all of the invoice's line items and the
+                  local ones that are not among them are deleted
     """
+    known = {} if known_subscriptions is None else known_subscriptions
+    plans = cache.pks(models.Plan, set(item["plan"]["id"] for item in items if item.get("plan")))
+    rows = collections.OrderedDict()
     for item in items:
         period_end = utils.convert_tstamp(item["period"], "end")
         period_start = utils.convert_tstamp(item["period"], "start")
 
         if item.get("plan"):
-            plan = models.Plan.objects.get(stripe_id=item["plan"]["id"])
+            try:
+                plan_id = plans[item["plan"]["id"]]
+            except KeyError:
+                raise models.Plan.DoesNotExist("Plan matching query does not exist: {0}".format(item["plan"]["id"]))
         else:
-            plan = None
+            plan_id = None
 
         if item["type"] == "subscription":
             if invoice.subscription and invoice.subscription.stripe_id == item["id"]:
                 item_subscription = invoice.subscription
+            elif item["id"] in known:
+                item_subscription = known[item["id"]]
             else:
                 stripe_subscription = subscriptions.retrieve(
                     invoice.customer,
@@ -168,24 +301,25 @@ def sync_invoice_items(invoice, items):
                     invoice.customer,
                     stripe_subscription
                 ) if stripe_subscription else None
-            plan = item_subscription.plan if item_subscription is not None and plan is None else None
+                known[item["id"]] = item_subscription
+            plan_id = item_subscription.plan_id if item_subscription is not None and plan_id is None else None
         else:
             item_subscription = None
 
-        defaults = dict(
+        rows[item["id"]] = dict(
+            invoice=invoice,
             amount=utils.convert_amount_for_db(item["amount"], item["currency"]),
             currency=item["currency"],
             proration=item["proration"],
             description=item.get("description") or "",
             line_type=item["type"],
-            plan=plan,
+            plan_id=plan_id,
             period_start=period_start,
             period_end=period_end,
             quantity=item.get("quantity"),
             subscription=item_subscription
         )
-        inv_item, inv_item_created = invoice.items.get_or_create(
-            stripe_id=item["id"],
-            defaults=defaults
-        )
-        utils.update_with_defaults(inv_item, defaults, inv_item_created)
+    with transaction.atomic():
+        utils.bulk_upsert(invoice.items, rows)
+        if complete:
+            invoice.items.exclude(stripe_id__in=list(rows)).delete()
@@ -1,5 +1,8 @@
+import collections
+
 import stripe
 
+from .. import cache
 from .. import utils
 from .. import models
 
@@ -13,8 +16,8 @@ def sync_plans():
     except AttributeError:
         plans = iter(stripe.Plan.all().data)
 
-    for plan in plans:
-        defaults = dict(
+    utils.bulk_upsert(models.Plan.objects, collections.OrderedDict(
+        (plan["id"], dict(
             amount=utils.convert_amount_for_db(plan["amount"], plan["currency"]),
             currency=plan["currency"] or "",
             interval=plan["interval"],
@@ -23,9 +26,7 @@ def sync_plans():
             statement_descriptor=plan["statement_descriptor"] or "",
             trial_period_days=plan["trial_period_days"],
             metadata=plan["metadata"]
-        )
-        obj, created = models.Plan.objects.get_or_create(
-            stripe_id=plan["id"],
-            defaults=defaults
-        )
-        utils.update_with_defaults(obj, defaults, created)
+        ))
+        for plan in plans
+    ))
+    cache.clear_pks(models.Plan)
@@ -0,0 +1,277 @@
+import datetime
+import decimal
+
+from django.conf import settings
+from django.db import IntegrityError, connection, transaction
+from django.db.models import F, Q
+from django.utils import timezone
+
+from .. import models
+
+
+def _day(value):
+    if settings.USE_TZ and timezone.is_aware(value):
+        value = timezone.localtime(value, timezone.get_default_timezone())
+    return value.date()
+
+
+def _midnight(date):
+    value = datetime.datetime.combine(date, datetime.time())
+    if settings.USE_TZ:
+        value = timezone.make_aware(value, timezone.get_default_timezone())
+    return value
+
+
+def _on_days(field, dates):
+    """
+    Returns a Q object selecting the rows whose datetime field falls on one of
+    dates, as one range per run of consecutive days
+    """
+    q = Q()
+    if dates is None:
+        return q
+    runs = []
+    for date in sorted(dates):
+        if runs and runs[-1][1] == date:
+            runs[-1][1] = date + datetime.timedelta(days=1)
+        else:
+            runs.append([date, date + datetime.timedelta(days=1)])
+    for start, end in runs:
+        q |= Q(**{
+            "{0}__gte".format(field): _midnight(start),
+            "{0}__lt".format(field): _midnight(end)
+        })
+    return q
+
+
+def _replace(model, dates, compute):
+    def replace():
+        with transaction.atomic():
+            qs = model.objects.all() if dates is None else model.objects.filter(date__in=dates)
+            qs.delete()
+            objs = compute()
+            model.objects.bulk_create(objs)
+        return objs
+    try:
+        return replace()
+    except IntegrityError:
+        # Another process rolled up some of the same days at the same time,
+        # computing them again includes anything it saw
+        return replace()
+
+
+# The fields of charges and subscriptions the rollups are computed from
+CHARGE_FIELDS = ("charge_created", "currency", "amount", "amount_refunded", "paid")
+SUBSCRIPTION_FIELDS = ("start", "canceled_at", "status", "plan")
+
+
+def locked(qs):
+    """
+    Returns qs locking the rows it selects where the database supports it, so
+    that concurrent syncs of the same objects each see the other's changes
+    before working out their own
+    """
+    if connection.features.has_select_for_update:
+        return qs.select_for_update()
+    return qs
+
+
+def _difference(before, after):
+    deltas = {}
+    for sign, totals in ((-1, before), (1, after)):
+        for key, values in totals.items():
+            delta = deltas.setdefault(key, [0] * len(values))
+            for i, value in enumerate(values):
+                delta[i] += sign * value
+    return dict((key, delta) for key, delta in deltas.items() if any(delta))
+
+
+def _add(model, key_fields, fields, deltas):
+    for key, delta in deltas.items():
+        lookup = dict(zip(key_fields, key))
+        changes = dict((field, value) for field, value in zip(fields, delta) if value)
+
+        def update():
+            return model.objects.filter(**lookup).update(**dict(
+                (field, F(field) + value) for field, value in changes.items()
+            ))
+        if update():
+            continue
+        try:
+            with transaction.atomic():
+                # Without a row the day was not rolled up before, which the
+                # rebuild_rollups command corrects, so never count below zero
+                model.objects.create(**dict(lookup, **dict(
+                    (field, max(value, 0)) for field, value in changes.items()
+                )))
+        except IntegrityError:
+            # Created by another process in the meantime
+            update()
+
+
+def charge_totals(charges):
+    """
+    Returns what charges add to the DailyChargeTotal rows
+
+    Args:
+        charges: pinax.stripe.models.Charge objects
+
+    Returns:
+        a dict of [count, gross, refunded] lists keyed by (date, currency)
+    """
+    totals = {}
+    for charge in charges:
+        if not charge.paid or charge.charge_created is None:
+            continue
+        total = totals.setdefault((_day(charge.charge_created), charge.currency), [0, decimal.Decimal("0"), decimal.Decimal("0")])
+        total[0] += 1
+        total[1] += charge.amount or 0
+        total[2] += charge.amount_refunded or 0
+    return totals
+
+
+def subscription_counts(subscriptions):
+    """
+    Returns what subscriptions add to the DailySubscriptionCount rows
+
+    Args:
+        subscriptions: pinax.stripe.models.Subscription objects
+
+    Returns:
+        a dict of [new, canceled] lists keyed by (date, plan primary key)
+    """
+    counts = {}
+    for subscription in subscriptions:
+        if subscription.start is not None and subscription.status != "trialing":
+            counts.setdefault((_day(subscription.start), subscription.plan_id), [0, 0])[0] += 1
+        if subscription.canceled_at is not None and subscription.status == "canceled":
+            counts.setdefault((_day(subscription.canceled_at), subscription.plan_id), [0, 0])[1] += 1
+    return counts
+
+
+def apply_charge_changes(before, after):
+    """
+    Adjusts the DailyChargeTotal rows by the difference between charges as
+    they were before a sync and as they are after it, touching only the rows
+    of the days and currencies that changed
+
+    Args:
+        before: the pinax.stripe.models.Charge objects as they were, leaving
+                out the ones that did not exist
+        after: the Charge objects as they are now, leaving out deleted ones
+    """
+    _add(
+        models.DailyChargeTotal,
+        ("date", "currency"),
+        ("count", "gross", "refunded"),
+        _difference(charge_totals(before), charge_totals(after))
+    )
+
+
+def apply_subscription_changes(before, after):
+    """
+    Adjusts the DailySubscriptionCount rows by the difference between
+    subscriptions as they were before a sync and as they are after it,
+    touching only the rows of the days and plans that changed
+
+    Args:
+        before: the pinax.stripe.models.Subscription objects as they were,
+                leaving out the ones that did not exist
+        after: the Subscription objects as they are now, leaving out deleted
+               ones
+    """
+    _add(
+        models.DailySubscriptionCount,
+        ("date", "plan_id"),
+        ("new", "canceled"),
+        _difference(subscription_counts(before), subscription_counts(after))
+    )
+
+
+def update_charge_totals(dates=None):
+    """
+    Computes the pinax.stripe.models.DailyChargeTotal rows for some days again
+    from all of their charges, unlike apply_charge_changes
+
+    Args:
+        dates: the days to compute, or None for all of them
+
+    Returns:
+        the DailyChargeTotal objects created
+    """
+    if dates is not None and not dates:
+        return []
+
+    def compute():
+        totals = {}
+        charges = models.Charge.objects.filter(
+            _on_days("charge_created", dates),
+            paid=True,
+            charge_created__isnull=False
+        ).values_list("charge_created", "currency", "amount", "amount_refunded")
+        for created, currency, amount, refunded in charges.iterator():
+            total = totals.setdefault((_day(created), currency), models.DailyChargeTotal(
+                date=_day(created),
+                currency=currency,
+                count=0,
+                gross=decimal.Decimal("0"),
+                refunded=decimal.Decimal("0")
+            ))
+            total.count += 1
+            total.gross += amount or 0
+            total.refunded += refunded or 0
+        return list(totals.values())
+    return _replace(models.DailyChargeTotal, dates, compute)
+
+
+def update_subscription_counts(dates=None):
+    """
+    Computes the pinax.stripe.models.DailySubscriptionCount rows for some days
+    again from all of their subscriptions, unlike apply_subscription_changes
+
+    Args:
+        dates: the days to compute, or None for all of them
+
+    Returns:
+        the DailySubscriptionCount objects created
+    """
+    if dates is not None and not dates:
+        return []
+
+    def compute():
+        counts = {}
+
+        def count(value, plan_id, field):
+            row = counts.setdefault((_day(value), plan_id), models.DailySubscriptionCount(
+                date=_day(value),
+                plan_id=plan_id
+            ))
+            setattr(row, field, getattr(row, field) + 1)
+
+        started = models.Subscription.objects.filter(
+            _on_days("start", dates)
+        ).exclude(
+            status="trialing"
+        ).values_list("start", "plan_id")
+        for start, plan_id in started.iterator():
+            count(start, plan_id, "new")
+        canceled = models.Subscription.objects.filter(
+            _on_days("canceled_at", dates),
+            status="canceled",
+            canceled_at__isnull=False
+        ).values_list("canceled_at", "plan_id")
+        for canceled_at, plan_id in canceled.iterator():
+            count(canceled_at, plan_id, "canceled")
+        return list(counts.values())
+    return _replace(models.DailySubscriptionCount, dates, compute)
+
+
+def rebuild():
+    """
+    Computes all of the rollups again from the charges and subscriptions
+
+    Returns:
+        a tuple of the number of DailyChargeTotal and DailySubscriptionCount
+        rows created
+    """
+    return len(update_charge_totals()), len(update_subscription_counts())
@@ -1,3 +1,6 @@
+import collections
+
+from .. import cache
 from .. import models
 from .. import utils
 
@@ -23,6 +26,7 @@ def delete_card(customer, source):
         source: the Stripe ID of the payment source to delete
     """
     customer.stripe_customer.sources.retrieve(source).delete()
+    cache.invalidate(customer)
     return delete_card_object(source)
 
 
@@ -37,15 +41,8 @@ def delete_card_object(source):
         return models.Card.objects.filter(stripe_id=source).delete()
 
 
-def sync_card(customer, source):
-    """
-    Syncronizes the data for a card locally for a given customer
-
-    Args:
-        customer: the customer to create or update a card for
-        source: data reprenting the card from the Stripe API
-    """
-    defaults = dict(
+def _card_defaults(customer, source):
+    return dict(
         customer=customer,
         name=source["name"] or "",
         address_line_1=source["address_line1"] or "",
@@ -66,22 +63,10 @@ def sync_card(customer, source):
         last4=source["last4"] or "",
         fingerprint=source["fingerprint"] or ""
     )
-    card, created = models.Card.objects.get_or_create(
-        stripe_id=source["id"],
-        defaults=defaults
-    )
-    return utils.update_with_defaults(card, defaults, created)
 
 
-def sync_bitcoin(customer, source):
-    """
-    Syncronizes the data for a Bitcoin receiver locally for a given customer
-
-    Args:
-        customer: the customer to create or update a Bitcoin receiver for
-        source: data reprenting the Bitcoin receiver from the Stripe API
-    """
-    defaults = dict(
+def _bitcoin_defaults(customer, source):
+    return dict(
         customer=customer,
         active=source["active"],
         amount=utils.convert_amount_for_db(source["amount"], source["currency"]),
@@ -99,11 +84,34 @@ def sync_bitcoin(customer, source):
         uncaptured_funds=source["uncaptured_funds"],
         used_for_payment=source["used_for_payment"]
     )
-    receiver, created = models.BitcoinReceiver.objects.get_or_create(
-        stripe_id=source["id"],
-        defaults=defaults
-    )
-    return utils.update_with_defaults(receiver, defaults, created)
+
+
+def sync_card(customer, source):
+    """
+    Syncronizes the data for a card locally for a given customer
+
+    Args:
+        customer: the customer to create or update a card for
+        source: data reprenting the card from the Stripe API
+    """
+    return utils.bulk_upsert(
+        models.Card.objects,
+        {source["id"]: _card_defaults(customer, source)}
+    )[source["id"]]
+
+
+def sync_bitcoin(customer, source):
+    """
+    Syncronizes the data for a Bitcoin receiver locally for a given customer
+
+    Args:
+        customer: the customer to create or update a Bitcoin receiver for
+        source: data reprenting the Bitcoin receiver from the Stripe API
+    """
+    return utils.bulk_upsert(
+        models.BitcoinReceiver.objects,
+        {source["id"]: _bitcoin_defaults(customer, source)}
+    )[source["id"]]
 
 
 def sync_payment_source_from_stripe_data(customer, source):
@@ -120,6 +128,32 @@ def sync_payment_source_from_stripe_data(customer, source):
         return sync_bitcoin(customer, source)
 
 
+def sync_payment_sources_from_stripe_data(customer, sources):
+    """
+    Syncronizes the data for a batch of payment sources locally for a given
+    customer in a constant number of queries
+
+    Args:
+        customer: the customer to create or update the payment sources for
+        sources: data reprenting the payment sources from the Stripe API
+
+    Returns:
+        a list of the Card and BitcoinReceiver objects, in the same order as
+        sources
+    """
+    cards = collections.OrderedDict()
+    receivers = collections.OrderedDict()
+    for source in sources:
+        if source["id"].startswith("card_"):
+            cards[source["id"]] = _card_defaults(customer, source)
+        else:
+            receivers[source["id"]] = _bitcoin_defaults(customer, source)
+    objs = utils.bulk_upsert(models.Card.objects, cards) if cards else {}
+    if receivers:
+        objs.update(utils.bulk_upsert(models.BitcoinReceiver.objects, receivers))
+    return [objs[source["id"]] for source in sources]
+
+
 def update_card(customer, source, name=None, exp_month=None, exp_year=None):
     """
     Updates a card for a given customer
@@ -1,14 +1,19 @@
+import collections
 import datetime
 
-from django.db.models import Q
+from django.core.cache import cache
+from django.db import transaction
 from django.utils import timezone
 from django.utils.encoding import smart_str
 
 import stripe
 
+from . import rollups
+from .. import cache as local_cache
 from .. import hooks
 from .. import models
 from .. import utils
+from ..conf import settings
 
 
 def cancel(subscription, at_period_end=True):
@@ -64,17 +69,86 @@ def has_active_subscription(customer):
     """
     Checks if the given customer has an active subscription
 
+    This reads the subscription summary columns of the customer, a single
+    primary key lookup, rather than the customer's subscriptions.
+
     Args:
         customer: the customer to check
 
     Returns:
         True, if there is an active subscription, otherwise False
     """
-    return models.Subscription.objects.filter(
-        customer=customer
-    ).filter(
-        Q(ended_at__isnull=True) | Q(ended_at__gt=timezone.now())
-    ).exists()
+    if customer is None:
+        return False
+    summary = models.Customer.objects.filter(pk=customer.pk).values_list(
+        "active_subscription_count",
+        "subscription_ended_at_max"
+    ).first()
+    return summary is not None and _is_active(*summary)
+
+
+def _is_active(active_subscription_count, subscription_ended_at_max):
+    return active_subscription_count > 0 or (
+        subscription_ended_at_max is not None and subscription_ended_at_max > timezone.now()
+    )
+
+
+def _active_subscription_cache_key(user_pk):
+    return "pinax-stripe-active-subscription-{0}".format(user_pk)
+
+
+def user_has_active_subscription(user):
+    """
+    Checks if the customer for the given user has an active subscription,
+    caching the answer for PINAX_STRIPE_SUBSCRIPTION_CACHE_TIMEOUT seconds
+
+    The cached answer is dropped whenever the user's subscriptions are synced.
+    An active answer is never cached past the time the last active
+    subscription is due to end.
+
+    Args:
+        user: the user to check
+
+    Returns:
+        True, if there is an active subscription, otherwise False
+    """
+    timeout = settings.PINAX_STRIPE_SUBSCRIPTION_CACHE_TIMEOUT
+    key = _active_subscription_cache_key(user.pk)
+    if timeout:
+        active = cache.get(key)
+        if active is not None:
+            return active
+    summary = models.Customer.objects.filter(user=user).values_list(
+        "active_subscription_count",
+        "subscription_ended_at_max"
+    ).first()
+    active = summary is not None and _is_active(*summary)
+    if timeout:
+        if active and summary[0] == 0:
+            # Every active subscription is due to end
+            timeout = min(timeout, int((summary[1] - timezone.now()).total_seconds()) + 1)
+        cache.set(key, active, timeout)
+    return active
+
+
+def invalidate_active_subscription(customer):
+    """
+    Drops the cached answer of user_has_active_subscription for the user of
+    the given customer, once the current transaction commits
+
+    Args:
+        customer: the customer who's subscriptions changed
+    """
+    if customer is None or customer.user_id is None:
+        return
+    key = _active_subscription_cache_key(customer.user_id)
+    on_commit = getattr(transaction, "on_commit", None)
+    if on_commit is not None:
+        # Until the change is committed other requests still see the old
+        # subscriptions and would cache the old answer again
+        on_commit(lambda: cache.delete(key))
+    else:
+        cache.delete(key)
 
 
 def is_period_current(subscription):
@@ -137,18 +211,8 @@ def retrieve(customer, sub_id):
             raise
 
 
-def sync_subscription_from_stripe_data(customer, subscription):
-    """
-    Syncronizes data from the Stripe API for a subscription
-
-    Args:
-        customer: the customer who's subscription you are syncronizing
-        subscription: data from the Stripe API representing a subscription
-
-    Returns:
-        the pinax.stripe.models.Subscription object created or updated
-    """
-    defaults = dict(
+def _subscription_defaults(customer, subscription, plan_id):
+    return dict(
         customer=customer,
         application_fee_percent=subscription["application_fee_percent"],
         cancel_at_period_end=subscription["cancel_at_period_end"],
@@ -156,19 +220,94 @@ def sync_subscription_from_stripe_data(customer, subscription):
         current_period_start=utils.convert_tstamp(subscription["current_period_start"]),
         current_period_end=utils.convert_tstamp(subscription["current_period_end"]),
         ended_at=utils.convert_tstamp(subscription["ended_at"]),
-        plan=models.Plan.objects.get(stripe_id=subscription["plan"]["id"]),
+        plan_id=plan_id,
         quantity=subscription["quantity"],
         start=utils.convert_tstamp(subscription["start"]),
         status=subscription["status"],
         trial_start=utils.convert_tstamp(subscription["trial_start"]) if subscription["trial_start"] else None,
         trial_end=utils.convert_tstamp(subscription["trial_end"]) if subscription["trial_end"] else None
     )
-    sub, created = models.Subscription.objects.get_or_create(
-        stripe_id=subscription["id"],
-        defaults=defaults
+
+
+def sync_subscription_from_stripe_data(customer, subscription):
+    """
+    Syncronizes data from the Stripe API for a subscription
+
+    Args:
+        customer: the customer who's subscription you are syncronizing
+        subscription: data from the Stripe API representing a subscription
+
+    Returns:
+        the pinax.stripe.models.Subscription object created or updated
+    """
+    return sync_subscriptions_from_stripe_data(customer, [subscription])[0]
+
+
+def sync_subscriptions_from_stripe_data(customer, subscriptions):
+    """
+    Syncronizes data from the Stripe API for a batch of subscriptions in a
+    constant number of queries
+
+    Args:
+        customer: the customer who's subscriptions you are syncronizing
+        subscriptions: data from the Stripe API representing subscriptions
+
+    Returns:
+        a list of the pinax.stripe.models.Subscription objects created or
+        updated, in the same order as subscriptions
+    """
+    plan_ids = set(subscription["plan"]["id"] for subscription in subscriptions)
+    plans = local_cache.pks(models.Plan, plan_ids)
+    missing = plan_ids - set(plans)
+    if missing:
+        raise models.Plan.DoesNotExist("Plan matching query does not exist: {0}".format(", ".join(sorted(missing))))
+    rows = collections.OrderedDict(
+        (subscription["id"], _subscription_defaults(customer, subscription, plans[subscription["plan"]["id"]]))
+        for subscription in subscriptions
     )
-    sub = utils.update_with_defaults(sub, defaults, created)
-    return sub
+    if settings.PINAX_STRIPE_ROLLUPS:
+        with transaction.atomic():
+            before = list(rollups.locked(models.Subscription.objects.filter(
+                stripe_id__in=list(rows)
+            )).only(*rollups.SUBSCRIPTION_FIELDS))
+            subs = utils.bulk_upsert(models.Subscription.objects, rows)
+            rollups.apply_subscription_changes(before, subs.values())
+    else:
+        subs = utils.bulk_upsert(models.Subscription.objects, rows)
+    # Once for the whole batch, the post_save receiver leaves it to us
+    customer.update_subscription_summary()
+    invalidate_active_subscription(customer)
+    return [subs[subscription["id"]] for subscription in subscriptions]
+
+
+def sync_account_subscriptions_from_stripe_data(subscriptions):
+    """
+    Syncronizes a batch of subscriptions belonging to any number of customers,
+    such as a page of account-wide subscriptions from the Stripe API
+
+    Subscriptions for customers that do not exist locally are skipped.
+
+    Args:
+        subscriptions: data from the Stripe API representing subscriptions
+
+    Returns:
+        a list of the pinax.stripe.models.Subscription objects created or
+        updated
+    """
+    customers = {
+        customer.stripe_id: customer
+        for customer in models.Customer.objects.filter(
+            stripe_id__in=set(subscription["customer"] for subscription in subscriptions)
+        )
+    }
+    by_customer = {}
+    for subscription in subscriptions:
+        if subscription["customer"] in customers:
+            by_customer.setdefault(subscription["customer"], []).append(subscription)
+    synced = []
+    for stripe_id, batch in by_customer.items():
+        synced.extend(sync_subscriptions_from_stripe_data(customers[stripe_id], batch))
+    return synced
 
 
 def update(subscription, plan=None, quantity=None, prorate=True, coupon=None, charge_immediately=False):
@@ -4,18 +4,19 @@ from .. import models
 from .. import utils
 
 
-def during(year, month):
+def during(year=None, month=None, start=None, end=None):
     """
     Return a queryset of pinax.stripe.models.Transfer objects for the provided
-    year and month.
+    year and month, in the current timezone, or for the provided window.
 
     Args:
         year: 4-digit year
         month: month as a integer, 1=January through 12=December
+        start: the start of the window, inclusive, instead of year and month
+        end: the end of the window, exclusive, instead of year and month
     """
     return models.Transfer.objects.filter(
-        date__year=year,
-        date__month=month
+        **utils.during_filter("date", year, month, start, end)
     )
 
 
@@ -39,9 +40,7 @@ def sync_transfer(transfer, event=None):
         stripe_id=transfer["id"],
         defaults=defaults
     )
-    if not created:
-        obj.status = transfer["status"]
-        obj.save()
+    utils.update_with_defaults(obj, {"status": transfer["status"]}, created)
 
 
 def update_status(transfer):
@@ -1,7 +1,18 @@
 from django.contrib import admin
+from django.contrib.admin.views.main import ORDER_VAR, PAGE_VAR, ChangeList
 from django.contrib.auth import get_user_model
-from django.db.models import Count, Q
-
+from django.core.paginator import Paginator
+from django.db import connections
+from django.db.models import Q
+from django.utils.dateparse import parse_datetime
+from django.utils.functional import cached_property
+
+try:
+    from django.db.models import Exists, OuterRef
+except ImportError:  # Django < 1.11
+    Exists = OuterRef = None
+
+from .conf import settings
 from .models import (  # @@@ make all these read-only
     Charge,
     Subscription,
@@ -17,6 +28,120 @@ from .models import (  # @@@ make all these read-only
     Transfer,
     TransferChargeFee
 )
+from .webhooks import registry
+
+
+CURSOR_VAR = "cursor"
+
+
+def estimated_count(queryset):
+    """
+    Returns the number of rows in the table of an unfiltered queryset from the
+    database statistics, or None if the database does not keep one
+    """
+    if queryset.query.where:
+        return None
+    connection = connections[queryset.db]
+    table = queryset.model._meta.db_table
+    if connection.vendor == "postgresql":
+        sql = "SELECT reltuples FROM pg_class WHERE relname = %s"
+    elif connection.vendor == "mysql":
+        sql = "SELECT table_rows FROM information_schema.tables WHERE table_schema = DATABASE() AND table_name = %s"
+    else:
+        return None
+    with connection.cursor() as cursor:
+        cursor.execute(sql, [table])
+        row = cursor.fetchone()
+    return int(row[0]) if row and row[0] is not None else None
+
+
+class EstimatedCountPaginator(Paginator):
+    """
+    Uses the table statistics for the count of large unfiltered tables rather
+    than counting every row
+    """
+
+    # Below this the estimate may well be off, and counting is cheap anyway
+    MIN_ESTIMATE = 10000
+
+    @cached_property
+    def count(self):
+        estimate = estimated_count(self.object_list)
+        if estimate is not None and estimate >= self.MIN_ESTIMATE:
+            return estimate
+        return super(EstimatedCountPaginator, self).count
+
+
+class KeysetChangeList(ChangeList):
+    """
+    Pages through the rows newest first by (created_at, id), fetching each page
+    with an index range scan however deep it is, rather than by offset.
+    Sorting by a column falls back to the usual pagination.
+    """
+
+    def get_filters_params(self, params=None):
+        lookup_params = super(KeysetChangeList, self).get_filters_params(params)
+        lookup_params.pop(CURSOR_VAR, None)
+        return lookup_params
+
+    def get_results(self, request):
+        self.keyset = ORDER_VAR not in self.params
+        if not self.keyset:
+            return super(KeysetChangeList, self).get_results(request)
+        queryset = self.queryset.order_by("-created_at", "-pk")
+        self.cursor = self.params.get(CURSOR_VAR)
+        if self.cursor:
+            try:
+                created_at, pk = self.cursor.rsplit("_", 1)
+                created_at, pk = parse_datetime(created_at), int(pk)
+            except ValueError:
+                created_at = None
+            if created_at is None:
+                raise admin.options.IncorrectLookupParameters
+            queryset = queryset.filter(Q(created_at__lt=created_at) | Q(created_at=created_at, pk__lt=pk))
+        rows = list(queryset[:self.list_per_page + 1])
+        self.next_cursor = None
+        if len(rows) > self.list_per_page:
+            rows = rows[:self.list_per_page]
+            self.next_cursor = "{0}_{1}".format(rows[-1].created_at.isoformat(), rows[-1].pk)
+        self.paginator = self.model_admin.get_paginator(request, self.queryset, self.list_per_page)
+        self.result_count = self.paginator.count
+        self.show_full_result_count = False
+        self.show_admin_actions = True
+        self.full_result_count = None
+        self.result_list = rows
+        self.can_show_all = False
+        self.multi_page = bool(self.cursor or self.next_cursor)
+
+    @property
+    def first_page_url(self):
+        return self.get_query_string(remove=[CURSOR_VAR, PAGE_VAR])
+
+    @property
+    def next_page_url(self):
+        return self.get_query_string({CURSOR_VAR: self.next_cursor}, [PAGE_VAR])
+
+
+class KeysetModelAdmin(admin.ModelAdmin):
+    """
+    For tables that grow without bound, such as events: uses keyset pagination
+    and an estimated count, and only searches the columns in
+    payload_search_fields when PINAX_STRIPE_ADMIN_PAYLOAD_SEARCH is on
+    """
+
+    change_list_template = "admin/pinax_stripe/keyset_change_list.html"
+    paginator = EstimatedCountPaginator
+    show_full_result_count = False
+    payload_search_fields = []
+
+    def get_changelist(self, request, **kwargs):
+        return KeysetChangeList
+
+    def get_search_fields(self, request):
+        search_fields = list(super(KeysetModelAdmin, self).get_search_fields(request))
+        if settings.PINAX_STRIPE_ADMIN_PAYLOAD_SEARCH:
+            search_fields += self.payload_search_fields
+        return search_fields
 
 
 def user_search_fields():  # coverage: omit
@@ -76,6 +201,10 @@ class InvoiceCustomerHasCardListFilter(admin.SimpleListFilter):
         return queryset.all()
 
 
+# The statuses Stripe gives subscriptions
+SUBSCRIPTION_STATUSES = ["trialing", "active", "past_due", "canceled", "unpaid"]
+
+
 class CustomerSubscriptionStatusListFilter(admin.SimpleListFilter):
     title = "subscription status"
     parameter_name = "sub_status"
@@ -83,31 +212,32 @@ class CustomerSubscriptionStatusListFilter(admin.SimpleListFilter):
     def lookups(self, request, model_admin):
         statuses = [
             [x, x.replace("_", " ").title()]
-            for x in Subscription.objects.all().values_list(
-                "status",
-                flat=True
-            ).distinct()
+            for x in SUBSCRIPTION_STATUSES
         ]
         statuses.append(["none", "No Subscription"])
         return statuses
 
     def queryset(self, request, queryset):
-        if self.value() == "none":
-            # Get customers with 0 subscriptions
-            return queryset.annotate(subs=Count('subscription')).filter(subs=0)
-        elif self.value():
-            # Get customer pks without a subscription with this status
-            customers = Subscription.objects.filter(
-                status=self.value()).values_list(
-                'customer', flat=True).distinct()
-            # Filter by those customers
+        if not self.value():
+            return queryset.all()
+        subscriptions = Subscription.objects.all()
+        if self.value() != "none":
+            subscriptions = subscriptions.filter(status=self.value())
+        if Exists is None:
+            customers = subscriptions.values("customer")
+            if self.value() == "none":
+                return queryset.exclude(pk__in=customers)
             return queryset.filter(pk__in=customers)
-        return queryset.all()
+        # Annotated first as Exists can only be filtered on once annotated
+        return queryset.annotate(
+            has_subscription=Exists(subscriptions.filter(customer=OuterRef("pk")))
+        ).filter(
+            has_subscription=self.value() != "none"
+        )
 
 
-admin.site.register(
-    Charge,
-    list_display=[
+class ChargeAdmin(admin.ModelAdmin):
+    list_display = [
         "stripe_id",
         "customer",
         "amount",
@@ -117,64 +247,96 @@ admin.site.register(
         "refunded",
         "receipt_sent",
         "created_at"
-    ],
-    search_fields=[
+    ]
+    search_fields = [
         "stripe_id",
         "customer__stripe_id",
         "invoice__stripe_id"
-    ] + customer_search_fields(),
-    list_filter=[
+    ] + customer_search_fields()
+    list_filter = [
         "paid",
         "disputed",
         "refunded",
         "created_at"
-    ],
-    raw_id_fields=[
+    ]
+    raw_id_fields = [
         "customer",
         "invoice"
-    ],
-)
+    ]
 
-admin.site.register(
-    EventProcessingException,
-    list_display=[
+    def get_queryset(self, request):
+        # The customer column shows the customer's user
+        return super(ChargeAdmin, self).get_queryset(request).select_related("customer__user")
+
+
+admin.site.register(Charge, ChargeAdmin)
+
+
+class EventProcessingExceptionAdmin(KeysetModelAdmin):
+    list_display = [
         "message",
         "event",
         "created_at"
-    ],
-    search_fields=[
-        "message",
+    ]
+    search_fields = [
+        "message"
+    ]
+    payload_search_fields = [
         "traceback",
         "data"
-    ],
-    raw_id_fields=[
+    ]
+    raw_id_fields = [
         "event"
-    ],
-)
+    ]
 
-admin.site.register(
-    Event,
-    raw_id_fields=["customer"],
-    list_display=[
+    def get_queryset(self, request):
+        return super(EventProcessingExceptionAdmin, self).get_queryset(request).select_related("event")
+
+
+admin.site.register(EventProcessingException, EventProcessingExceptionAdmin)
+
+
+class EventKindListFilter(admin.SimpleListFilter):
+    title = "kind"
+    parameter_name = "kind"
+
+    def lookups(self, request, model_admin):
+        # The registered webhooks rather than a SELECT DISTINCT over every event
+        return [[kind, kind] for kind in sorted(registry.keys())]
+
+    def queryset(self, request, queryset):
+        if self.value():
+            return queryset.filter(kind=self.value())
+        return queryset.all()
+
+
+class EventAdmin(KeysetModelAdmin):
+    raw_id_fields = ["customer"]
+    list_display = [
         "stripe_id",
         "kind",
         "livemode",
         "valid",
         "processed",
         "created_at"
-    ],
-    list_filter=[
-        "kind",
+    ]
+    list_filter = [
+        EventKindListFilter,
         "created_at",
         "valid",
         "processed"
-    ],
-    search_fields=[
-        "stripe_id",
-        "customer__stripe_id",
-        "validated_message"
-    ] + customer_search_fields(),
-)
+    ]
+    search_fields = [
+        "=stripe_id",
+        "=object_id",
+        "=customer__stripe_id"
+    ] + customer_search_fields()
+    payload_search_fields = [
+        "webhook_message"
+    ]
+
+
+admin.site.register(Event, EventAdmin)
 
 
 class SubscriptionInline(admin.TabularInline):
@@ -200,10 +362,9 @@ def subscription_status(obj):
 subscription_status.short_description = "Subscription Status"
 
 
-admin.site.register(
-    Customer,
-    raw_id_fields=["user"],
-    list_display=[
+class CustomerAdmin(admin.ModelAdmin):
+    raw_id_fields = ["user"]
+    list_display = [
         "stripe_id",
         "user",
         "account_balance",
@@ -212,21 +373,30 @@ admin.site.register(
         "default_source",
         subscription_status,
         "date_purged"
-    ],
-    list_filter=[
+    ]
+    list_filter = [
         "delinquent",
         CustomerHasCardListFilter,
         CustomerSubscriptionStatusListFilter
-    ],
-    search_fields=[
+    ]
+    search_fields = [
         "stripe_id",
-    ] + user_search_fields(),
-    inlines=[
+    ] + user_search_fields()
+    inlines = [
         SubscriptionInline,
         CardInline,
         BitcoinReceiverInline
     ]
-)
+
+    def get_queryset(self, request):
+        return super(CustomerAdmin, self).get_queryset(request).select_related(
+            "user"
+        ).prefetch_related(
+            "subscription_set"
+        )
+
+
+admin.site.register(Customer, CustomerAdmin)
 
 
 class InvoiceItemInline(admin.TabularInline):
@@ -236,7 +406,10 @@ class InvoiceItemInline(admin.TabularInline):
 
 
 def customer_has_card(obj):
-    return obj.customer.card_set.exclude(fingerprint='').exists()
+    if hasattr(obj, "customer_has_card"):
+        # Annotated by InvoiceAdmin
+        return obj.customer_has_card
+    return any(card.fingerprint != "" for card in obj.customer.card_set.all())
 customer_has_card.short_description = "Customer Has Card"
 
 
@@ -251,10 +424,9 @@ def customer_user(obj):
 customer_user.short_description = "Customer"
 
 
-admin.site.register(
-    Invoice,
-    raw_id_fields=["customer"],
-    list_display=[
+class InvoiceAdmin(admin.ModelAdmin):
+    raw_id_fields = ["customer"]
+    list_display = [
         "stripe_id",
         "paid",
         "closed",
@@ -264,12 +436,12 @@ admin.site.register(
         "period_end",
         "subtotal",
         "total"
-    ],
-    search_fields=[
+    ]
+    search_fields = [
         "stripe_id",
         "customer__stripe_id",
-    ] + customer_search_fields(),
-    list_filter=[
+    ] + customer_search_fields()
+    list_filter = [
         InvoiceCustomerHasCardListFilter,
         "paid",
         "closed",
@@ -279,11 +451,21 @@ admin.site.register(
         "date",
         "period_end",
         "total"
-    ],
-    inlines=[
+    ]
+    inlines = [
         InvoiceItemInline
     ]
-)
+
+    def get_queryset(self, request):
+        queryset = super(InvoiceAdmin, self).get_queryset(request).select_related("customer__user")
+        if Exists is None:
+            return queryset.prefetch_related("customer__card_set")
+        return queryset.annotate(customer_has_card=Exists(
+            Card.objects.filter(customer=OuterRef("customer")).exclude(fingerprint="")
+        ))
+
+
+admin.site.register(Invoice, InvoiceAdmin)
 
 admin.site.register(
     Plan,
@@ -0,0 +1,222 @@
+"""
+Subscription metrics over a range of months
+
+Each metric is computed with a single query using conditional aggregation,
+with one aggregate per month, and the results are yielded a month at a time.
+They are derived from the subscriptions as they are now: a subscription
+counts from its start until it ended, at its current plan and quantity, as
+the history of plan and quantity changes is not kept. Trialing
+subscriptions are left out.
+
+Requires Django 1.8 or later.
+"""
+import datetime
+import decimal
+
+from django.conf import settings
+from django.db.models import Case, DecimalField, ExpressionWrapper, F, IntegerField, Q, Sum, Value, When
+from django.utils import timezone
+
+from .models import Subscription
+from .utils import month_range
+
+# The number of months in a plan interval
+MONTHS_PER_INTERVAL = {
+    "day": decimal.Decimal("12") / decimal.Decimal("365"),
+    "week": decimal.Decimal("12") / decimal.Decimal("52"),
+    "month": decimal.Decimal("1"),
+    "year": decimal.Decimal("12"),
+}
+
+CENTS = decimal.Decimal("0.01")
+
+
+def _as_datetime(value):
+    if not isinstance(value, datetime.datetime):
+        value = datetime.datetime.combine(value, datetime.time())
+    if settings.USE_TZ:
+        if timezone.is_naive(value):
+            value = timezone.make_aware(value, timezone.get_current_timezone())
+        else:
+            value = timezone.localtime(value)
+    return value
+
+
+def months(start, end):
+    """
+    Returns the months from the one start falls in up to the one before end,
+    or including it if end is not the first of a month
+
+    Args:
+        start: a date or datetime
+        end: a date or datetime, exclusive
+
+    Returns:
+        a list of (month_start, next_month_start) datetime tuples in the
+        current timezone
+    """
+    ranges = []
+    start, end = _as_datetime(start), _as_datetime(end)
+    year, month = start.year, start.month
+    while True:
+        month_start, month_end = month_range(year, month)
+        if month_start >= end:
+            return ranges
+        ranges.append((month_start, month_end))
+        year, month = year + month // 12, month % 12 + 1
+
+
+def _active_at(moment):
+    return Q(start__lte=moment) & (Q(ended_at__isnull=True) | Q(ended_at__gt=moment))
+
+
+def _count(q):
+    return Sum(Case(When(q, then=Value(1)), default=Value(0), output_field=IntegerField()))
+
+
+def _amount(q):
+    amount = ExpressionWrapper(F("plan__amount") * F("quantity"), output_field=DecimalField(max_digits=15, decimal_places=2))
+    return Sum(Case(When(q, then=amount), default=Value(0), output_field=DecimalField(max_digits=15, decimal_places=2)))
+
+
+def _subscriptions():
+    return Subscription.objects.exclude(status="trialing")
+
+
+def _mrr_totals(aggregates):
+    """
+    Runs the _amount aggregates grouped by plan interval and currency
+
+    Returns:
+        a dict of monthly amounts keyed by currency for each aggregate
+    """
+    rows = _subscriptions().values(
+        "plan__currency", "plan__interval", "plan__interval_count"
+    ).order_by().annotate(**aggregates)
+    totals = dict((name, {}) for name in aggregates)
+    for row in rows:
+        months_per_interval = MONTHS_PER_INTERVAL.get(row["plan__interval"], 1) * (row["plan__interval_count"] or 1)
+        for name in aggregates:
+            by_currency = totals[name]
+            amount = decimal.Decimal(str(row[name] or 0)) / months_per_interval
+            by_currency[row["plan__currency"]] = by_currency.get(row["plan__currency"], 0) + amount
+    for by_currency in totals.values():
+        for currency in by_currency:
+            by_currency[currency] = by_currency[currency].quantize(CENTS)
+    return totals
+
+
+def _rate(numerator, denominator):
+    if not denominator:
+        return None
+    return decimal.Decimal(str(numerator)) / decimal.Decimal(str(denominator))
+
+
+def churn(start, end):
+    """
+    Yields the churn of each month: the subscriptions that ended in the month
+    relative to the ones active at its start
+
+    Args:
+        start: a date or datetime in the first month
+        end: a date or datetime after the last month
+
+    Yields:
+        dicts with the month (the datetime it starts at), the active and
+        canceled counts and the churn rate, None if none were active
+    """
+    ranges = months(start, end)
+    aggregates = {}
+    for i, (month_start, month_end) in enumerate(ranges):
+        aggregates["active_{0}".format(i)] = _count(_active_at(month_start))
+        aggregates["canceled_{0}".format(i)] = _count(_active_at(month_start) & Q(ended_at__lte=month_end))
+    counts = _subscriptions().aggregate(**aggregates) if ranges else {}
+    for i, (month_start, month_end) in enumerate(ranges):
+        active = counts["active_{0}".format(i)] or 0
+        canceled = counts["canceled_{0}".format(i)] or 0
+        yield dict(month=month_start, active=active, canceled=canceled, churn=_rate(canceled, active))
+
+
+def mrr(start, end):
+    """
+    Yields the monthly recurring revenue at the end of each month, with the
+    amounts of yearly, weekly and daily plans converted to a month
+
+    Args:
+        start: a date or datetime in the first month
+        end: a date or datetime after the last month
+
+    Yields:
+        dicts with the month and the mrr, a dict of amounts keyed by currency
+    """
+    ranges = months(start, end)
+    totals = _mrr_totals(dict(
+        ("mrr_{0}".format(i), _amount(_active_at(month_end)))
+        for i, (month_start, month_end) in enumerate(ranges)
+    )) if ranges else {}
+    for i, (month_start, month_end) in enumerate(ranges):
+        yield dict(month=month_start, mrr=totals["mrr_{0}".format(i)])
+
+
+def net_revenue_retention(start, end):
+    """
+    Yields the net revenue retention of each month: the recurring revenue at
+    the end of the month from the subscriptions active at its start, relative
+    to their recurring revenue at its start
+
+    Args:
+        start: a date or datetime in the first month
+        end: a date or datetime after the last month
+
+    Yields:
+        dicts with the month and the starting and retained mrr and the
+        retention rate, each a dict keyed by currency. A rate is None if
+        there was no revenue at the start of the month.
+    """
+    ranges = months(start, end)
+    aggregates = {}
+    for i, (month_start, month_end) in enumerate(ranges):
+        aggregates["starting_{0}".format(i)] = _amount(_active_at(month_start))
+        aggregates["retained_{0}".format(i)] = _amount(_active_at(month_start) & _active_at(month_end))
+    totals = _mrr_totals(aggregates) if ranges else {}
+    for i, (month_start, month_end) in enumerate(ranges):
+        starting = totals["starting_{0}".format(i)]
+        retained = totals["retained_{0}".format(i)]
+        yield dict(
+            month=month_start,
+            starting=starting,
+            retained=retained,
+            rate=dict((currency, _rate(retained.get(currency, 0), amount)) for currency, amount in starting.items())
+        )
+
+
+def cohorts(start, end):
+    """
+    Yields the subscriptions started in each month, and how many of them were
+    still active at the start of each month after it
+
+    Args:
+        start: a date or datetime in the first month
+        end: a date or datetime after the last month
+
+    Yields:
+        dicts with the month, the size of the cohort and retained, a list of
+        the number still active at the start of each following month up to
+        and including the one after the last month
+    """
+    ranges = months(start, end)
+    aggregates = {}
+    for i, (cohort_start, cohort_end) in enumerate(ranges):
+        started = Q(start__gte=cohort_start, start__lt=cohort_end)
+        aggregates["size_{0}".format(i)] = _count(started)
+        for j, (month_start, month_end) in enumerate(ranges[i:]):
+            aggregates["retained_{0}_{1}".format(i, j)] = _count(
+                started & (Q(ended_at__isnull=True) | Q(ended_at__gt=month_end))
+            )
+    counts = _subscriptions().aggregate(**aggregates) if ranges else {}
+    for i, (cohort_start, cohort_end) in enumerate(ranges):
+        yield dict(
+            month=cohort_start,
+            size=counts["size_{0}".format(i)] or 0,
+            retained=[counts["retained_{0}_{1}".format(i, j)] or 0 for j in range(len(ranges) - i)]
+        )
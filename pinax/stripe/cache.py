@@ -0,0 +1,256 @@
+import collections
+import contextlib
+import threading
+
+from django.core.cache import caches
+from django.db import transaction
+from django.db.models.signals import post_save
+from django.dispatch import receiver
+
+from .conf import settings
+
+
+_local = threading.local()
+
+# Stripe objects that are embedded in another one, e.g. a customer object
+# lists the customer's subscriptions and sources, so a change to them
+# makes the cached parent stale as well
+PARENTS = {
+    "bitcoinreceiver": "customer",
+    "card": "customer",
+    "subscription": "customer",
+}
+
+# How many customers a unit of work remembers by Stripe ID
+CUSTOMER_CACHE_SIZE = 1000
+
+# Primary keys by Stripe ID for objects that are looked up far more often
+# than they change, shared by every thread in the process
+_pks = {}
+_pks_lock = threading.Lock()
+
+# How many recently received events the in-memory duplicate check remembers
+EVENT_CACHE_SIZE = 10000
+
+_events = collections.OrderedDict()
+_events_lock = threading.Lock()
+
+
+def _store():
+    return getattr(_local, "store", None)
+
+
+@contextlib.contextmanager
+def unit_of_work():
+    """
+    Caches the Stripe objects retrieved through the model properties, such as
+    Customer.stripe_customer, until the block exits so that they are only
+    retrieved once. Nested units of work share the outermost cache.
+
+    Outside of a unit of work every access retrieves the object again.
+    """
+    if _store() is not None:
+        yield
+        return
+    _local.store = {}
+    _local.customers = collections.OrderedDict()
+    try:
+        yield
+    finally:
+        _local.store = None
+        _local.customers = None
+
+
+def retrieve(obj, fetch):
+    """
+    Returns the Stripe object for a local object, fetching it only if it is
+    not cached in the current unit of work
+
+    Args:
+        obj: the local model instance the Stripe object belongs to
+        fetch: a callable retrieving the object from the Stripe API
+
+    Returns:
+        the Stripe object
+    """
+    store = _store()
+    if store is None or obj.pk is None:
+        return fetch()
+    key = (obj._meta.model_name, obj.pk)
+    if key not in store:
+        store[key] = fetch()
+    return store[key]
+
+
+def invalidate(obj):
+    """
+    Drops the cached Stripe object for a local object, and for the object it
+    is embedded in, if there is one
+
+    Args:
+        obj: the local model instance that was saved or deleted
+    """
+    model_name = obj._meta.model_name
+    if model_name == "customer" and getattr(_local, "customers", None):
+        _local.customers.pop(obj.stripe_id, None)
+    store = _store()
+    if not store:
+        return
+    store.pop((model_name, obj.pk), None)
+    parent = PARENTS.get(model_name)
+    if parent is not None:
+        store.pop((parent, getattr(obj, "{0}_id".format(parent))), None)
+
+
+def customer(stripe_id):
+    """
+    Returns the customer with the given Stripe ID, remembering the most
+    recently used ones in the current unit of work so that syncing many
+    objects belonging to the same customers does not look them up each time
+
+    Args:
+        stripe_id: the Stripe ID of the customer
+
+    Returns:
+        a pinax.stripe.models.Customer object
+
+    Raises:
+        Customer.DoesNotExist if there is no such customer
+    """
+    from .models import Customer  # if put globally there is a circular import
+    customers = getattr(_local, "customers", None)
+    if customers is None:
+        return Customer.objects.get(stripe_id=stripe_id)
+    obj = customers.pop(stripe_id, None)
+    if obj is None:
+        obj = Customer.objects.get(stripe_id=stripe_id)
+    customers[stripe_id] = obj
+    if len(customers) > CUSTOMER_CACHE_SIZE:
+        customers.popitem(last=False)
+    return obj
+
+
+def pks(model, stripe_ids):
+    """
+    Returns the primary keys of the objects with the given Stripe IDs, only
+    querying for the ones not already known to this process. Meant for
+    objects such as plans whose rows are never replaced.
+
+    Args:
+        model: the model class, e.g. pinax.stripe.models.Plan
+        stripe_ids: the Stripe IDs to look up
+
+    Returns:
+        a dict of primary keys keyed by Stripe ID, leaving out the Stripe IDs
+        that do not exist locally
+    """
+    known = _pks.get(model._meta.model_name, {})
+    found = {stripe_id: known[stripe_id] for stripe_id in stripe_ids if stripe_id in known}
+    missing = set(stripe_ids) - set(found)
+    if missing:
+        fetched = dict(model.objects.filter(stripe_id__in=missing).values_list("stripe_id", "pk"))
+        with _pks_lock:
+            _pks.setdefault(model._meta.model_name, {}).update(fetched)
+        found.update(fetched)
+    return found
+
+
+def clear_pks(model):
+    """
+    Forgets the primary keys looked up for a model, e.g. after its objects
+    were synced
+
+    Args:
+        model: the model class, e.g. pinax.stripe.models.Plan
+    """
+    with _pks_lock:
+        _pks.pop(model._meta.model_name, None)
+
+
+def _event_key(stripe_id):
+    return "pinax-stripe-event:{0}".format(stripe_id)
+
+
+def event_received(stripe_id):
+    """
+    Returns whether an event was received recently, so that duplicate
+    deliveries can be turned away without a query. Nothing is recorded, see
+    remember_event.
+
+    Where received events are remembered is set by
+    PINAX_STRIPE_WEBHOOK_DEDUPE_CACHE: "memory" for the most recent ones in
+    this process, or the alias of a Django cache, which every process shares.
+    When it is None nothing is remembered.
+
+    Args:
+        stripe_id: the Stripe ID of the event
+
+    Returns:
+        True if the event was received recently, otherwise False
+    """
+    alias = settings.PINAX_STRIPE_WEBHOOK_DEDUPE_CACHE
+    if alias is None:
+        return False
+    if alias != "memory":
+        return caches[alias].get(_event_key(stripe_id)) is not None
+    with _events_lock:
+        if stripe_id not in _events:
+            return False
+        # Most recently used last
+        _events[stripe_id] = _events.pop(stripe_id)
+    return True
+
+
+def _remember_event(stripe_id):
+    alias = settings.PINAX_STRIPE_WEBHOOK_DEDUPE_CACHE
+    if alias is None:
+        return
+    if alias != "memory":
+        caches[alias].set(_event_key(stripe_id), True, settings.PINAX_STRIPE_WEBHOOK_DEDUPE_TIMEOUT)
+        return
+    with _events_lock:
+        _events.pop(stripe_id, None)
+        _events[stripe_id] = True
+        if len(_events) > EVENT_CACHE_SIZE:
+            _events.popitem(last=False)
+
+
+def remember_event(stripe_id):
+    """
+    Records that an event was received once the current transaction commits,
+    so that a duplicate is only turned away once the event is stored for good
+
+    Args:
+        stripe_id: the Stripe ID of the event
+    """
+    on_commit = getattr(transaction, "on_commit", None)
+    if on_commit is not None:
+        on_commit(lambda: _remember_event(stripe_id))
+    else:
+        _remember_event(stripe_id)
+
+
+def forget_event(stripe_id):
+    """
+    Forgets that an event was received, so that Stripe can deliver it again
+
+    Args:
+        stripe_id: the Stripe ID of the event
+    """
+    alias = settings.PINAX_STRIPE_WEBHOOK_DEDUPE_CACHE
+    if alias is None:
+        return
+    if alias != "memory":
+        caches[alias].delete(_event_key(stripe_id))
+        return
+    with _events_lock:
+        _events.pop(stripe_id, None)
+
+
+# Not connected to post_delete, as any listener disables fast deletes
+@receiver(post_save)
+def invalidate_on_save(sender, instance, **kwargs):
+    if sender._meta.app_label == "pinax_stripe":
+        invalidate(instance)
+        if sender._meta.model_name in _pks:
+            clear_pks(sender)
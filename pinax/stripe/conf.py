@@ -28,16 +28,32 @@ def load_path_attr(path):
 
 class PinaxStripeAppConf(AppConf):
 
+    ADMIN_PAYLOAD_SEARCH = False
     PUBLIC_KEY = None
     SECRET_KEY = None
     API_VERSION = "2015-10-16"
     INVOICE_FROM_EMAIL = "billing@example.com"
     DEFAULT_PLAN = None
+    EVENT_COMPACT_STORAGE = False
+    EVENT_JSONB = False
     HOOKSET = "pinax.stripe.hooks.DefaultHookSet"
+    ROLLUPS = False
     SEND_EMAIL_RECEIPTS = True
+    SUBSCRIPTION_CACHE_TIMEOUT = None
+    SUBSCRIPTION_WEBHOOK_FULL_CUSTOMER_SYNC = False
     SUBSCRIPTION_REQUIRED_EXCEPTION_URLS = []
     SUBSCRIPTION_REQUIRED_REDIRECT = None
     SUBSCRIPTION_TAX_PERCENT = None
+    WEBHOOK_DEDUPE_CACHE = None
+    # Stripe retries a webhook for up to three days
+    WEBHOOK_DEDUPE_TIMEOUT = 60 * 60 * 24 * 3
+    WEBHOOK_QUEUE = "pinax.stripe.queues.InlineEventQueue"
+    WEBHOOK_QUEUE_WORKERS = 4
+    WEBHOOK_SECRET = None
+    WEBHOOK_TOLERANCE = 300
+    WEBHOOK_TRUST_PAYLOAD = False
+    WEBHOOK_TRUST_PAYLOAD_MAX_AGE = 60
+    WEBHOOK_VALIDATION = "retrieve"
 
     class Meta:
         prefix = "pinax_stripe"
@@ -53,3 +69,6 @@ class PinaxStripeAppConf(AppConf):
 
     def configure_hookset(self, value):
         return load_path_attr(value)()
+
+    def configure_webhook_queue(self, value):
+        return load_path_attr(value)()
@@ -0,0 +1,21 @@
+from __future__ import unicode_literals
+
+from jsonfield.fields import JSONField as BaseJSONField
+
+from .conf import settings
+
+
+class JSONField(BaseJSONField):
+    """
+    A jsonfield.fields.JSONField stored as jsonb on PostgreSQL when
+    PINAX_STRIPE_EVENT_JSONB is on
+
+    jsonb drops the whitespace and duplicate keys of the text it was given and
+    can be queried and indexed with the PostgreSQL JSON operators. Other
+    backends, and PostgreSQL with the setting off, keep a text column.
+    """
+
+    def db_type(self, connection):
+        if connection.vendor == "postgresql" and settings.PINAX_STRIPE_EVENT_JSONB:
+            return "jsonb"
+        return super(JSONField, self).db_type(connection)
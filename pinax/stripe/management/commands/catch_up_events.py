@@ -0,0 +1,25 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from ...actions import events
+from ...utils import parse_since
+
+
+class Command(BaseCommand):
+
+    help = "Replay events that were missed since the last run"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--since",
+            help="List events created since this date, time or Unix timestamp instead of since the last run"
+        )
+
+    def handle(self, *args, **options):
+        since = None
+        if options.get("since"):
+            try:
+                since = parse_since(options["since"])
+            except ValueError as e:
+                raise CommandError(str(e))
+        added = events.catch_up(since=since)
+        print(u"Added {0} missed events".format(len(added)))
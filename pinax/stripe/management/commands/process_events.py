@@ -0,0 +1,58 @@
+import multiprocessing
+import threading
+
+from django.core.management.base import BaseCommand
+from django.db import connections
+
+from ...actions import events
+
+
+def drain(counter):
+    attempted = []
+    try:
+        while True:
+            event = events.process_next_pending_event(exclude=attempted)
+            if event is None:
+                break
+            attempted.append(event.pk)
+            with counter.get_lock():
+                counter.value += 1
+    finally:
+        connections.close_all()
+
+
+class Command(BaseCommand):
+
+    help = "Process received events that have not been processed yet"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--workers",
+            type=int,
+            default=1,
+            help="Number of workers processing events at the same time"
+        )
+        parser.add_argument(
+            "--processes",
+            action="store_true",
+            default=False,
+            help="Run the workers as processes instead of threads"
+        )
+
+    def handle(self, *args, **options):
+        counter = multiprocessing.Value("i", 0)
+        if options["processes"]:
+            # Forked workers must not share the parent's database connections
+            connections.close_all()
+            worker_class = multiprocessing.Process
+        else:
+            worker_class = threading.Thread
+        workers = [
+            worker_class(target=drain, args=(counter,))
+            for _ in range(max(options["workers"], 1))
+        ]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        print("Processed {0} events".format(counter.value))
@@ -0,0 +1,84 @@
+import datetime
+import gzip
+import os
+
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+
+from ...actions import events
+
+
+def parse_kind_days(value):
+    kind, sep, days = value.rpartition("=")
+    if not sep or not kind:
+        raise CommandError("Expected --kind KIND=DAYS, got: {0}".format(value))
+    try:
+        return kind, int(days)
+    except ValueError:
+        raise CommandError("Expected --kind KIND=DAYS, got: {0}".format(value))
+
+
+class Command(BaseCommand):
+
+    help = "Delete processed events and event processing exceptions older than a retention period"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--days",
+            type=int,
+            help="Delete events and exceptions older than this many days"
+        )
+        parser.add_argument(
+            "--kind",
+            action="append",
+            default=[],
+            help="Delete events of a kind older than a number of days instead, as KIND=DAYS, can be repeated"
+        )
+        parser.add_argument(
+            "--batch-size",
+            type=int,
+            default=1000,
+            help="Number of rows to delete per transaction"
+        )
+        parser.add_argument(
+            "--archive",
+            help="Directory to write the deleted rows to first, as gzipped newline-delimited JSON"
+        )
+
+    def handle(self, *args, **options):
+        policies = dict(parse_kind_days(value) for value in options["kind"])
+        days = options.get("days")
+        if days is None and not policies:
+            raise CommandError("Provide --days and/or --kind")
+        now = timezone.now()
+        archive = None
+        if options.get("archive"):
+            path = os.path.join(
+                options["archive"],
+                "pinax-stripe-events-{0}.ndjson.gz".format(now.strftime("%Y%m%dT%H%M%S"))
+            )
+            archive = gzip.open(path, "wb")
+        try:
+            batch_size = max(options["batch_size"], 1)
+            count = 0
+            for kind, kind_days in sorted(policies.items()):
+                count += events.prune_events(
+                    now - datetime.timedelta(days=kind_days),
+                    kinds=[kind],
+                    batch_size=batch_size,
+                    archive=archive
+                )
+            exceptions = 0
+            if days is not None:
+                before = now - datetime.timedelta(days=days)
+                count += events.prune_events(
+                    before,
+                    exclude_kinds=list(policies),
+                    batch_size=batch_size,
+                    archive=archive
+                )
+                exceptions = events.prune_event_exceptions(before, batch_size=batch_size, archive=archive)
+        finally:
+            if archive is not None:
+                archive.close()
+        print(u"Deleted {0} events and {1} other event processing exceptions".format(count, exceptions))
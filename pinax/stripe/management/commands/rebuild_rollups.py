@@ -0,0 +1,14 @@
+from django.core.management.base import BaseCommand
+
+from ...actions import rollups
+
+
+class Command(BaseCommand):
+
+    help = "Compute the daily charge totals and subscription counts again"
+
+    def handle(self, *args, **options):
+        charge_totals, subscription_counts = rollups.rebuild()
+        print(u"Rebuilt {0} daily charge totals and {1} daily subscription counts".format(
+            charge_totals, subscription_counts
+        ))
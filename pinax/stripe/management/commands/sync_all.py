@@ -0,0 +1,39 @@
+from django.core.management.base import BaseCommand
+
+import stripe
+
+from ... import cache
+from ...actions import charges, customers, invoices, plans, subscriptions
+from ...utils import iter_pages
+
+
+class Command(BaseCommand):
+
+    help = "Sync all customer data using account-wide list calls"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--limit",
+            type=int,
+            default=100,
+            help="Number of objects to request per page"
+        )
+
+    def sync(self, name, resource, action, limit, **params):
+        count = 0
+        for page in iter_pages(resource, limit=limit, **params):
+            action(page)
+            count += len(page)
+            print(u"Synced {0} {1}".format(count, name))
+
+    def handle(self, *args, **options):
+        limit = options.get("limit") or 100
+        # Plans first as subscriptions refer to them, and charges and
+        # subscriptions before invoices so the few not expanded in the
+        # invoice list are found locally
+        plans.sync_plans()
+        with cache.unit_of_work():
+            self.sync("customers", stripe.Customer, customers.sync_customers_from_stripe_data, limit)
+            self.sync("subscriptions", stripe.Subscription, subscriptions.sync_account_subscriptions_from_stripe_data, limit, status="all")
+            self.sync("charges", stripe.Charge, charges.sync_charges_from_stripe_data, limit)
+            self.sync("invoices", stripe.Invoice, invoices.sync_invoices_from_stripe_data, limit, expand=invoices.INVOICE_EXPAND)
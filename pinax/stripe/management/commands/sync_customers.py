@@ -1,35 +1,144 @@
-from django.core.management.base import BaseCommand
+import functools
+from multiprocessing.pool import ThreadPool
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.db.models import Q
+from django.utils import timezone
 
 from django.contrib.auth import get_user_model
 
+import stripe
 from stripe.error import InvalidRequestError
 
+from ... import cache
 from ...actions import customers, charges, invoices
+from ...models import Checkpoint
+from ...utils import RateLimitedHttpClient, RateLimiter, parse_since
 
 
-class Command(BaseCommand):
+CHECKPOINT = "sync_customers"
 
-    help = "Sync customer data"
 
-    def handle(self, *args, **options):
-        User = get_user_model()
-        qs = User.objects.exclude(customer__isnull=True)
-        count = 0
-        total = qs.count()
-        for user in qs:
-            count += 1
-            perc = int(round(100 * (float(count) / float(total))))
-            username = getattr(user, user.USERNAME_FIELD)
-            print(u"[{0}/{1} {2}%] Syncing {3} [{4}]".format(
-                count, total, perc, username, user.pk
-            ))
-            customer = customers.get_customer_for_user(user)
+# How many users are loaded and handed to the workers at a time
+CHUNK_SIZE = 1000
+
+
+def sync_user(user, close_connection=False):
+    customer = user.customer
+    try:
+        with cache.unit_of_work():
             try:
                 customers.sync_customer(customer)
             except InvalidRequestError as e:
                 if e.http_status == 404:
                     # This user doesn't exist (might be in test mode)
-                    continue
-
+                    return user
             invoices.sync_invoices_for_customer(customer)
             charges.sync_charges_for_customer(customer)
+        return user
+    finally:
+        if close_connection:
+            # Each worker thread opens a connection of its own, which
+            # nothing else would close
+            connection.close()
+
+
+def iter_chunks(qs, size):
+    """
+    Yields the objects of a queryset ordered by primary key a list of at most
+    size at a time, going by primary key rather than by offset
+    """
+    last_pk = None
+    while True:
+        chunk = list((qs if last_pk is None else qs.filter(pk__gt=last_pk))[:size])
+        if not chunk:
+            return
+        yield chunk
+        last_pk = chunk[-1].pk
+
+
+class Command(BaseCommand):
+
+    help = "Sync customer data"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--workers",
+            type=int,
+            default=1,
+            help="Number of customers to sync at the same time"
+        )
+        parser.add_argument(
+            "--rate",
+            type=float,
+            default=25,
+            help="Maximum number of Stripe API requests per second across all workers"
+        )
+        parser.add_argument(
+            "--resume",
+            action="store_true",
+            default=False,
+            help="Continue from where the last run stopped"
+        )
+        parser.add_argument(
+            "--since",
+            help="Only sync customers created or with events received since this date, time or Unix timestamp"
+        )
+
+    def get_queryset(self, options):
+        User = get_user_model()
+        qs = User.objects.exclude(customer__isnull=True)
+        if options.get("since"):
+            try:
+                since = parse_since(options["since"])
+            except ValueError as e:
+                raise CommandError(str(e))
+            qs = qs.filter(
+                Q(customer__created_at__gte=since) | Q(customer__event__created_at__gte=since)
+            ).distinct()
+        if options.get("resume"):
+            checkpoint = Checkpoint.objects.filter(name=CHECKPOINT).first()
+            if checkpoint is not None and checkpoint.value:
+                qs = qs.filter(pk__gt=int(checkpoint.value))
+        return qs.select_related("customer").order_by("pk")
+
+    def save_checkpoint(self, user):
+        Checkpoint.objects.update_or_create(
+            name=CHECKPOINT,
+            defaults={"value": str(user.pk), "updated_at": timezone.now()}
+        )
+
+    def handle(self, *args, **options):
+        users = self.get_queryset(options)
+        count = 0
+        total = users.count()
+        workers = max(options.get("workers") or 1, 1)
+        http_client = stripe.default_http_client
+        if options.get("rate"):
+            stripe.default_http_client = RateLimitedHttpClient(
+                http_client or stripe.http_client.new_default_http_client(),
+                RateLimiter(options["rate"])
+            )
+        pool = ThreadPool(workers) if workers > 1 else None
+        try:
+            for chunk in iter_chunks(users, CHUNK_SIZE):
+                # Results come back in order, so every user before the one
+                # just returned has been synced and it is safe to checkpoint it
+                if pool is not None:
+                    results = pool.imap(functools.partial(sync_user, close_connection=True), chunk)
+                else:
+                    results = (sync_user(user) for user in chunk)
+                for user in results:
+                    count += 1
+                    perc = int(round(100 * (float(count) / float(total))))
+                    username = getattr(user, user.USERNAME_FIELD)
+                    print(u"[{0}/{1} {2}%] Syncing {3} [{4}]".format(
+                        count, total, perc, username, user.pk
+                    ))
+                    self.save_checkpoint(user)
+            Checkpoint.objects.filter(name=CHECKPOINT).delete()
+        finally:
+            if pool is not None:
+                pool.terminate()
+            stripe.default_http_client = http_client
@@ -1,16 +1,50 @@
+import datetime
 import decimal
 
 from django.db import models
+from django.utils import timezone
+
+try:
+    from django.db.models import Case, When
+except ImportError:  # Django < 1.8
+    Case = When = None
+
+from .conf import settings
+from .utils import during_filter
+
+
+def _rollup_dates(year, month, start, end):
+    """
+    Returns the half-open range of dates to read from the rollups for a
+    month, or None if the rollups are off or cannot answer the query
+    """
+    if not settings.PINAX_STRIPE_ROLLUPS or year is None or month is None or start is not None or end is not None:
+        return None
+    # The rollups are by day in the default timezone
+    if timezone.get_current_timezone_name() != timezone.get_default_timezone_name():
+        return None
+    return datetime.date(year, month, 1), datetime.date(year + month // 12, month % 12 + 1, 1)
+
+
+def _plan_summary(dates, field):
+    from .models import DailySubscriptionCount  # if put globally there is a circular import
+    counts = DailySubscriptionCount.objects.filter(
+        date__gte=dates[0],
+        date__lt=dates[1],
+        **{"{0}__gt".format(field): 0}
+    ).values("plan").order_by().annotate(
+        count=models.Sum(field)
+    )
+    return [{"subscription__plan": row["plan"], "count": row["count"]} for row in counts]
 
 
 class CustomerManager(models.Manager):
 
-    def started_during(self, year, month):
+    def started_during(self, year=None, month=None, start=None, end=None):
         return self.exclude(
             subscription__status="trialing"
         ).filter(
-            subscription__start__year=year,
-            subscription__start__month=month
+            **during_filter("subscription__start", year, month, start, end)
         )
 
     def active(self):
@@ -23,14 +57,18 @@ class CustomerManager(models.Manager):
             subscription__status="canceled"
         )
 
-    def canceled_during(self, year, month):
-        return self.canceled().filter(
-            subscription__canceled_at__year=year,
-            subscription__canceled_at__month=month,
+    def canceled_during(self, year=None, month=None, start=None, end=None):
+        # A single filter() so both conditions apply to the same subscription
+        return self.filter(
+            subscription__status="canceled",
+            **during_filter("subscription__canceled_at", year, month, start, end)
         )
 
-    def started_plan_summary_for(self, year, month):
-        return self.started_during(year, month).values(
+    def started_plan_summary_for(self, year=None, month=None, start=None, end=None):
+        dates = _rollup_dates(year, month, start, end)
+        if dates is not None:
+            return _plan_summary(dates, "new")
+        return self.started_during(year, month, start, end).values(
             "subscription__plan"
         ).order_by().annotate(
             count=models.Count("subscription__plan")
@@ -43,29 +81,56 @@ class CustomerManager(models.Manager):
             count=models.Count("subscription__plan")
         )
 
-    def canceled_plan_summary_for(self, year, month):
-        return self.canceled_during(year, month).values(
+    def canceled_plan_summary_for(self, year=None, month=None, start=None, end=None):
+        dates = _rollup_dates(year, month, start, end)
+        if dates is not None:
+            return _plan_summary(dates, "canceled")
+        return self.canceled_during(year, month, start, end).values(
             "subscription__plan"
         ).order_by().annotate(
             count=models.Count("subscription__plan")
         )
 
     def churn(self):
-        canceled = self.canceled().count()
-        active = self.active().count()
-        return decimal.Decimal(str(canceled)) / decimal.Decimal(str(active))
+        """
+        Returns the number of canceled subscriptions relative to active ones,
+        or 0 if there are no active subscriptions
+        """
+        if Case is None:
+            counts = dict(canceled=self.canceled().count(), active=self.active().count())
+        else:
+            counts = self.aggregate(**{
+                status: models.Sum(Case(
+                    When(subscription__status=status, then=models.Value(1)),
+                    default=models.Value(0),
+                    output_field=models.IntegerField()
+                ))
+                for status in ("canceled", "active")
+            })
+        if not counts["active"]:
+            return decimal.Decimal("0")
+        return decimal.Decimal(str(counts["canceled"])) / decimal.Decimal(str(counts["active"]))
 
 
 class ChargeManager(models.Manager):
 
-    def during(self, year, month):
+    def during(self, year=None, month=None, start=None, end=None):
         return self.filter(
-            charge_created__year=year,
-            charge_created__month=month
+            **during_filter("charge_created", year, month, start, end)
         )
 
-    def paid_totals_for(self, year, month):
-        return self.during(year, month).filter(
+    def paid_totals_for(self, year=None, month=None, start=None, end=None):
+        dates = _rollup_dates(year, month, start, end)
+        if dates is not None:
+            from .models import DailyChargeTotal  # if put globally there is a circular import
+            return DailyChargeTotal.objects.filter(
+                date__gte=dates[0],
+                date__lt=dates[1]
+            ).aggregate(
+                total_amount=models.Sum("gross"),
+                total_refunded=models.Sum("refunded")
+            )
+        return self.during(year, month, start, end).filter(
             paid=True
         ).aggregate(
             total_amount=models.Sum("amount"),
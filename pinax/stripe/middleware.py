@@ -6,7 +6,7 @@ try:
 except ImportError:
     from django.core.urlresolvers import resolve
 
-from .actions import customers, subscriptions
+from .actions import subscriptions
 from .conf import settings
 
 
@@ -20,8 +20,7 @@ class ActiveSubscriptionMiddleware(object):
         if is_authenticated and not request.user.is_staff:
             url_name = resolve(request.path).url_name
             if url_name not in settings.PINAX_STRIPE_SUBSCRIPTION_REQUIRED_EXCEPTION_URLS:
-                customer = customers.get_customer_for_user(request.user)
-                if not subscriptions.has_active_subscription(customer):
+                if not subscriptions.user_has_active_subscription(request.user):
                     return redirect(
                         settings.PINAX_STRIPE_SUBSCRIPTION_REQUIRED_REDIRECT
                     )
@@ -0,0 +1,36 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.29 on 2026-10-18 05:47
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('pinax_stripe', '0007_checkpoint'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='customer',
+            name='active_subscription_count',
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+        migrations.AddField(
+            model_name='customer',
+            name='current_period_end_max',
+            field=models.DateTimeField(editable=False, null=True),
+        ),
+        migrations.AddField(
+            model_name='customer',
+            name='primary_plan',
+            field=models.ForeignKey(editable=False, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to='pinax_stripe.Plan'),
+        ),
+        migrations.AddField(
+            model_name='customer',
+            name='subscription_ended_at_max',
+            field=models.DateTimeField(editable=False, null=True),
+        ),
+    ]
@@ -0,0 +1,46 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.29 on 2026-10-18 05:58
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('pinax_stripe', '0008_customer_subscription_summary'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='charge',
+            name='charge_created',
+            field=models.DateTimeField(blank=True, db_index=True, null=True),
+        ),
+        migrations.AlterField(
+            model_name='subscription',
+            name='start',
+            field=models.DateTimeField(db_index=True),
+        ),
+        migrations.AlterField(
+            model_name='transfer',
+            name='date',
+            field=models.DateTimeField(db_index=True),
+        ),
+        migrations.AlterIndexTogether(
+            name='charge',
+            index_together=set([('paid', 'charge_created')]),
+        ),
+        migrations.AlterIndexTogether(
+            name='event',
+            index_together=set([('processed', 'created_at')]),
+        ),
+        migrations.AlterIndexTogether(
+            name='invoiceitem',
+            index_together=set([('invoice', 'stripe_id')]),
+        ),
+        migrations.AlterIndexTogether(
+            name='subscription',
+            index_together=set([('status', 'customer'), ('customer', 'status'), ('customer', 'ended_at'), ('status', 'canceled_at')]),
+        ),
+    ]
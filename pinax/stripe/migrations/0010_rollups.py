@@ -0,0 +1,45 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.29 on 2026-10-18 06:01
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('pinax_stripe', '0009_query_indexes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DailyChargeTotal',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('date', models.DateField()),
+                ('currency', models.CharField(max_length=10)),
+                ('count', models.PositiveIntegerField(default=0)),
+                ('gross', models.DecimalField(decimal_places=2, default=0, max_digits=15)),
+                ('refunded', models.DecimalField(decimal_places=2, default=0, max_digits=15)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='DailySubscriptionCount',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('date', models.DateField()),
+                ('new', models.PositiveIntegerField(default=0)),
+                ('canceled', models.PositiveIntegerField(default=0)),
+                ('plan', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='pinax_stripe.Plan')),
+            ],
+        ),
+        migrations.AlterUniqueTogether(
+            name='dailychargetotal',
+            unique_together=set([('date', 'currency')]),
+        ),
+        migrations.AlterUniqueTogether(
+            name='dailysubscriptioncount',
+            unique_together=set([('date', 'plan')]),
+        ),
+    ]
@@ -0,0 +1,28 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.29 on 2026-10-18 06:08
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('pinax_stripe', '0010_rollups'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='event',
+            name='object_id',
+            field=models.CharField(blank=True, db_index=True, max_length=255),
+        ),
+        migrations.AlterIndexTogether(
+            name='event',
+            index_together=set([('processed', 'created_at'), ('created_at', 'id')]),
+        ),
+        migrations.AlterIndexTogether(
+            name='eventprocessingexception',
+            index_together=set([('created_at', 'id')]),
+        ),
+    ]
@@ -0,0 +1,21 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.29 on 2026-10-18 06:12
+from __future__ import unicode_literals
+
+from django.db import migrations
+import pinax.stripe.fields
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('pinax_stripe', '0011_event_object_id'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='event',
+            name='validated_diff',
+            field=pinax.stripe.fields.JSONField(null=True),
+        ),
+    ]
@@ -0,0 +1,38 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, transaction
+
+
+def set_object_ids(apps, schema_editor):
+    Event = apps.get_model("pinax_stripe", "Event")
+    last_pk = 0
+    while True:
+        # Instances rather than values, so the messages are decoded
+        batch = list(Event.objects.filter(pk__gt=last_pk).order_by("pk").only("pk", "webhook_message")[:1000])
+        if not batch:
+            return
+        with transaction.atomic():
+            for event in batch:
+                try:
+                    object_id = event.webhook_message["data"]["object"].get("id") or ""
+                except (AttributeError, KeyError, TypeError):
+                    object_id = ""
+                if object_id:
+                    Event.objects.filter(pk=event.pk).update(object_id=object_id[:255])
+        last_pk = batch[-1].pk
+
+
+class Migration(migrations.Migration):
+
+    # Each batch is committed on its own rather than holding locks on the
+    # events for the whole backfill
+    atomic = False
+
+    dependencies = [
+        ('pinax_stripe', '0012_event_compact_storage'),
+    ]
+
+    operations = [
+        migrations.RunPython(set_object_ids, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,27 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.conf import settings
+from django.db import migrations
+
+from pinax.stripe.utils import compact_events
+
+
+def compact(apps, schema_editor):
+    if getattr(settings, "PINAX_STRIPE_EVENT_COMPACT_STORAGE", False):
+        compact_events(apps.get_model("pinax_stripe", "Event"))
+
+
+class Migration(migrations.Migration):
+
+    # Each batch is committed on its own, rather than within the transaction
+    # that changed the type of the message columns
+    atomic = False
+
+    dependencies = [
+        ('pinax_stripe', '0013_set_event_object_ids'),
+    ]
+
+    operations = [
+        migrations.RunPython(compact, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,52 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, transaction
+
+
+def set_subscription_summaries(apps, schema_editor):
+    Customer = apps.get_model("pinax_stripe", "Customer")
+    Subscription = apps.get_model("pinax_stripe", "Subscription")
+    last_pk = 0
+    while True:
+        # Only customers with subscriptions, the others keep the defaults
+        customer_ids = list(
+            Subscription.objects.filter(customer_id__gt=last_pk).order_by("customer_id").values_list(
+                "customer_id", flat=True
+            ).distinct()[:1000]
+        )
+        if not customer_ids:
+            return
+        rows = {}
+        for row in Subscription.objects.filter(customer_id__in=customer_ids).values_list(
+            "customer_id", "plan_id", "current_period_end", "ended_at"
+        ):
+            rows.setdefault(row[0], []).append(row[1:])
+        with transaction.atomic():
+            for customer_id, subscriptions in rows.items():
+                current = [row for row in subscriptions if row[2] is None]
+                period_ends = [row[1] for row in current if row[1] is not None]
+                ended_ats = [row[2] for row in subscriptions if row[2] is not None]
+                primary = max(current, key=lambda row: (row[1] is not None, row[1] or 0)) if current else None
+                Customer.objects.filter(pk=customer_id).update(
+                    active_subscription_count=len(current),
+                    current_period_end_max=max(period_ends) if period_ends else None,
+                    subscription_ended_at_max=max(ended_ats) if ended_ats else None,
+                    primary_plan_id=primary[0] if primary else None
+                )
+        last_pk = customer_ids[-1]
+
+
+class Migration(migrations.Migration):
+
+    # Each batch is committed on its own rather than holding locks on the
+    # customers for the whole backfill
+    atomic = False
+
+    dependencies = [
+        ('pinax_stripe', '0014_compact_events'),
+    ]
+
+    operations = [
+        migrations.RunPython(set_subscription_summaries, migrations.RunPython.noop),
+    ]
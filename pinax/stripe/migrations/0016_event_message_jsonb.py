@@ -0,0 +1,27 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations
+import pinax.stripe.fields
+
+
+class Migration(migrations.Migration):
+
+    # Only changes the columns with PINAX_STRIPE_EVENT_JSONB on, when on
+    # PostgreSQL it rewrites the event table under an exclusive lock
+    dependencies = [
+        ('pinax_stripe', '0015_set_subscription_summaries'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='event',
+            name='validated_message',
+            field=pinax.stripe.fields.JSONField(null=True),
+        ),
+        migrations.AlterField(
+            model_name='event',
+            name='webhook_message',
+            field=pinax.stripe.fields.JSONField(),
+        ),
+    ]
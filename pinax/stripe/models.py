@@ -3,6 +3,8 @@ from __future__ import unicode_literals
 import decimal
 
 from django.db import models
+from django.db.models.signals import post_save
+from django.dispatch import receiver
 from django.utils import timezone
 from django.utils.encoding import python_2_unicode_compatible
 
@@ -10,9 +12,10 @@ import stripe
 
 from jsonfield.fields import JSONField
 
+from . import cache, fields
 from .conf import settings
 from .managers import ChargeManager, CustomerManager
-from .utils import CURRENCY_SYMBOLS
+from .utils import CURRENCY_SYMBOLS, apply_message_diff, bulk_upserting, message_diff
 
 
 class StripeObject(models.Model):
@@ -63,6 +66,21 @@ class Coupon(StripeObject):
         return "Coupon for {}, {}".format(description, self.duration)
 
 
+@python_2_unicode_compatible
+class Checkpoint(models.Model):
+    """
+    Records how far a long running or incremental sync has got so that it
+    can pick up from there the next time it runs
+    """
+
+    name = models.CharField(max_length=100, unique=True)
+    value = models.TextField(blank=True)
+    updated_at = models.DateTimeField(default=timezone.now)
+
+    def __str__(self):
+        return "{} - {}".format(self.name, self.value)
+
+
 @python_2_unicode_compatible
 class EventProcessingException(models.Model):
 
@@ -72,6 +90,12 @@ class EventProcessingException(models.Model):
     traceback = models.TextField()
     created_at = models.DateTimeField(default=timezone.now)
 
+    class Meta:
+        index_together = [
+            # The admin changelist
+            ("created_at", "id"),
+        ]
+
     def __str__(self):
         return "<{}, pk={}, Event={}>".format(self.message, self.pk, self.event)
 
@@ -82,17 +106,44 @@ class Event(StripeObject):
     kind = models.CharField(max_length=250)
     livemode = models.BooleanField(default=False)
     customer = models.ForeignKey("Customer", null=True, on_delete=models.CASCADE)
-    webhook_message = JSONField()
-    validated_message = JSONField(null=True)
+    webhook_message = fields.JSONField()
+    validated_message = fields.JSONField(null=True)
+    # With PINAX_STRIPE_EVENT_COMPACT_STORAGE the validated message is kept
+    # as its difference from the webhook message instead
+    validated_diff = fields.JSONField(null=True)
     valid = models.NullBooleanField(null=True)
     processed = models.BooleanField(default=False)
     request = models.CharField(max_length=100, blank=True)
     pending_webhooks = models.PositiveIntegerField(default=0)
     api_version = models.CharField(max_length=100, blank=True)
+    # The ID of the object the event is about, for searching in the admin
+    object_id = models.CharField(max_length=255, blank=True, db_index=True)
+
+    class Meta:
+        index_together = [
+            # pending_events
+            ("processed", "created_at"),
+            # The admin changelist
+            ("created_at", "id"),
+        ]
 
     @property
     def message(self):
-        return self.validated_message
+        """
+        The validated message, or None if the event has not been validated
+        """
+        if self.validated_message is not None or self.validated_diff is None:
+            return self.validated_message
+        return apply_message_diff(self.webhook_message or {}, self.validated_diff)
+
+    @message.setter
+    def message(self, value):
+        if settings.PINAX_STRIPE_EVENT_COMPACT_STORAGE:
+            self.validated_message = None
+            self.validated_diff = message_diff(self.webhook_message or {}, value)
+        else:
+            self.validated_message = value
+            self.validated_diff = None
 
     def __str__(self):
         return "{} - {}".format(self.kind, self.stripe_id)
@@ -103,7 +154,7 @@ class Transfer(StripeObject):
     amount = models.DecimalField(decimal_places=2, max_digits=9)
     currency = models.CharField(max_length=25, default="usd")
     status = models.CharField(max_length=25)
-    date = models.DateTimeField()
+    date = models.DateTimeField(db_index=True)
     description = models.TextField(null=True, blank=True)
 
 
@@ -128,11 +179,51 @@ class Customer(StripeObject):
     default_source = models.TextField(blank=True)
     date_purged = models.DateTimeField(null=True, editable=False)
 
+    # Summary of the customer's subscriptions, kept up to date by
+    # update_subscription_summary whenever they are synced or saved
+    active_subscription_count = models.PositiveIntegerField(default=0, editable=False)
+    current_period_end_max = models.DateTimeField(null=True, editable=False)
+    subscription_ended_at_max = models.DateTimeField(null=True, editable=False)
+    primary_plan = models.ForeignKey(
+        "Plan",
+        null=True,
+        editable=False,
+        related_name="+",
+        on_delete=models.SET_NULL
+    )
+
     objects = CustomerManager()
 
     @property
     def stripe_customer(self):
-        return stripe.Customer.retrieve(self.stripe_id)
+        return cache.retrieve(self, lambda: stripe.Customer.retrieve(self.stripe_id))
+
+    def update_subscription_summary(self):
+        """
+        Recomputes the subscription summary columns from the customer's
+        subscriptions
+
+        active_subscription_count counts the subscriptions that have not
+        ended, current_period_end_max is the latest period end among them and
+        primary_plan is the plan of the one with the latest period end.
+        subscription_ended_at_max is the latest ended_at of any subscription,
+        which may lie in the future.
+        """
+        rows = list(self.subscription_set.values_list("plan_id", "current_period_end", "ended_at"))
+        current = [row for row in rows if row[2] is None]
+        period_ends = [row[1] for row in current if row[1] is not None]
+        ended_ats = [row[2] for row in rows if row[2] is not None]
+        primary = max(current, key=lambda row: (row[1] is not None, row[1] or 0)) if current else None
+        summary = dict(
+            active_subscription_count=len(current),
+            current_period_end_max=max(period_ends) if period_ends else None,
+            subscription_ended_at_max=max(ended_ats) if ended_ats else None,
+            primary_plan_id=primary[0] if primary else None
+        )
+        for field, value in summary.items():
+            setattr(self, field, value)
+        # Not a save so neither post_save nor the Stripe object cache is involved
+        Customer.objects.filter(pk=self.pk).update(**summary)
 
     def __str__(self):
         return str(self.user)
@@ -193,14 +284,27 @@ class Subscription(StripeObject):
     ended_at = models.DateTimeField(blank=True, null=True)
     plan = models.ForeignKey(Plan, on_delete=models.CASCADE)
     quantity = models.IntegerField()
-    start = models.DateTimeField()
+    start = models.DateTimeField(db_index=True)
     status = models.CharField(max_length=25)  # trialing, active, past_due, canceled, or unpaid
     trial_end = models.DateTimeField(blank=True, null=True)
     trial_start = models.DateTimeField(blank=True, null=True)
 
+    class Meta:
+        index_together = [
+            # A customer's subscriptions by status, and the subscription summary
+            ("customer", "status"),
+            ("customer", "ended_at"),
+            # CustomerManager.active() and canceled_during()
+            ("status", "customer"),
+            ("status", "canceled_at"),
+        ]
+
     @property
     def stripe_subscription(self):
-        return stripe.Customer.retrieve(self.customer.stripe_id).subscriptions.retrieve(self.stripe_id)
+        return cache.retrieve(
+            self,
+            lambda: self.customer.stripe_customer.subscriptions.retrieve(self.stripe_id)
+        )
 
     @property
     def total_amount(self):
@@ -218,12 +322,24 @@ class Subscription(StripeObject):
         references will not show previous values (such as when an Event
         signal is triggered after a subscription has been deleted)
         """
+        cache.invalidate(self)
         super(Subscription, self).delete(using=using)
+        self.customer.update_subscription_summary()
+        if settings.PINAX_STRIPE_ROLLUPS:
+            from .actions import rollups  # if put globally there is a circular import
+            rollups.apply_subscription_changes([self], [])
         self.status = None
         self.quantity = 0
         self.amount = 0
 
 
+@receiver(post_save, sender=Subscription)
+def update_customer_subscription_summary(sender, instance, **kwargs):
+    # The syncs update the summary once for the whole batch
+    if not bulk_upserting():
+        instance.customer.update_subscription_summary()
+
+
 class Invoice(StripeObject):
 
     customer = models.ForeignKey(Customer, related_name="invoices", on_delete=models.CASCADE)
@@ -251,7 +367,7 @@ class Invoice(StripeObject):
 
     @property
     def stripe_invoice(self):
-        return stripe.Invoice.retrieve(self.stripe_id)
+        return cache.retrieve(self, lambda: stripe.Invoice.retrieve(self.stripe_id))
 
 
 class InvoiceItem(models.Model):
@@ -272,6 +388,12 @@ class InvoiceItem(models.Model):
     plan = models.ForeignKey(Plan, null=True, on_delete=models.CASCADE)
     quantity = models.IntegerField(null=True)
 
+    class Meta:
+        index_together = [
+            # sync_invoice_items
+            ("invoice", "stripe_id"),
+        ]
+
     def plan_display(self):
         return self.plan.name if self.plan else ""
 
@@ -294,10 +416,48 @@ class Charge(StripeObject):
     refunded = models.NullBooleanField(null=True)
     captured = models.NullBooleanField(null=True)
     receipt_sent = models.BooleanField(default=False)
-    charge_created = models.DateTimeField(null=True, blank=True)
+    charge_created = models.DateTimeField(null=True, blank=True, db_index=True)
 
     objects = ChargeManager()
 
+    class Meta:
+        index_together = [
+            # ChargeManager.paid_totals_for()
+            ("paid", "charge_created"),
+        ]
+
     @property
     def stripe_charge(self):
-        return stripe.Charge.retrieve(self.stripe_id)
+        return cache.retrieve(self, lambda: stripe.Charge.retrieve(self.stripe_id))
+
+
+class DailyChargeTotal(models.Model):
+    """
+    The paid charges created on a day, in the default timezone, per currency.
+    Maintained by pinax.stripe.actions.rollups when PINAX_STRIPE_ROLLUPS is on.
+    """
+
+    date = models.DateField()
+    currency = models.CharField(max_length=10)
+    count = models.PositiveIntegerField(default=0)
+    gross = models.DecimalField(decimal_places=2, max_digits=15, default=0)
+    refunded = models.DecimalField(decimal_places=2, max_digits=15, default=0)
+
+    class Meta:
+        unique_together = [("date", "currency")]
+
+
+class DailySubscriptionCount(models.Model):
+    """
+    The subscriptions to a plan that started, other than trials, and that
+    were canceled on a day, in the default timezone. Maintained by
+    pinax.stripe.actions.rollups when PINAX_STRIPE_ROLLUPS is on.
+    """
+
+    date = models.DateField()
+    plan = models.ForeignKey(Plan, related_name="+", on_delete=models.CASCADE)
+    new = models.PositiveIntegerField(default=0)
+    canceled = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        unique_together = [("date", "plan")]
@@ -0,0 +1,87 @@
+import threading
+
+from django.db import connection, transaction
+
+from six.moves import queue
+
+
+class InlineEventQueue(object):
+    """
+    Processes events immediately, in the same thread that received the
+    webhook. This is the default and matches the historical behavior.
+    """
+
+    def enqueue(self, event):
+        from .actions import events  # if put globally there is a circular import
+        events.process_event(event)
+
+
+class DeferredEventQueue(object):
+    """
+    Leaves events in the database for the process_events management command
+    to pick up, which can run on any number of nodes.
+    """
+
+    def enqueue(self, event):
+        return
+
+
+class ThreadPoolEventQueue(object):
+    """
+    Hands events off to a pool of background threads so the webhook view
+    can return as soon as the Event row has been persisted.
+
+    The number of threads is controlled by PINAX_STRIPE_WEBHOOK_QUEUE_WORKERS.
+    """
+
+    def __init__(self, workers=None):
+        self._workers = workers
+        self.queue = queue.Queue()
+        self.threads = []
+        self.lock = threading.Lock()
+
+    @property
+    def workers(self):
+        if self._workers is None:
+            # Read lazily as this is instantiated while settings are configured
+            from .conf import settings
+            return settings.PINAX_STRIPE_WEBHOOK_QUEUE_WORKERS
+        return self._workers
+
+    def start(self):
+        with self.lock:
+            self.threads = [t for t in self.threads if t.is_alive()]
+            for _ in range(self.workers - len(self.threads)):
+                thread = threading.Thread(target=self.work)
+                thread.daemon = True
+                thread.start()
+                self.threads.append(thread)
+
+    def enqueue(self, event):
+        self.start()
+        on_commit = getattr(transaction, "on_commit", None)
+        if on_commit is not None:
+            # The worker reads the event back from the database, so wait
+            # until the row is visible outside of this transaction
+            on_commit(lambda: self.queue.put(event.pk))
+        else:
+            self.queue.put(event.pk)
+
+    def work(self):
+        while True:
+            pk = self.queue.get()
+            try:
+                self.process(pk)
+            finally:
+                self.queue.task_done()
+
+    def process(self, pk):
+        from .actions import events, exceptions
+        try:
+            # Claimed like process_events does, which may be draining the
+            # same pending events
+            events.process_pending_event(pk)
+        except Exception as e:
+            exceptions.log_exception(data="", exception=e)
+        finally:
+            connection.close()
@@ -4,7 +4,9 @@ from unittest import skipIf
 import time
 
 import django
+from django.core.cache import cache
 from django.test import TestCase
+from django.test.utils import override_settings
 from django.utils import timezone
 
 from django.contrib.auth import get_user_model
@@ -13,8 +15,11 @@ import stripe
 
 from mock import patch, Mock
 
-from ..actions import charges, customers, events, invoices, plans, refunds, sources, subscriptions, transfers
-from ..models import BitcoinReceiver, Customer, Charge, Card, Plan, Event, Invoice, Subscription, Transfer
+from ..actions import charges, customers, events, invoices, plans, refunds, rollups, sources, subscriptions, transfers
+from ..models import (
+    BitcoinReceiver, Checkpoint, Customer, Charge, Card, DailyChargeTotal, DailySubscriptionCount, Plan, Event, Invoice,
+    Subscription, Transfer
+)
 
 
 class ChargesTests(TestCase):
@@ -282,6 +287,114 @@ class EventsTests(TestCase):
         self.assertEquals(event.kind, "account.updated")
         self.assertTrue(ProcessMock.called)
 
+    @patch("pinax.stripe.queues.InlineEventQueue.enqueue")
+    def test_add_event_enqueues(self, EnqueueMock):
+        event = events.add_event(stripe_id="evt_004", kind="account.updated", livemode=True, message={})
+        EnqueueMock.assert_called_once_with(event)
+        self.assertFalse(event.processed)
+        self.assertEquals(event.object_id, "")
+
+    @patch("pinax.stripe.queues.InlineEventQueue.enqueue")
+    def test_add_event_object_id(self, EnqueueMock):
+        event = events.add_event(stripe_id="evt_004", kind="charge.succeeded", livemode=True, message={"data": {"object": {"id": "ch_1"}}})
+        self.assertEquals(event.object_id, "ch_1")
+
+    @patch("pinax.stripe.queues.InlineEventQueue.enqueue")
+    def test_add_event_duplicate(self, EnqueueMock):
+        Event.objects.create(stripe_id="evt_004", kind="account.updated", webhook_message={})
+        # The insert, within a savepoint
+        with self.assertNumQueries(4):
+            self.assertIsNone(events.add_event(stripe_id="evt_004", kind="account.updated", livemode=True, message={}))
+        self.assertFalse(EnqueueMock.called)
+        self.assertEquals(Event.objects.count(), 1)
+
+    @patch("pinax.stripe.actions.events.add_event")
+    @patch("stripe.Event.all")
+    @patch("stripe.Event.list", None, create=True)
+    def test_catch_up_without_list(self, AllMock, AddEventMock):
+        # As with stripe<1.28
+        AllMock.return_value = {"data": [
+            {"id": "evt_001", "type": "account.updated", "livemode": False, "created": 1500000100}
+        ], "has_more": False}
+        events.catch_up()
+        AllMock.assert_called_once_with(limit=100)
+        self.assertEquals([c[1]["stripe_id"] for c in AddEventMock.call_args_list], ["evt_001"])
+
+    @patch("pinax.stripe.actions.events.add_event")
+    @patch("stripe.Event.list", create=True)
+    def test_catch_up_added_in_the_meantime(self, ListMock, AddEventMock):
+        AddEventMock.return_value = None
+        ListMock.return_value = {"data": [
+            {"id": "evt_003", "type": "account.updated", "livemode": False, "created": 1500000300},
+            {"id": "evt_002", "type": "account.updated", "livemode": False, "created": 1500000200}
+        ], "has_more": False}
+        self.assertEquals(events.catch_up(), [])
+        self.assertEquals(AddEventMock.call_count, 2)
+
+    def test_pending_events(self):
+        pending = Event.objects.create(stripe_id="evt_001", kind="account.updated", webhook_message={})
+        valid = Event.objects.create(stripe_id="evt_002", kind="account.updated", webhook_message={}, valid=True)
+        Event.objects.create(stripe_id="evt_003", kind="account.updated", webhook_message={}, valid=False)
+        Event.objects.create(stripe_id="evt_004", kind="account.updated", webhook_message={}, valid=True, processed=True)
+        self.assertEquals(list(events.pending_events()), [pending, valid])
+
+    @patch("pinax.stripe.actions.events.process_event")
+    def test_process_next_pending_event(self, ProcessMock):
+        first = Event.objects.create(stripe_id="evt_001", kind="account.updated", webhook_message={})
+        second = Event.objects.create(stripe_id="evt_002", kind="account.updated", webhook_message={})
+        self.assertEquals(events.process_next_pending_event(), first)
+        ProcessMock.assert_called_once_with(first)
+        self.assertEquals(events.process_next_pending_event(exclude=[first.pk]), second)
+        self.assertIsNone(events.process_next_pending_event(exclude=[first.pk, second.pk]))
+
+    @patch("pinax.stripe.actions.events.add_event")
+    @patch("stripe.Event.list", create=True)
+    def test_catch_up(self, ListMock, AddEventMock):
+        Event.objects.create(stripe_id="evt_002", kind="account.updated", webhook_message={})
+        ListMock.side_effect = [
+            {"data": [
+                {"id": "evt_003", "type": "account.updated", "livemode": False, "created": 1500000300, "request": {"id": "req_1"}},
+                {"id": "evt_002", "type": "account.updated", "livemode": False, "created": 1500000200}
+            ], "has_more": True},
+            {"data": [
+                {"id": "evt_001", "type": "customer.updated", "livemode": False, "created": 1500000100, "api_version": "2017-06-05"}
+            ], "has_more": False}
+        ]
+        events.catch_up(since=1500000000)
+        ListMock.assert_any_call(limit=100, created={"gte": 1500000000})
+        # Added a page at a time
+        self.assertEquals([c[1]["stripe_id"] for c in AddEventMock.call_args_list], ["evt_003", "evt_001"])
+        self.assertEquals(AddEventMock.call_args_list[0][1]["request_id"], "req_1")
+        self.assertEquals(AddEventMock.call_args_list[1][1]["api_version"], "2017-06-05")
+        self.assertEquals(Checkpoint.objects.get(name="events.catch_up").value, "1500000300")
+
+        ListMock.reset_mock()
+        ListMock.side_effect = None
+        ListMock.return_value = {"data": [], "has_more": False}
+        self.assertEquals(events.catch_up(), [])
+        # From a little before the high-water mark, for events listed late
+        ListMock.assert_called_once_with(limit=100, created={"gte": 1500000240})
+        self.assertEquals(Checkpoint.objects.get(name="events.catch_up").value, "1500000300")
+
+    @patch("stripe.Event.list", create=True)
+    def test_catch_up_first_run(self, ListMock):
+        ListMock.return_value = {"data": [], "has_more": False}
+        events.catch_up()
+        ListMock.assert_called_once_with(limit=100)
+        ListMock.reset_mock()
+        Event.objects.create(stripe_id="evt_001", kind="account.updated", webhook_message={})
+        Event.objects.filter(stripe_id="evt_001").update(created_at=datetime.datetime(2017, 7, 14, 2, 40, tzinfo=timezone.utc))
+        events.catch_up()
+        # From the newest event received rather than the whole history
+        ListMock.assert_called_once_with(limit=100, created={"gte": 1499999940})
+
+    @patch("stripe.Event.list", create=True)
+    def test_catch_up_since(self, ListMock):
+        ListMock.return_value = {"data": [], "has_more": False}
+        since = datetime.datetime(2017, 7, 14, 2, 40, tzinfo=timezone.utc)
+        events.catch_up(since=since)
+        ListMock.assert_called_once_with(limit=100, created={"gte": 1500000000})
+
     def test_add_event_new_webhook_kind(self):
         events.add_event(stripe_id="evt_002", kind="patrick.got.coffee", livemode=True, message={})
         event = Event.objects.get(stripe_id="evt_002")
@@ -518,7 +631,8 @@ class SubscriptionsTests(TestCase):
         self.assertTrue(subscriptions.has_active_subscription(self.customer))
 
     def test_has_active_subscription_False_no_subscription(self):
-        self.assertFalse(subscriptions.has_active_subscription(self.customer))
+        with self.assertNumQueries(1):
+            self.assertFalse(subscriptions.has_active_subscription(self.customer))
 
     def test_has_active_subscription_False_expired(self):
         plan = Plan.objects.create(
@@ -558,6 +672,62 @@ class SubscriptionsTests(TestCase):
         )
         self.assertTrue(subscriptions.has_active_subscription(self.customer))
 
+    @override_settings(PINAX_STRIPE_SUBSCRIPTION_CACHE_TIMEOUT=300)
+    @patch("django.db.transaction.on_commit", create=True, side_effect=lambda func: func())
+    def test_user_has_active_subscription_cached(self, OnCommitMock):
+        cache.clear()
+        plan = Plan.objects.create(stripe_id="pro2", interval="month", interval_count=1, amount=decimal.Decimal("19.99"))
+        self.assertFalse(subscriptions.user_has_active_subscription(self.user))
+        subscription = {
+            "id": "sub_7Q4BX0HMfqTpN8",
+            "application_fee_percent": None,
+            "cancel_at_period_end": False,
+            "canceled_at": None,
+            "current_period_end": 1448758544,
+            "current_period_start": 1448499344,
+            "ended_at": None,
+            "plan": {"id": plan.stripe_id},
+            "quantity": 1,
+            "start": 1448499344,
+            "status": "active",
+            "trial_end": None,
+            "trial_start": None
+        }
+        subscriptions.sync_subscription_from_stripe_data(self.customer, subscription)
+        with self.assertNumQueries(1):
+            self.assertTrue(subscriptions.user_has_active_subscription(self.user))
+        with self.assertNumQueries(0):
+            self.assertTrue(subscriptions.user_has_active_subscription(self.user))
+
+    @patch("django.db.transaction.on_commit", create=True)
+    @patch("pinax.stripe.actions.subscriptions.cache")
+    def test_invalidate_active_subscription_on_commit(self, CacheMock, OnCommitMock):
+        subscriptions.invalidate_active_subscription(self.customer)
+        self.assertFalse(CacheMock.delete.called)
+        OnCommitMock.call_args[0][0]()
+        self.assertTrue(CacheMock.delete.called)
+
+    @override_settings(PINAX_STRIPE_SUBSCRIPTION_CACHE_TIMEOUT=300)
+    @patch("pinax.stripe.actions.subscriptions.cache")
+    def test_user_has_active_subscription_cached_until_ended(self, CacheMock):
+        CacheMock.get.return_value = None
+        plan = Plan.objects.create(stripe_id="pro2", interval="month", interval_count=1, amount=decimal.Decimal("19.99"))
+        Subscription.objects.create(
+            customer=self.customer,
+            plan=plan,
+            quantity=1,
+            start=timezone.now(),
+            status="active",
+            ended_at=timezone.now() + datetime.timedelta(seconds=60)
+        )
+        self.assertTrue(subscriptions.user_has_active_subscription(self.user))
+        self.assertTrue(CacheMock.set.call_args[0][2] <= 61)
+
+    def test_user_has_active_subscription_not_cached_by_default(self):
+        self.assertFalse(subscriptions.user_has_active_subscription(self.user))
+        with self.assertNumQueries(1):
+            self.assertFalse(subscriptions.user_has_active_subscription(self.user))
+
     @patch("pinax.stripe.actions.subscriptions.sync_subscription_from_stripe_data")
     def test_cancel_subscription(self, SyncMock):
         SubMock = Mock()
@@ -1075,8 +1245,140 @@ class SyncsTests(TestCase):
         subscriptions.sync_subscription_from_stripe_data(self.customer, subscription)
         self.assertEquals(Subscription.objects.get(stripe_id=subscription["id"]).status, "active")
 
-    @patch("pinax.stripe.actions.subscriptions.sync_subscription_from_stripe_data")
-    @patch("pinax.stripe.actions.sources.sync_payment_source_from_stripe_data")
+    def test_sync_subscriptions_from_stripe_data(self):
+        Plan.objects.create(stripe_id="pro2", interval="month", interval_count=1, amount=decimal.Decimal("19.99"))
+        subscription = {
+            "id": "sub_7Q4BX0HMfqTpN8",
+            "application_fee_percent": None,
+            "cancel_at_period_end": False,
+            "canceled_at": None,
+            "current_period_end": 1448758544,
+            "current_period_start": 1448499344,
+            "ended_at": None,
+            "plan": {"id": "pro2"},
+            "quantity": 1,
+            "start": 1448499344,
+            "status": "active",
+            "trial_end": None,
+            "trial_start": None
+        }
+        other = dict(subscription, id="sub_7Q4BX0HMfqTpN9", quantity=2)
+        subscriptions.sync_subscription_from_stripe_data(self.customer, subscription)
+        subs = subscriptions.sync_subscriptions_from_stripe_data(self.customer, [other, dict(subscription, status="past_due")])
+        self.assertEquals([sub.stripe_id for sub in subs], [other["id"], subscription["id"]])
+        self.assertEquals(Subscription.objects.get(stripe_id=other["id"]).quantity, 2)
+        self.assertEquals(Subscription.objects.get(stripe_id=subscription["id"]).status, "past_due")
+        customer = Customer.objects.get(pk=self.customer.pk)
+        self.assertEquals(customer.active_subscription_count, 2)
+        self.assertEquals(customer.primary_plan.stripe_id, "pro2")
+
+    def test_sync_subscriptions_from_stripe_data_queries(self):
+        Plan.objects.create(stripe_id="pro2", interval="month", interval_count=1, amount=decimal.Decimal("19.99"))
+        subscription = {
+            "application_fee_percent": None,
+            "cancel_at_period_end": False,
+            "canceled_at": None,
+            "current_period_end": 1448758544,
+            "current_period_start": 1448499344,
+            "ended_at": None,
+            "plan": {"id": "pro2"},
+            "quantity": 1,
+            "start": 1448499344,
+            "status": "active",
+            "trial_end": None,
+            "trial_start": None
+        }
+        subs = [dict(subscription, id="sub_{0}".format(i)) for i in range(10)]
+        subscriptions.sync_subscriptions_from_stripe_data(self.customer, subs)
+        # The existing subscriptions, one UPDATE for all of them and the
+        # summary's SELECT and UPDATE
+        with self.assertNumQueries(4):
+            subscriptions.sync_subscriptions_from_stripe_data(self.customer, [dict(sub, quantity=2) for sub in subs])
+        with self.assertNumQueries(4):
+            subscriptions.sync_subscription_from_stripe_data(self.customer, dict(subs[0], quantity=2, status="past_due"))
+        self.assertEquals(Subscription.objects.filter(quantity=2).count(), 10)
+
+    def test_sync_subscriptions_from_stripe_data_unknown_plan(self):
+        subscription = {"id": "sub_7Q4BX0HMfqTpN8", "plan": {"id": "missing"}}
+        with self.assertRaises(Plan.DoesNotExist):
+            subscriptions.sync_subscriptions_from_stripe_data(self.customer, [subscription])
+
+    def test_sync_account_subscriptions_from_stripe_data(self):
+        Plan.objects.create(stripe_id="pro2", interval="month", interval_count=1, amount=decimal.Decimal("19.99"))
+        subscription = {
+            "id": "sub_7Q4BX0HMfqTpN8",
+            "application_fee_percent": None,
+            "cancel_at_period_end": False,
+            "canceled_at": None,
+            "current_period_end": 1448758544,
+            "current_period_start": 1448499344,
+            "customer": self.customer.stripe_id,
+            "ended_at": None,
+            "plan": {"id": "pro2"},
+            "quantity": 1,
+            "start": 1448499344,
+            "status": "active",
+            "trial_end": None,
+            "trial_start": None
+        }
+        unknown = dict(subscription, id="sub_7Q4BX0HMfqTpN9", customer="cus_unknown")
+        subs = subscriptions.sync_account_subscriptions_from_stripe_data([subscription, unknown])
+        self.assertEquals([sub.stripe_id for sub in subs], [subscription["id"]])
+        self.assertEquals(Subscription.objects.get().customer, self.customer)
+
+    @patch("pinax.stripe.actions.customers.sync_customer")
+    def test_sync_customers_from_stripe_data(self, SyncMock):
+        cu = {"id": self.customer.stripe_id}
+        synced = customers.sync_customers_from_stripe_data([{"id": "cus_unknown"}, cu])
+        self.assertEquals(synced, [self.customer])
+        SyncMock.assert_called_once_with(self.customer, cu=cu)
+
+    def test_sync_payment_sources_from_stripe_data(self):
+        card = {
+            "id": "card_17AMEBI10iPhvocM1LnJ0dBc",
+            "name": None,
+            "address_line1": None,
+            "address_line1_check": None,
+            "address_line2": None,
+            "address_city": None,
+            "address_state": None,
+            "address_country": None,
+            "address_zip": None,
+            "address_zip_check": None,
+            "brand": "MasterCard",
+            "country": "US",
+            "cvc_check": "pass",
+            "dynamic_last4": None,
+            "exp_month": 1,
+            "exp_year": 2020,
+            "funding": "credit",
+            "last4": "4444",
+            "fingerprint": "xyz"
+        }
+        receiver = {
+            "id": "btcrcv_17BE32I10iPhvocMqViUU1w4",
+            "active": False,
+            "amount": 100,
+            "amount_received": 0,
+            "bitcoin_amount": 1757908,
+            "bitcoin_amount_received": 0,
+            "bitcoin_uri": "bitcoin:test_7i9Fo4b5wXcUAuoVBFrc7nc9HDxD1?amount=0.01757908",
+            "currency": "usd",
+            "description": "Receiver for John Doe",
+            "email": "test@example.com",
+            "filled": False,
+            "inbound_address": "test_7i9Fo4b5wXcUAuoVBFrc7nc9HDxD1",
+            "refund_address": None,
+            "uncaptured_funds": False,
+            "used_for_payment": False
+        }
+        objs = sources.sync_payment_sources_from_stripe_data(self.customer, [receiver, card])
+        self.assertTrue(isinstance(objs[0], BitcoinReceiver))
+        self.assertTrue(isinstance(objs[1], Card))
+        self.assertEquals(Card.objects.get(stripe_id=card["id"]).last4, "4444")
+
+    @patch("pinax.stripe.actions.subscriptions.sync_subscriptions_from_stripe_data")
+    @patch("pinax.stripe.actions.sources.sync_payment_sources_from_stripe_data")
     @patch("stripe.Customer.retrieve")
     def test_sync_customer(self, RetreiveMock, SyncPaymentSourceMock, SyncSubscriptionMock):
         RetreiveMock.return_value = dict(
@@ -1096,8 +1398,8 @@ class SyncsTests(TestCase):
         self.assertTrue(SyncPaymentSourceMock.called)
         self.assertTrue(SyncSubscriptionMock.called)
 
-    @patch("pinax.stripe.actions.subscriptions.sync_subscription_from_stripe_data")
-    @patch("pinax.stripe.actions.sources.sync_payment_source_from_stripe_data")
+    @patch("pinax.stripe.actions.subscriptions.sync_subscriptions_from_stripe_data")
+    @patch("pinax.stripe.actions.sources.sync_payment_sources_from_stripe_data")
     def test_sync_customer_no_cu_provided(self, SyncPaymentSourceMock, SyncSubscriptionMock):
         cu = dict(
             account_balance=1999,
@@ -1116,12 +1418,49 @@ class SyncsTests(TestCase):
         self.assertTrue(SyncPaymentSourceMock.called)
         self.assertTrue(SyncSubscriptionMock.called)
 
-    @patch("pinax.stripe.actions.invoices.sync_invoice_from_stripe_data")
+    @patch("pinax.stripe.actions.subscriptions.sync_subscriptions_from_stripe_data")
+    @patch("pinax.stripe.actions.sources.sync_payment_sources_from_stripe_data")
     @patch("stripe.Customer.retrieve")
-    def test_sync_invoices_for_customer(self, RetreiveMock, SyncMock):
-        RetreiveMock().invoices().data = [Mock()]
+    def test_sync_customer_details(self, RetreiveMock, SyncPaymentSourceMock, SyncSubscriptionMock):
+        RetreiveMock.return_value = dict(
+            account_balance=-500,
+            currency="usd",
+            delinquent=True,
+            default_source="card_xxxxxxxxxxxxxxx"
+        )
+        customers.sync_customer_details(self.customer)
+        customer = Customer.objects.get(user=self.user)
+        self.assertEquals(customer.account_balance, decimal.Decimal("-5"))
+        self.assertEquals(customer.delinquent, True)
+        self.assertEquals(customer.default_source, "card_xxxxxxxxxxxxxxx")
+        self.assertFalse(SyncPaymentSourceMock.called)
+        self.assertFalse(SyncSubscriptionMock.called)
+
+    @patch("pinax.stripe.actions.invoices.sync_invoices_from_stripe_data")
+    @patch("stripe.Invoice.list", create=True)
+    def test_sync_invoices_for_customer(self, ListMock, SyncMock):
+        ListMock.return_value = {"data": [{"id": "in_1"}], "has_more": False}
         invoices.sync_invoices_for_customer(self.customer)
-        self.assertTrue(SyncMock.called)
+        ListMock.assert_called_once_with(
+            limit=100,
+            customer=self.customer.stripe_id,
+            expand=["data.charge", "data.subscription"]
+        )
+        SyncMock.assert_called_once_with([{"id": "in_1"}])
+
+    @patch("pinax.stripe.actions.invoices.sync_invoices_from_stripe_data")
+    @patch("stripe.Invoice.all")
+    @patch("stripe.Invoice.list", None, create=True)
+    def test_sync_invoices_for_customer_without_list(self, AllMock, SyncMock):
+        # As with stripe<1.28
+        AllMock.return_value = {"data": [{"id": "in_1"}], "has_more": False}
+        invoices.sync_invoices_for_customer(self.customer)
+        AllMock.assert_called_once_with(
+            limit=100,
+            customer=self.customer.stripe_id,
+            expand=["data.charge", "data.subscription"]
+        )
+        SyncMock.assert_called_once_with([{"id": "in_1"}])
 
     @patch("pinax.stripe.actions.charges.sync_charge_from_stripe_data")
     @patch("stripe.Customer.retrieve")
@@ -1199,6 +1538,40 @@ class SyncsTests(TestCase):
         charge = Charge.objects.get(customer=self.customer, stripe_id=data["id"])
         self.assertEquals(charge.amount, decimal.Decimal("2"))
 
+    def test_sync_charges_from_stripe_data(self):
+        invoice = Invoice.objects.create(
+            stripe_id="in_17A1dUI10iPhvocMSGtIfUDF",
+            customer=self.customer,
+            amount_due=decimal.Decimal("2.00"),
+            period_end=timezone.now(),
+            period_start=timezone.now(),
+            subtotal=decimal.Decimal("2.00"),
+            total=decimal.Decimal("2.00"),
+            date=timezone.now()
+        )
+        data = {
+            "id": "ch_17A1dUI10iPhvocMOecpvQlI",
+            "amount": 200,
+            "amount_refunded": 0,
+            "captured": True,
+            "created": 1448213304,
+            "currency": "usd",
+            "customer": self.customer.stripe_id,
+            "description": None,
+            "dispute": None,
+            "invoice": invoice.stripe_id,
+            "paid": True,
+            "refunded": False,
+            "source": {"id": "card_179o0lI10iPhvocMZgdPiR5M"}
+        }
+        other = dict(data, id="ch_17A1dUI10iPhvocMOecpvQlJ", invoice=None, refunded=True)
+        guest = dict(data, id="ch_17A1dUI10iPhvocMOecpvQlK", customer=None)
+        objs = charges.sync_charges_from_stripe_data([data, other, guest])
+        self.assertEquals([charge.stripe_id for charge in objs], [data["id"], other["id"]])
+        self.assertEquals(objs[0].invoice, invoice)
+        self.assertEquals(objs[0].amount, decimal.Decimal("2"))
+        self.assertEquals(Charge.objects.get(stripe_id=other["id"]).amount_refunded, decimal.Decimal("2"))
+
     def test_sync_charge_from_stripe_data_description(self):
         data = {
             "id": "ch_17A1dUI10iPhvocMOecpvQlI",
@@ -1568,6 +1941,88 @@ class SyncsTests(TestCase):
         self.assertEquals(invoice.items.all()[0].description, "Something random")
         self.assertEquals(invoice.items.all()[0].amount, decimal.Decimal("20"))
 
+    def test_sync_invoice_items_complete_deletes_vanished(self):
+        invoice = Invoice.objects.create(
+            stripe_id="inv_001",
+            customer=self.customer,
+            amount_due=100,
+            period_end=timezone.now(),
+            period_start=timezone.now(),
+            subtotal=100,
+            total=100,
+            date=timezone.now()
+        )
+        invoice.items.create(stripe_id="ii_vanished", amount=1, period_start=timezone.now(), period_end=timezone.now(), line_type="invoiceitem")
+        invoice.items.create(stripe_id="ii_kept", amount=1, period_start=timezone.now(), period_end=timezone.now(), line_type="invoiceitem")
+        items = [{
+            "id": "ii_kept",
+            "amount": 2000,
+            "currency": "usd",
+            "description": "Something random",
+            "period": {
+                "start": 1448499344,
+                "end": 1448758544
+            },
+            "proration": False,
+            "quantity": 1,
+            "type": "invoiceitem"
+        }, {
+            "id": "ii_new",
+            "amount": 500,
+            "currency": "usd",
+            "description": None,
+            "period": {
+                "start": 1448499344,
+                "end": 1448758544
+            },
+            "proration": False,
+            "quantity": 1,
+            "type": "invoiceitem"
+        }]
+        invoices.sync_invoice_items(invoice, items)
+        self.assertEquals(invoice.items.count(), 3)
+        invoices.sync_invoice_items(invoice, items, complete=True)
+        self.assertEquals(
+            sorted(invoice.items.values_list("stripe_id", "amount")),
+            [("ii_kept", decimal.Decimal("20")), ("ii_new", decimal.Decimal("5"))]
+        )
+
+    def test_sync_invoice_items_many_changed_in_one_update(self):
+        invoice = Invoice.objects.create(
+            stripe_id="inv_001",
+            customer=self.customer,
+            amount_due=100,
+            period_end=timezone.now(),
+            period_start=timezone.now(),
+            subtotal=100,
+            total=100,
+            date=timezone.now()
+        )
+        items = [{
+            "id": "ii_{0}".format(i),
+            "amount": 100,
+            "currency": "usd",
+            "description": "Line {0}".format(i),
+            "period": {
+                "start": 1448499344,
+                "end": 1448758544
+            },
+            "proration": False,
+            "quantity": 1,
+            "type": "invoiceitem"
+        } for i in range(50)]
+        invoices.sync_invoice_items(invoice, items)
+        for i, item in enumerate(items):
+            item["amount"] = 200 + i
+        # A savepoint and its release around loading the existing items, one
+        # UPDATE for all of them and deleting the vanished ones
+        with self.assertNumQueries(5):
+            invoices.sync_invoice_items(invoice, items, complete=True)
+        self.assertEquals(
+            list(invoice.items.order_by("pk").values_list("amount", flat=True)),
+            [decimal.Decimal(200 + i) / 100 for i in range(50)]
+        )
+
     @patch("pinax.stripe.actions.subscriptions.retrieve")
     @patch("pinax.stripe.actions.subscriptions.sync_subscription_from_stripe_data")
     def test_sync_invoice_items_different_stripe_id_than_invoice(self, SyncMock, RetrieveSubscriptionMock):  # two subscriptions on invoice?
@@ -1868,6 +2323,137 @@ class SyncsTests(TestCase):
         self.assertTrue(SyncChargeMock.called)
         self.assertTrue(SendReceiptMock.called)
 
+    @patch("pinax.stripe.hooks.hookset.send_receipt")
+    @patch("stripe.Charge.retrieve")
+    @patch("pinax.stripe.actions.invoices.sync_invoice_items")
+    @patch("pinax.stripe.actions.subscriptions.retrieve")
+    def test_sync_invoices_from_stripe_data(self, RetrieveSubscriptionMock, SyncInvoiceItemsMock, ChargeFetchMock, SendReceiptMock):
+        plan = Plan.objects.create(stripe_id="pro2", interval="month", interval_count=1, amount=decimal.Decimal("19.99"))
+        subscription = Subscription.objects.create(
+            stripe_id="sub_7Q4BX0HMfqTpN8",
+            customer=self.customer,
+            plan=plan,
+            quantity=1,
+            status="active",
+            start=timezone.now()
+        )
+        charge = Charge.objects.create(
+            stripe_id="ch_XXXXXX",
+            customer=self.customer,
+            source="card_01",
+            amount=decimal.Decimal("19.99"),
+            currency="usd",
+            paid=True,
+            refunded=False,
+            disputed=False
+        )
+        data = {
+            "id": "in_17B6e8I10iPhvocMGtYd4hDD",
+            "amount_due": 1999,
+            "attempt_count": 1,
+            "attempted": True,
+            "charge": charge.stripe_id,
+            "closed": True,
+            "currency": "usd",
+            "customer": self.customer.stripe_id,
+            "date": 1448470892,
+            "lines": {"data": []},
+            "paid": True,
+            "period_end": 1448470739,
+            "period_start": 1448211539,
+            "subscription": subscription.stripe_id,
+            "subtotal": 1999,
+            "total": 1999
+        }
+        unknown = dict(data, id="in_17B6e8I10iPhvocMGtYd4hDE", customer="cus_unknown")
+        objs = invoices.sync_invoices_from_stripe_data([data, unknown])
+        self.assertEquals([invoice.stripe_id for invoice in objs], [data["id"]])
+        self.assertEquals(objs[0].subscription, subscription)
+        self.assertEquals(Charge.objects.get(pk=charge.pk).invoice, objs[0])
+        self.assertFalse(ChargeFetchMock.called)
+        self.assertFalse(RetrieveSubscriptionMock.called)
+        self.assertFalse(SendReceiptMock.called)
+        SyncInvoiceItemsMock.assert_called_once_with(objs[0], [], {subscription.stripe_id: subscription}, complete=True)
+
+    @patch("stripe.Charge.retrieve")
+    @patch("pinax.stripe.actions.subscriptions.retrieve")
+    def test_sync_invoices_from_stripe_data_expanded(self, RetrieveSubscriptionMock, ChargeFetchMock):
+        plan = Plan.objects.create(stripe_id="pro2", interval="month", interval_count=1, amount=decimal.Decimal("19.99"))
+        other = Subscription.objects.create(
+            stripe_id="sub_7Q4BX0HMfqTpN9",
+            customer=self.customer,
+            plan=plan,
+            quantity=1,
+            status="active",
+            start=timezone.now()
+        )
+        stripe_subscription = {
+            "id": "sub_7Q4BX0HMfqTpN8",
+            "application_fee_percent": None,
+            "cancel_at_period_end": False,
+            "canceled_at": None,
+            "current_period_end": 1448758544,
+            "current_period_start": 1448499344,
+            "customer": self.customer.stripe_id,
+            "ended_at": None,
+            "plan": {"id": "pro2"},
+            "quantity": 1,
+            "start": 1448499344,
+            "status": "active",
+            "trial_end": None,
+            "trial_start": None
+        }
+        stripe_charge = {
+            "id": "ch_17A1dUI10iPhvocMOecpvQlI",
+            "amount": 1999,
+            "amount_refunded": 0,
+            "captured": True,
+            "created": 1448213304,
+            "currency": "usd",
+            "customer": self.customer.stripe_id,
+            "description": None,
+            "dispute": None,
+            "invoice": "in_17B6e8I10iPhvocMGtYd4hDD",
+            "paid": True,
+            "refunded": False,
+            "source": {"id": "card_179o0lI10iPhvocMZgdPiR5M"}
+        }
+        data = {
+            "id": "in_17B6e8I10iPhvocMGtYd4hDD",
+            "amount_due": 1999,
+            "attempt_count": 1,
+            "attempted": True,
+            "charge": stripe_charge,
+            "closed": True,
+            "currency": "usd",
+            "customer": self.customer.stripe_id,
+            "date": 1448470892,
+            "lines": {"data": [{
+                "id": other.stripe_id,
+                "amount": 1999,
+                "currency": "usd",
+                "description": None,
+                "period": {"start": 1448499344, "end": 1448758544},
+                "plan": None,
+                "proration": False,
+                "quantity": 1,
+                "type": "subscription"
+            }]},
+            "paid": True,
+            "period_end": 1448470739,
+            "period_start": 1448211539,
+            "subscription": stripe_subscription,
+            "subtotal": 1999,
+            "total": 1999
+        }
+        invoice = invoices.sync_invoices_from_stripe_data([data])[0]
+        self.assertFalse(ChargeFetchMock.called)
+        self.assertFalse(RetrieveSubscriptionMock.called)
+        self.assertEquals(invoice.subscription.stripe_id, stripe_subscription["id"])
+        self.assertEquals(invoice.charge.stripe_id, stripe_charge["id"])
+        self.assertEquals(Charge.objects.get(stripe_id=stripe_charge["id"]).invoice, invoice)
+        self.assertEquals(invoice.items.get().subscription, other)
+
     @patch("pinax.stripe.hooks.hookset.send_receipt")
     @patch("pinax.stripe.actions.subscriptions.sync_subscription_from_stripe_data")
     @patch("stripe.Charge.retrieve")
@@ -2227,6 +2813,188 @@ class SyncsTests(TestCase):
         self.assertEquals(Invoice.objects.filter(customer=self.customer)[0].paid, True)
 
 
+class RollupsTests(TestCase):
+
+    def setUp(self):
+        self.customer = Customer.objects.create(stripe_id="cus_xxxxxxxxxxxxxxx")
+        self.plan = Plan.objects.create(stripe_id="pro2", interval="month", interval_count=1, amount=decimal.Decimal("19.99"))
+        self.day = datetime.datetime(2016, 3, 4, 12, tzinfo=timezone.utc)
+
+    def charge(self, stripe_id, created, currency="usd", paid=True):
+        return Charge.objects.create(
+            stripe_id=stripe_id,
+            customer=self.customer,
+            currency=currency,
+            amount=decimal.Decimal("10"),
+            amount_refunded=decimal.Decimal("2.50"),
+            paid=paid,
+            charge_created=created
+        )
+
+    def test_update_charge_totals(self):
+        self.charge("ch_1", self.day)
+        self.charge("ch_2", self.day)
+        self.charge("ch_3", self.day, currency="eur")
+        self.charge("ch_4", self.day, paid=False)
+        self.charge("ch_5", self.day + datetime.timedelta(days=1))
+        DailyChargeTotal.objects.create(date=self.day.date(), currency="gbp", count=1, gross=1)
+        rollups.update_charge_totals(set([self.day.date()]))
+        self.assertEquals(
+            sorted(DailyChargeTotal.objects.values_list("date", "currency", "count", "gross", "refunded")),
+            [
+                (self.day.date(), "eur", 1, decimal.Decimal("10"), decimal.Decimal("2.50")),
+                (self.day.date(), "usd", 2, decimal.Decimal("20"), decimal.Decimal("5")),
+            ]
+        )
+
+    @override_settings(TIME_ZONE="America/Los_Angeles")
+    def test_update_charge_totals_default_timezone(self):
+        charge = self.charge("ch_1", datetime.datetime(2016, 3, 4, 3, tzinfo=timezone.utc))
+        self.assertEquals(list(rollups.charge_totals([charge])), [(datetime.date(2016, 3, 3), "usd")])
+        rollups.update_charge_totals(set([datetime.date(2016, 3, 3)]))
+        self.assertEquals(DailyChargeTotal.objects.get().date, datetime.date(2016, 3, 3))
+
+    def test_update_subscription_counts(self):
+        canceled = self.day + datetime.timedelta(days=2)
+        for stripe_id, status, canceled_at in [
+            ("sub_1", "active", None),
+            ("sub_2", "trialing", None),
+            ("sub_3", "canceled", canceled),
+        ]:
+            Subscription.objects.create(
+                stripe_id=stripe_id,
+                customer=self.customer,
+                plan=self.plan,
+                quantity=1,
+                status=status,
+                start=self.day,
+                canceled_at=canceled_at
+            )
+        self.assertEquals(rollups.rebuild(), (0, 2))
+        self.assertEquals(
+            sorted(DailySubscriptionCount.objects.values_list("date", "plan", "new", "canceled")),
+            [
+                (self.day.date(), self.plan.pk, 2, 0),
+                (canceled.date(), self.plan.pk, 0, 1),
+            ]
+        )
+
+    @override_settings(PINAX_STRIPE_ROLLUPS=True)
+    def test_maintained_by_sync(self):
+        data = {
+            "id": "ch_1",
+            "amount": 1000,
+            "amount_refunded": 0,
+            "captured": True,
+            "created": 1457092800,
+            "currency": "usd",
+            "customer": self.customer.stripe_id,
+            "description": None,
+            "dispute": None,
+            "invoice": None,
+            "paid": True,
+            "refunded": False,
+            "source": {"id": "card_1"},
+        }
+        charges.sync_charges_from_stripe_data([data])
+        self.assertEquals(DailyChargeTotal.objects.get().gross, decimal.Decimal("10"))
+        data.update(amount_refunded=400)
+        charges.sync_charge_from_stripe_data(data)
+        self.assertEquals(DailyChargeTotal.objects.get().refunded, decimal.Decimal("4"))
+
+    def charge_data(self, stripe_id, **kwargs):
+        return dict({
+            "id": stripe_id,
+            "amount": 1000,
+            "amount_refunded": 0,
+            "captured": True,
+            "created": 1457092800,
+            "currency": "usd",
+            "customer": self.customer.stripe_id,
+            "description": None,
+            "dispute": None,
+            "invoice": None,
+            "paid": True,
+            "refunded": False,
+            "source": {"id": "card_1"},
+        }, **kwargs)
+
+    def rebuilt_charge_totals(self):
+        totals = sorted(DailyChargeTotal.objects.filter(count__gt=0).values_list("date", "currency", "count", "gross", "refunded"))
+        rollups.update_charge_totals()
+        self.assertEquals(totals, sorted(DailyChargeTotal.objects.values_list("date", "currency", "count", "gross", "refunded")))
+        return totals
+
+    @override_settings(PINAX_STRIPE_ROLLUPS=True)
+    def test_sync_applies_charge_changes(self):
+        charges.sync_charges_from_stripe_data([self.charge_data("ch_{0}".format(i)) for i in range(20)])
+        # Looking up the customer and invoice, then in a savepoint the charge
+        # before and in bulk_upsert, its UPDATE and the one of its day's row,
+        # without reading the day's other charges
+        with self.assertNumQueries(8):
+            charges.sync_charge_from_stripe_data(self.charge_data("ch_1", amount_refunded=400))
+        self.assertEquals(
+            self.rebuilt_charge_totals(),
+            [(datetime.date(2016, 3, 4), "usd", 20, decimal.Decimal("200"), decimal.Decimal("4"))]
+        )
+        charges.sync_charges_from_stripe_data([
+            self.charge_data("ch_2", paid=False),
+            self.charge_data("ch_3", currency="eur"),
+            self.charge_data("ch_4", created=1457179200),
+            self.charge_data("ch_5", amount=2000),
+        ])
+        self.assertEquals(
+            self.rebuilt_charge_totals(),
+            [
+                (datetime.date(2016, 3, 4), "eur", 1, decimal.Decimal("10"), decimal.Decimal("0")),
+                (datetime.date(2016, 3, 4), "usd", 17, decimal.Decimal("180"), decimal.Decimal("4")),
+                (datetime.date(2016, 3, 5), "usd", 1, decimal.Decimal("10"), decimal.Decimal("0")),
+            ]
+        )
+
+    @override_settings(PINAX_STRIPE_ROLLUPS=True)
+    def test_subscription_delete_applies_changes(self):
+        subscription = Subscription.objects.create(
+            stripe_id="sub_1",
+            customer=self.customer,
+            plan=self.plan,
+            quantity=1,
+            status="active",
+            start=self.day
+        )
+        rollups.rebuild()
+        subscription.delete()
+        self.assertEquals(DailySubscriptionCount.objects.get().new, 0)
+
+    def test_apply_changes_never_counts_below_zero(self):
+        charge = self.charge("ch_1", self.day)
+        rollups.apply_charge_changes([charge], [])
+        self.assertEquals(DailyChargeTotal.objects.get().count, 0)
+
+    @override_settings(PINAX_STRIPE_ROLLUPS=True)
+    def test_reverted_cancellation(self):
+        subscription = {
+            "id": "sub_1",
+            "application_fee_percent": None,
+            "cancel_at_period_end": False,
+            "canceled_at": 1457092800,
+            "current_period_start": 1457092800,
+            "current_period_end": 1459771200,
+            "ended_at": None,
+            "plan": {"id": self.plan.stripe_id},
+            "quantity": 1,
+            "start": 1457092800,
+            "status": "canceled",
+            "trial_start": None,
+            "trial_end": None,
+        }
+        subscriptions.sync_subscription_from_stripe_data(self.customer, subscription)
+        self.assertEquals(DailySubscriptionCount.objects.get().canceled, 1)
+        subscription.update(status="active", canceled_at=None)
+        subscriptions.sync_subscription_from_stripe_data(self.customer, subscription)
+        self.assertEquals(DailySubscriptionCount.objects.get().canceled, 0)
+
+
 class TransfersTests(TestCase):
 
     def setUp(self):
@@ -1,15 +1,21 @@
 import datetime
 
 from django.contrib.auth import get_user_model
+from django.db import connection
+from django.contrib import admin
 from django.test import Client, TestCase
+from django.test.utils import CaptureQueriesContext, override_settings
 from django.utils import timezone
 
+from mock import patch
+
 try:
     from django.urls import reverse
 except ImportError:
     from django.core.urlresolvers import reverse
 
-from ..models import Customer, Invoice, Plan, Subscription
+from ..admin import CustomerSubscriptionStatusListFilter
+from ..models import Card, Charge, Customer, Event, Invoice, Plan, Subscription
 
 
 User = get_user_model()
@@ -134,3 +140,107 @@ class AdminTestCase(TestCase):
         url = reverse('admin:pinax_stripe_charge_changelist')
         response = self.client.get(url)
         self.assertEqual(response.status_code, 200)
+
+    def assertConstantQueries(self, url, add_rows):
+        with CaptureQueriesContext(connection) as before:
+            self.assertEqual(self.client.get(url).status_code, 200)
+        add_rows()
+        with CaptureQueriesContext(connection) as after:
+            self.assertEqual(self.client.get(url).status_code, 200)
+        self.assertEqual(len(after), len(before))
+
+    def test_customer_admin_queries(self):
+        def add_rows():
+            for i in range(5):
+                customer = Customer.objects.create(
+                    user=User.objects.create_user(username="extra{0}".format(i)),
+                    stripe_id="cus_extra{0}".format(i)
+                )
+                Subscription.objects.create(
+                    stripe_id="sub_extra{0}".format(i),
+                    customer=customer,
+                    plan=self.plan,
+                    status="active",
+                    start=timezone.now(),
+                    quantity=1
+                )
+        self.assertConstantQueries(reverse("admin:pinax_stripe_customer_changelist"), add_rows)
+
+    def test_invoice_admin_queries(self):
+        def add_rows():
+            for i in range(5):
+                customer = Customer.objects.create(
+                    user=User.objects.create_user(username="extra{0}".format(i)),
+                    stripe_id="cus_extra{0}".format(i)
+                )
+                Card.objects.create(customer=customer, stripe_id="card_extra{0}".format(i), exp_month=1, exp_year=2030, fingerprint="abc")
+                Invoice.objects.create(
+                    stripe_id="in_extra{0}".format(i),
+                    customer=customer,
+                    date=timezone.now(),
+                    amount_due=100,
+                    subtotal=100,
+                    total=100,
+                    period_end=timezone.now(),
+                    period_start=timezone.now()
+                )
+        self.assertConstantQueries(reverse("admin:pinax_stripe_invoice_changelist"), add_rows)
+
+    def test_charge_admin_queries(self):
+        def add_rows():
+            for customer in Customer.objects.all():
+                Charge.objects.create(stripe_id="ch_{0}".format(customer.pk), customer=customer, source="card_1")
+        self.assertConstantQueries(reverse("admin:pinax_stripe_charge_changelist"), add_rows)
+
+    def test_subscription_status_filter(self):
+        Customer.objects.create(stripe_id="cus_nosubscription")
+
+        def customers(value):
+            list_filter = CustomerSubscriptionStatusListFilter(None, {"sub_status": value}, Customer, None)
+            return list_filter.queryset(None, Customer.objects.all())
+
+        with self.assertNumQueries(0):
+            lookups = CustomerSubscriptionStatusListFilter(None, {}, Customer, None).lookups(None, None)
+        self.assertIn(["past_due", "Past Due"], lookups)
+        self.assertEqual(customers("active").count(), 11)
+        self.assertEqual(list(customers("canceled").values_list("stripe_id", flat=True)), ["cus_xxxxxxxxxxxxxx11"])
+        self.assertEqual(list(customers("none").values_list("stripe_id", flat=True)), ["cus_nosubscription"])
+        self.assertEqual(customers(None).count(), 13)
+
+    def test_event_admin_keyset_pages(self):
+        created_at = timezone.now()
+        for i in range(5):
+            Event.objects.create(stripe_id="evt_{0}".format(i), kind="charge.succeeded", webhook_message={}, created_at=created_at)
+        url = reverse("admin:pinax_stripe_event_changelist")
+        seen = []
+        with patch.object(admin.site._registry[Event], "list_per_page", 2):
+            response = self.client.get(url)
+            while True:
+                self.assertEqual(response.status_code, 200)
+                cl = response.context["cl"]
+                seen.extend(event.stripe_id for event in cl.result_list)
+                if cl.next_cursor is None:
+                    break
+                response = self.client.get(url + cl.next_page_url)
+        self.assertEqual(seen, ["evt_4", "evt_3", "evt_2", "evt_1", "evt_0"])
+
+    def test_event_admin_invalid_cursor(self):
+        response = self.client.get(reverse("admin:pinax_stripe_event_changelist") + "?cursor=bad")
+        self.assertEqual(response.status_code, 302)
+
+    def test_event_admin_search(self):
+        Event.objects.create(stripe_id="evt_1", kind="charge.succeeded", webhook_message={"note": "needle"}, object_id="ch_1")
+        Event.objects.create(stripe_id="evt_2", kind="charge.succeeded", webhook_message={}, object_id="ch_2")
+        url = reverse("admin:pinax_stripe_event_changelist")
+        response = self.client.get(url + "?q=ch_1")
+        self.assertEqual([event.stripe_id for event in response.context["cl"].result_list], ["evt_1"])
+        response = self.client.get(url + "?q=needle")
+        self.assertEqual(list(response.context["cl"].result_list), [])
+        with override_settings(PINAX_STRIPE_ADMIN_PAYLOAD_SEARCH=True):
+            response = self.client.get(url + "?q=needle")
+        self.assertEqual([event.stripe_id for event in response.context["cl"].result_list], ["evt_1"])
+
+    def test_event_admin_sorted(self):
+        response = self.client.get(reverse("admin:pinax_stripe_event_changelist") + "?o=1")
+        self.assertEqual(response.status_code, 200)
+        self.assertFalse(response.context["cl"].keyset)
@@ -0,0 +1,80 @@
+import datetime
+import decimal
+
+from django.test import TestCase
+from django.utils import timezone
+
+from .. import analytics
+from ..models import Customer, Plan, Subscription
+
+
+def utc(*args):
+    return datetime.datetime(*args, tzinfo=timezone.utc)
+
+
+class AnalyticsTests(TestCase):
+
+    def setUp(self):
+        self.customer = Customer.objects.create(stripe_id="cus_xxxxxxxxxxxxxxx")
+        monthly = Plan.objects.create(stripe_id="pro", interval="month", interval_count=1, amount=decimal.Decimal("10"), currency="usd")
+        yearly = Plan.objects.create(stripe_id="pro-yearly", interval="year", interval_count=1, amount=decimal.Decimal("120"), currency="usd")
+        for i, (plan, quantity, status, start, ended_at) in enumerate([
+            (monthly, 1, "active", utc(2016, 1, 5), None),
+            (monthly, 2, "canceled", utc(2016, 1, 20), utc(2016, 2, 10)),
+            (yearly, 1, "active", utc(2016, 2, 1), None),
+            (monthly, 1, "trialing", utc(2016, 1, 5), None),
+        ]):
+            Subscription.objects.create(
+                stripe_id="sub_{0}".format(i),
+                customer=self.customer,
+                plan=plan,
+                quantity=quantity,
+                status=status,
+                start=start,
+                ended_at=ended_at,
+                canceled_at=ended_at
+            )
+
+    def test_months(self):
+        self.assertEquals(
+            analytics.months(datetime.date(2015, 12, 15), datetime.date(2016, 2, 1)),
+            [(utc(2015, 12, 1), utc(2016, 1, 1)), (utc(2016, 1, 1), utc(2016, 2, 1))]
+        )
+        self.assertEquals(len(analytics.months(utc(2016, 1, 1), utc(2016, 2, 2))), 2)
+
+    def test_churn(self):
+        with self.assertNumQueries(1):
+            rows = list(analytics.churn(datetime.date(2016, 1, 1), datetime.date(2016, 4, 1)))
+        self.assertEquals(
+            [(row["month"], row["active"], row["canceled"], row["churn"]) for row in rows],
+            [
+                (utc(2016, 1, 1), 0, 0, None),
+                (utc(2016, 2, 1), 3, 1, decimal.Decimal("1") / decimal.Decimal("3")),
+                (utc(2016, 3, 1), 2, 0, decimal.Decimal("0")),
+            ]
+        )
+
+    def test_mrr(self):
+        with self.assertNumQueries(1):
+            rows = list(analytics.mrr(datetime.date(2016, 1, 1), datetime.date(2016, 3, 1)))
+        self.assertEquals([row["mrr"] for row in rows], [
+            {"usd": decimal.Decimal("40.00")},
+            {"usd": decimal.Decimal("20.00")},
+        ])
+
+    def test_net_revenue_retention(self):
+        rows = list(analytics.net_revenue_retention(datetime.date(2016, 2, 1), datetime.date(2016, 3, 1)))
+        self.assertEquals(rows[0]["starting"], {"usd": decimal.Decimal("40.00")})
+        self.assertEquals(rows[0]["retained"], {"usd": decimal.Decimal("20.00")})
+        self.assertEquals(rows[0]["rate"], {"usd": decimal.Decimal("0.5")})
+
+    def test_cohorts(self):
+        with self.assertNumQueries(1):
+            rows = list(analytics.cohorts(datetime.date(2016, 1, 1), datetime.date(2016, 3, 1)))
+        self.assertEquals([(row["month"], row["size"], row["retained"]) for row in rows], [
+            (utc(2016, 1, 1), 2, [2, 1]),
+            (utc(2016, 2, 1), 1, [1]),
+        ])
+
+    def test_empty_range(self):
+        self.assertEquals(list(analytics.churn(datetime.date(2016, 2, 1), datetime.date(2016, 2, 1))), [])
@@ -0,0 +1,183 @@
+import decimal
+
+from django.test import TestCase, override_settings
+from django.utils import timezone
+
+from django.contrib.auth import get_user_model
+
+from mock import patch
+
+from .. import cache
+from ..models import Customer, Plan, Subscription
+from ..utils import bulk_upsert
+
+
+class UnitOfWorkTests(TestCase):
+
+    def setUp(self):
+        self.user = get_user_model().objects.create_user(username="patrick")
+        self.customer = Customer.objects.create(stripe_id="cus_xxxxxxxxxxxxxxx", user=self.user)
+        self.plan = Plan.objects.create(stripe_id="pro2", interval="month", interval_count=1, amount=decimal.Decimal("19.99"))
+
+    @patch("stripe.Customer.retrieve")
+    def test_no_caching_outside_unit_of_work(self, RetrieveMock):
+        self.customer.stripe_customer
+        self.customer.stripe_customer
+        self.assertEquals(RetrieveMock.call_count, 2)
+
+    @patch("stripe.Customer.retrieve")
+    def test_retrieved_once_per_unit_of_work(self, RetrieveMock):
+        with cache.unit_of_work():
+            first = self.customer.stripe_customer
+            with cache.unit_of_work():
+                second = Customer.objects.get(pk=self.customer.pk).stripe_customer
+        self.assertIs(first, second)
+        RetrieveMock.assert_called_once_with(self.customer.stripe_id)
+        with cache.unit_of_work():
+            self.customer.stripe_customer
+        self.assertEquals(RetrieveMock.call_count, 2)
+
+    @patch("stripe.Customer.retrieve")
+    def test_invalidated_on_save(self, RetrieveMock):
+        with cache.unit_of_work():
+            self.customer.stripe_customer
+            self.customer.save()
+            self.customer.stripe_customer
+        self.assertEquals(RetrieveMock.call_count, 2)
+
+    @patch("stripe.Customer.retrieve")
+    def test_subscription_save_invalidates_customer(self, RetrieveMock):
+        subscription = Subscription.objects.create(
+            stripe_id="sub_7Q4BX0HMfqTpN8",
+            customer=self.customer,
+            plan=self.plan,
+            quantity=1,
+            status="active",
+            start=timezone.now()
+        )
+        with cache.unit_of_work():
+            subscription.stripe_subscription
+            subscription.stripe_subscription
+            self.assertEquals(RetrieveMock.call_count, 1)
+            subscription.status = "past_due"
+            subscription.save()
+            subscription.stripe_subscription
+        self.assertEquals(RetrieveMock.call_count, 2)
+
+    @patch("stripe.Customer.retrieve")
+    def test_bulk_upsert_invalidates_changed_objects(self, RetrieveMock):
+        with cache.unit_of_work():
+            self.customer.stripe_customer
+            bulk_upsert(Customer.objects, {self.customer.stripe_id: {"delinquent": False}})
+            self.customer.stripe_customer
+            self.assertEquals(RetrieveMock.call_count, 1)
+            bulk_upsert(Customer.objects, {self.customer.stripe_id: {"delinquent": True}})
+            self.customer.stripe_customer
+        self.assertEquals(RetrieveMock.call_count, 2)
+
+    def test_customer_remembered_per_unit_of_work(self):
+        with self.assertNumQueries(1):
+            with cache.unit_of_work():
+                first = cache.customer(self.customer.stripe_id)
+                second = cache.customer(self.customer.stripe_id)
+        self.assertIs(first, second)
+        with self.assertNumQueries(2):
+            cache.customer(self.customer.stripe_id)
+            cache.customer(self.customer.stripe_id)
+
+    def test_customer_least_recently_used_dropped(self):
+        other = Customer.objects.create(stripe_id="cus_yyyyyyyyyyyyyyy")
+        with patch.object(cache, "CUSTOMER_CACHE_SIZE", 1):
+            with cache.unit_of_work():
+                cache.customer(self.customer.stripe_id)
+                cache.customer(other.stripe_id)
+                with self.assertNumQueries(1):
+                    cache.customer(self.customer.stripe_id)
+                    cache.customer(self.customer.stripe_id)
+
+    def test_customer_missing(self):
+        with cache.unit_of_work():
+            with self.assertRaises(Customer.DoesNotExist):
+                cache.customer("cus_missing")
+
+    def test_customer_dropped_on_save(self):
+        with cache.unit_of_work():
+            first = cache.customer(self.customer.stripe_id)
+            first.save()
+            self.assertIsNot(cache.customer(self.customer.stripe_id), first)
+
+
+class PksTests(TestCase):
+
+    def setUp(self):
+        self.plan = Plan.objects.create(stripe_id="pro2", interval="month", interval_count=1, amount=decimal.Decimal("19.99"))
+
+    def test_pks_cached(self):
+        with self.assertNumQueries(1):
+            self.assertEquals(cache.pks(Plan, ["pro2", "missing"]), {"pro2": self.plan.pk})
+        with self.assertNumQueries(0):
+            self.assertEquals(cache.pks(Plan, ["pro2"]), {"pro2": self.plan.pk})
+        # Unknown Stripe IDs are looked up again as they may have been synced since
+        with self.assertNumQueries(1):
+            cache.pks(Plan, ["pro2", "missing"])
+
+    def test_clear_pks(self):
+        cache.pks(Plan, ["pro2"])
+        cache.clear_pks(Plan)
+        with self.assertNumQueries(1):
+            cache.pks(Plan, ["pro2"])
+
+    def test_cleared_on_save(self):
+        cache.pks(Plan, ["pro2"])
+        self.plan.save()
+        with self.assertNumQueries(1):
+            cache.pks(Plan, ["pro2"])
+
+
+@patch("django.db.transaction.on_commit", create=True, side_effect=lambda func: func())
+class EventReceivedTests(TestCase):
+
+    @override_settings(PINAX_STRIPE_WEBHOOK_DEDUPE_CACHE=None)
+    def test_not_remembered_by_default(self, OnCommitMock):
+        cache.remember_event("evt_1")
+        self.assertFalse(cache.event_received("evt_1"))
+
+    @override_settings(PINAX_STRIPE_WEBHOOK_DEDUPE_CACHE="memory")
+    def test_memory(self, OnCommitMock):
+        self.addCleanup(cache.forget_event, "evt_1")
+        self.assertFalse(cache.event_received("evt_1"))
+        self.assertFalse(cache.event_received("evt_1"))
+        cache.remember_event("evt_1")
+        self.assertTrue(cache.event_received("evt_1"))
+        cache.forget_event("evt_1")
+        self.assertFalse(cache.event_received("evt_1"))
+
+    @override_settings(PINAX_STRIPE_WEBHOOK_DEDUPE_CACHE="memory")
+    def test_memory_least_recently_used_dropped(self, OnCommitMock):
+        with patch.object(cache, "EVENT_CACHE_SIZE", 1):
+            with patch.object(cache, "_events", cache.collections.OrderedDict()):
+                cache.remember_event("evt_1")
+                cache.remember_event("evt_2")
+                self.assertFalse(cache.event_received("evt_1"))
+                self.assertTrue(cache.event_received("evt_2"))
+
+    @override_settings(PINAX_STRIPE_WEBHOOK_DEDUPE_CACHE="memory")
+    def test_remembered_on_commit(self, OnCommitMock):
+        self.addCleanup(cache.forget_event, "evt_1")
+        OnCommitMock.side_effect = None
+        cache.remember_event("evt_1")
+        self.assertFalse(cache.event_received("evt_1"))
+        OnCommitMock.call_args[0][0]()
+        self.assertTrue(cache.event_received("evt_1"))
+
+    @override_settings(
+        PINAX_STRIPE_WEBHOOK_DEDUPE_CACHE="default",
+        CACHES={"default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"}}
+    )
+    def test_django_cache(self, OnCommitMock):
+        self.addCleanup(cache.forget_event, "evt_1")
+        self.assertFalse(cache.event_received("evt_1"))
+        cache.remember_event("evt_1")
+        self.assertTrue(cache.event_received("evt_1"))
+        cache.forget_event("evt_1")
+        self.assertFalse(cache.event_received("evt_1"))
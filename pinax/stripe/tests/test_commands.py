@@ -1,14 +1,46 @@
+import datetime
 import decimal
+import gzip
+import json
+import os
+import shutil
+import tempfile
 
 from django.core import management
 from django.test import TestCase
+from django.utils import timezone
 
 from django.contrib.auth import get_user_model
-from stripe.error import InvalidRequestError
+from stripe.error import APIConnectionError, InvalidRequestError
 
 from mock import patch
 
-from ..models import Customer, Plan, Coupon
+from ..models import Checkpoint, Customer, Coupon, Event, EventProcessingException, Plan, Transfer
+
+
+class SynchronousPool(object):
+
+    def __init__(self, workers):
+        self.workers = workers
+
+    def imap(self, func, iterable):
+        return (func(item) for item in iterable)
+
+    def terminate(self):
+        return
+
+
+class SynchronousWorker(object):
+
+    def __init__(self, target, args):
+        self.target = target
+        self.args = args
+
+    def start(self):
+        self.target(*self.args)
+
+    def join(self):
+        return
 
 
 class CommandTests(TestCase):
@@ -161,3 +193,208 @@ class CommandTests(TestCase):
         self.assertEqual(SyncChargesMock.call_count, 1)
         self.assertEqual(SyncInvoicesMock.call_count, 1)
         self.assertEqual(SyncMock.call_count, 1)
+
+    @patch("pinax.stripe.actions.rollups.rebuild")
+    def test_rebuild_rollups(self, RebuildMock):
+        RebuildMock.return_value = (1, 2)
+        management.call_command("rebuild_rollups")
+        self.assertTrue(RebuildMock.called)
+
+    def test_prune_events(self):
+        old = timezone.now() - datetime.timedelta(days=40)
+        for stripe_id, kind, processed, valid in [
+            ("evt_processed", "charge.succeeded", True, True),
+            ("evt_invalid", "charge.succeeded", False, False),
+            ("evt_pending", "charge.succeeded", False, None),
+            ("evt_transfer", "transfer.created", True, True),
+            ("evt_customer", "customer.updated", True, True),
+        ]:
+            Event.objects.create(stripe_id=stripe_id, kind=kind, processed=processed, valid=valid, webhook_message={"id": stripe_id}, created_at=old)
+        Event.objects.create(stripe_id="evt_recent", kind="charge.succeeded", processed=True, webhook_message={})
+        Transfer.objects.create(stripe_id="tr_1", event=Event.objects.get(stripe_id="evt_transfer"), amount=decimal.Decimal("1"), status="paid", date=old)
+        EventProcessingException.objects.create(event=Event.objects.get(stripe_id="evt_invalid"), data="", message="Invalid", traceback="", created_at=old)
+        EventProcessingException.objects.create(data="", message="Orphan", traceback="", created_at=old)
+        archive = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, archive)
+        management.call_command("prune_events", days=30, kind=["customer.updated=60"], batch_size=1, archive=archive)
+        self.assertEqual(
+            sorted(Event.objects.values_list("stripe_id", flat=True)),
+            ["evt_customer", "evt_pending", "evt_recent", "evt_transfer"]
+        )
+        self.assertFalse(EventProcessingException.objects.exists())
+        with gzip.open(os.path.join(archive, os.listdir(archive)[0]), "rb") as f:
+            rows = [json.loads(line.decode("utf-8")) for line in f]
+        self.assertEqual(
+            [(row["model"], row.get("stripe_id") or row.get("message")) for row in rows],
+            [
+                ("pinax_stripe.event", "evt_processed"),
+                ("pinax_stripe.eventprocessingexception", "Invalid"),
+                ("pinax_stripe.event", "evt_invalid"),
+                ("pinax_stripe.eventprocessingexception", "Orphan"),
+            ]
+        )
+        self.assertEqual(rows[0]["webhook_message"], {"id": "evt_processed"})
+
+    def test_prune_events_requires_policy(self):
+        with self.assertRaises(management.CommandError):
+            management.call_command("prune_events")
+        with self.assertRaises(management.CommandError):
+            management.call_command("prune_events", kind=["customer.updated"])
+
+    @patch("pinax.stripe.actions.events.catch_up")
+    def test_catch_up_events(self, CatchUpMock):
+        CatchUpMock.return_value = []
+        management.call_command("catch_up_events", since="1500000000")
+        CatchUpMock.assert_called_once_with(since=datetime.datetime(2017, 7, 14, 2, 40, tzinfo=timezone.utc))
+
+    def test_catch_up_events_since_invalid(self):
+        with self.assertRaises(management.CommandError):
+            management.call_command("catch_up_events", since="yesterday")
+
+    @patch("pinax.stripe.actions.plans.sync_plans")
+    @patch("pinax.stripe.actions.invoices.sync_invoices_from_stripe_data")
+    @patch("pinax.stripe.actions.charges.sync_charges_from_stripe_data")
+    @patch("pinax.stripe.actions.subscriptions.sync_account_subscriptions_from_stripe_data")
+    @patch("pinax.stripe.actions.customers.sync_customers_from_stripe_data")
+    @patch("stripe.Invoice.list", create=True)
+    @patch("stripe.Charge.list", create=True)
+    @patch("stripe.Subscription.list", create=True)
+    @patch("stripe.Customer.list", create=True)
+    def test_sync_all(self, CustomerListMock, SubscriptionListMock, ChargeListMock, InvoiceListMock, SyncCustomersMock, SyncSubscriptionsMock, SyncChargesMock, SyncInvoicesMock, SyncPlansMock):
+        CustomerListMock.side_effect = [
+            {"data": [{"id": "cus_1"}], "has_more": True},
+            {"data": [{"id": "cus_2"}], "has_more": False}
+        ]
+        SubscriptionListMock.return_value = {"data": [{"id": "sub_1"}], "has_more": False}
+        ChargeListMock.return_value = {"data": [{"id": "ch_1"}], "has_more": False}
+        InvoiceListMock.return_value = {"data": [], "has_more": False}
+        management.call_command("sync_all")
+        self.assertTrue(SyncPlansMock.called)
+        self.assertEqual(SyncCustomersMock.call_count, 2)
+        CustomerListMock.assert_called_with(limit=100, starting_after="cus_1")
+        SubscriptionListMock.assert_called_once_with(limit=100, status="all")
+        SyncSubscriptionsMock.assert_called_once_with([{"id": "sub_1"}])
+        SyncChargesMock.assert_called_once_with([{"id": "ch_1"}])
+        self.assertFalse(SyncInvoicesMock.called)
+
+    @patch("pinax.stripe.management.commands.sync_customers.ThreadPool", SynchronousPool)
+    @patch("pinax.stripe.management.commands.sync_customers.connection")
+    @patch("pinax.stripe.actions.customers.sync_customer")
+    @patch("pinax.stripe.actions.invoices.sync_invoices_for_customer")
+    @patch("pinax.stripe.actions.charges.sync_charges_for_customer")
+    def test_sync_customers_with_workers(self, SyncChargesMock, SyncInvoicesMock, SyncMock, ConnectionMock):
+        user2 = get_user_model().objects.create_user(username="thomas")
+        Customer.objects.create(stripe_id="cus_XXXXX", user=self.user)
+        Customer.objects.create(stripe_id="cus_YYYYY", user=user2)
+        management.call_command("sync_customers", workers=4)
+        self.assertEqual(SyncMock.call_count, 2)
+        # Once per customer, by the worker thread that synced it
+        self.assertEqual(ConnectionMock.close.call_count, 2)
+        self.assertFalse(Checkpoint.objects.filter(name="sync_customers").exists())
+
+    @patch("pinax.stripe.management.commands.sync_customers.connection")
+    @patch("pinax.stripe.actions.customers.sync_customer")
+    @patch("pinax.stripe.actions.invoices.sync_invoices_for_customer")
+    @patch("pinax.stripe.actions.charges.sync_charges_for_customer")
+    def test_sync_customers_without_workers_keeps_connection(self, SyncChargesMock, SyncInvoicesMock, SyncMock, ConnectionMock):
+        Customer.objects.create(stripe_id="cus_XXXXX", user=self.user)
+        management.call_command("sync_customers")
+        self.assertTrue(SyncMock.called)
+        self.assertFalse(ConnectionMock.close.called)
+
+    @patch("pinax.stripe.management.commands.sync_customers.CHUNK_SIZE", 2)
+    @patch("pinax.stripe.actions.customers.sync_customer")
+    @patch("pinax.stripe.actions.invoices.sync_invoices_for_customer")
+    @patch("pinax.stripe.actions.charges.sync_charges_for_customer")
+    def test_sync_customers_in_chunks(self, SyncChargesMock, SyncInvoicesMock, SyncMock):
+        users = [self.user] + [
+            get_user_model().objects.create_user(username="user{0}".format(i))
+            for i in range(4)
+        ]
+        for i, user in enumerate(users):
+            Customer.objects.create(stripe_id="cus_{0}".format(i), user=user)
+        management.call_command("sync_customers")
+        self.assertEqual(
+            [call[0][0].stripe_id for call in SyncMock.call_args_list],
+            ["cus_{0}".format(i) for i in range(5)]
+        )
+        self.assertFalse(Checkpoint.objects.filter(name="sync_customers").exists())
+
+    @patch("pinax.stripe.actions.customers.sync_customer")
+    @patch("pinax.stripe.actions.invoices.sync_invoices_for_customer")
+    @patch("pinax.stripe.actions.charges.sync_charges_for_customer")
+    def test_sync_customers_checkpoints_and_resumes(self, SyncChargesMock, SyncInvoicesMock, SyncMock):
+        user2 = get_user_model().objects.create_user(username="thomas")
+        Customer.objects.create(stripe_id="cus_XXXXX", user=self.user)
+        Customer.objects.create(stripe_id="cus_YYYYY", user=user2)
+        SyncChargesMock.side_effect = [None, ValueError("crash")]
+        with self.assertRaises(ValueError):
+            management.call_command("sync_customers")
+        self.assertEqual(Checkpoint.objects.get(name="sync_customers").value, str(self.user.pk))
+
+        SyncChargesMock.side_effect = None
+        SyncMock.reset_mock()
+        management.call_command("sync_customers", resume=True)
+        SyncMock.assert_called_once_with(user2.customer)
+        self.assertFalse(Checkpoint.objects.filter(name="sync_customers").exists())
+
+    @patch("pinax.stripe.actions.customers.sync_customer")
+    @patch("pinax.stripe.actions.invoices.sync_invoices_for_customer")
+    @patch("pinax.stripe.actions.charges.sync_charges_for_customer")
+    def test_sync_customers_since(self, SyncChargesMock, SyncInvoicesMock, SyncMock):
+        user2 = get_user_model().objects.create_user(username="thomas")
+        user3 = get_user_model().objects.create_user(username="altman")
+        long_ago = timezone.now() - datetime.timedelta(days=30)
+        Customer.objects.create(stripe_id="cus_XXXXX", user=self.user, created_at=long_ago)
+        customer = Customer.objects.create(stripe_id="cus_YYYYY", user=user2, created_at=long_ago)
+        Customer.objects.create(stripe_id="cus_ZZZZZ", user=user3)
+        Event.objects.create(stripe_id="evt_001", kind="customer.updated", customer=customer, webhook_message={})
+        Event.objects.create(stripe_id="evt_002", kind="customer.updated", customer=customer, webhook_message={})
+        since = (timezone.now() - datetime.timedelta(days=1)).date().isoformat()
+        management.call_command("sync_customers", since=since)
+        self.assertEqual(
+            sorted(call[0][0].stripe_id for call in SyncMock.call_args_list),
+            ["cus_YYYYY", "cus_ZZZZZ"]
+        )
+
+    def test_sync_customers_since_invalid(self):
+        with self.assertRaises(management.CommandError):
+            management.call_command("sync_customers", since="last tuesday")
+
+    @patch("multiprocessing.Process", SynchronousWorker)
+    @patch("threading.Thread", SynchronousWorker)
+    @patch("pinax.stripe.actions.events.process_event")
+    def test_process_events(self, ProcessMock):
+        def mark_processed(event):
+            event.processed = event.stripe_id != "evt_002"
+            event.save()
+        ProcessMock.side_effect = mark_processed
+        Event.objects.create(stripe_id="evt_001", kind="account.updated", webhook_message={})
+        Event.objects.create(stripe_id="evt_002", kind="account.updated", webhook_message={})
+        Event.objects.create(stripe_id="evt_003", kind="account.updated", webhook_message={}, valid=False)
+        management.call_command("process_events", workers=2)
+        self.assertEqual(ProcessMock.call_count, 3)
+        self.assertEqual(list(Event.objects.filter(processed=True).values_list("stripe_id", flat=True)), ["evt_001"])
+
+    @patch("threading.Thread", SynchronousWorker)
+    @patch("pinax.stripe.actions.events.process_event")
+    def test_process_events_failure(self, ProcessMock):
+        def process(event):
+            if event.stripe_id == "evt_001":
+                raise APIConnectionError("Could not connect")
+            event.processed = True
+            event.save()
+        ProcessMock.side_effect = process
+        Event.objects.create(stripe_id="evt_001", kind="account.updated", webhook_message={})
+        Event.objects.create(stripe_id="evt_002", kind="account.updated", webhook_message={})
+        management.call_command("process_events")
+        self.assertEqual(ProcessMock.call_count, 2)
+        self.assertEqual(list(Event.objects.filter(processed=True).values_list("stripe_id", flat=True)), ["evt_002"])
+        self.assertEqual(EventProcessingException.objects.get().event.stripe_id, "evt_001")
+
+    @patch("multiprocessing.Process", SynchronousWorker)
+    @patch("pinax.stripe.actions.events.process_event")
+    def test_process_events_with_processes(self, ProcessMock):
+        Event.objects.create(stripe_id="evt_001", kind="account.updated", webhook_message={}, processed=True)
+        management.call_command("process_events", workers=2, processes=True)
+        self.assertFalse(ProcessMock.called)
@@ -208,7 +208,7 @@ class TestEventMethods(TestCase):
         signal = WEBHOOK_SIGNALS.get(kind)
         signal.disconnect(func, **kwargs)
 
-    @patch("pinax.stripe.actions.customers.sync_customer")
+    @patch("pinax.stripe.actions.customers.sync_customer_details")
     @patch("stripe.Event.retrieve")
     @patch("stripe.Customer.retrieve")
     def test_customer_subscription_deleted(self, CustomerMock, EventMock, SyncMock):
@@ -2,10 +2,12 @@ import datetime
 import decimal
 
 from django.test import TestCase
+from django.test.utils import override_settings
 from django.utils import timezone
 
 from django.contrib.auth import get_user_model
 
+from ..actions import rollups
 from ..models import Customer, Subscription, Charge, Plan
 
 
@@ -96,6 +98,32 @@ class CustomerManagerTest(TestCase):
             1
         )
 
+    def test_canceled_during_window(self):
+        self.assertEquals(
+            Customer.objects.canceled_during(
+                start=datetime.datetime(2013, 4, 30, tzinfo=timezone.utc),
+                end=datetime.datetime(2013, 5, 1, tzinfo=timezone.utc)
+            ).count(),
+            1
+        )
+        self.assertEquals(
+            Customer.objects.canceled_during(end=datetime.datetime(2013, 4, 30, tzinfo=timezone.utc)).count(),
+            0
+        )
+
+    def test_plan_summaries_from_rollups(self):
+        expected = [
+            sorted((row["subscription__plan"], row["count"]) for row in Customer.objects.started_plan_summary_for(2013, 1)),
+            sorted((row["subscription__plan"], row["count"]) for row in Customer.objects.canceled_plan_summary_for(2013, 4)),
+        ]
+        rollups.rebuild()
+        with override_settings(PINAX_STRIPE_ROLLUPS=True):
+            with self.assertNumQueries(2):
+                self.assertEquals([
+                    sorted((row["subscription__plan"], row["count"]) for row in Customer.objects.started_plan_summary_for(2013, 1)),
+                    sorted((row["subscription__plan"], row["count"]) for row in Customer.objects.canceled_plan_summary_for(2013, 4)),
+                ], expected)
+
     def test_canceled_all(self):
         self.assertEquals(
             Customer.objects.canceled().count(),
@@ -135,6 +163,11 @@ class CustomerManagerTest(TestCase):
             decimal.Decimal("1") / decimal.Decimal("11")
         )
 
+    def test_churn_no_active(self):
+        Subscription.objects.filter(status="active").delete()
+        with self.assertNumQueries(1):
+            self.assertEquals(Customer.objects.churn(), decimal.Decimal("0"))
+
 
 class ChargeManagerTests(TestCase):
 
@@ -180,6 +213,25 @@ class ChargeManagerTests(TestCase):
         charges = Charge.objects.during(2013, 1)
         self.assertEqual(charges.count(), 3)
 
+    def test_charges_during_window(self):
+        charges = Charge.objects.during(
+            start=datetime.datetime(2013, 1, 1, tzinfo=timezone.utc),
+            end=datetime.datetime(2013, 4, 1, tzinfo=timezone.utc)
+        )
+        self.assertEqual(charges.count(), 3)
+
+    @override_settings(TIME_ZONE="America/New_York")
+    def test_charges_during_current_timezone(self):
+        # ch_4 was created at midnight UTC, still March in New York
+        self.assertEqual(Charge.objects.during(2013, 3).count(), 1)
+        self.assertEqual(Charge.objects.during(2013, 4).count(), 0)
+
+    def test_charges_during_requires_month_or_window(self):
+        with self.assertRaises(ValueError):
+            Charge.objects.during(2013)
+        with self.assertRaises(ValueError):
+            Charge.objects.during()
+
     def test_paid_totals_for_jan(self):
         totals = Charge.objects.paid_totals_for(2013, 1)
         self.assertEqual(totals["total_amount"], decimal.Decimal("200"))
@@ -190,6 +242,18 @@ class ChargeManagerTests(TestCase):
         self.assertEqual(totals["total_amount"], decimal.Decimal("500"))
         self.assertEqual(totals["total_refunded"], decimal.Decimal("15.42"))
 
+    def test_paid_totals_from_rollups(self):
+        expected = [Charge.objects.paid_totals_for(2013, month) for month in (1, 4, 12)]
+        rollups.rebuild()
+        with override_settings(PINAX_STRIPE_ROLLUPS=True):
+            self.assertEqual([Charge.objects.paid_totals_for(2013, month) for month in (1, 4, 12)], expected)
+            with self.assertNumQueries(1):
+                Charge.objects.paid_totals_for(2013, 1)
+            # Windows are not rolled up
+            with self.assertNumQueries(1):
+                Charge.objects.paid_totals_for(start=datetime.datetime(2013, 1, 1, tzinfo=timezone.utc))
+            self.assertEqual(Charge.objects.paid_totals_for(start=datetime.datetime(2013, 4, 1, tzinfo=timezone.utc)), expected[1])
+
     def test_paid_totals_for_dec(self):
         totals = Charge.objects.paid_totals_for(2013, 12)
         self.assertEqual(totals["total_amount"], None)
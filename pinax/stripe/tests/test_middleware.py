@@ -1,4 +1,6 @@
+from django.core.cache import cache
 from django.test import TestCase
+from django.test.utils import override_settings
 from django.utils import timezone
 
 try:
@@ -107,6 +109,16 @@ class ActiveSubscriptionMiddlewareTests(TestCase):
         response = self.middleware.process_request(self.request)
         self.assertIsNone(response)
 
+    @override_settings(PINAX_STRIPE_SUBSCRIPTION_CACHE_TIMEOUT=300)
+    def test_authed_user_verdict_is_cached(self):
+        cache.clear()
+        Customer.objects.create(stripe_id="cus_1", user=self.request.user)
+        self.request.path = "/the/app/"
+        self.middleware.process_request(self.request)
+        with self.assertNumQueries(0):
+            response = self.middleware.process_request(self.request)
+        self.assertEqual(response.status_code, 302)
+
     def test_unauthed_user_passes(self):
         logout(self.request)
         self.request.path = "/the/app/"
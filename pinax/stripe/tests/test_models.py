@@ -3,14 +3,18 @@ from __future__ import unicode_literals
 import datetime
 import decimal
 import sys
+import unittest
 
+from django.db import connection
 from django.test import TestCase
+from django.test.utils import override_settings
 from django.utils import timezone
 
-from mock import patch
+from mock import Mock, patch
 
+from ..actions import events
 from ..models import (
-    Charge, Customer, Event, EventProcessingException, Invoice, InvoiceItem, Plan, Coupon, Subscription
+    Charge, Customer, Event, EventProcessingException, Invoice, InvoiceItem, Plan, Coupon, Subscription, Transfer
 )
 
 
@@ -68,6 +72,17 @@ class ModelTests(TestCase):
         event = Event(validated_message={"foo": 1})
         self.assertEquals(event.validated_message, event.message)
 
+    def test_event_message_compact(self):
+        event = Event(webhook_message={"id": "evt_1", "pending_webhooks": 1, "request": "req_1"})
+        with self.settings(PINAX_STRIPE_EVENT_COMPACT_STORAGE=True):
+            event.message = {"id": "evt_1", "pending_webhooks": 0}
+        self.assertIsNone(event.validated_message)
+        self.assertEquals(event.validated_diff, {"set": {"pending_webhooks": 0}, "unset": ["request"]})
+        self.assertEquals(event.message, {"id": "evt_1", "pending_webhooks": 0})
+        event.message = {"id": "evt_1"}
+        self.assertEquals(event.validated_message, {"id": "evt_1"})
+        self.assertIsNone(event.validated_diff)
+
     def test_invoice_status(self):
         self.assertEquals(Invoice(paid=True).status, "Paid")
 
@@ -95,6 +110,34 @@ class ModelTests(TestCase):
         self.assertEquals(sub.quantity, 0)
         self.assertEquals(sub.amount, 0)
 
+    def test_customer_subscription_summary(self):
+        pro = Plan.objects.create(stripe_id="pro2", amount=decimal.Decimal("100"), interval="monthly", interval_count=1)
+        basic = Plan.objects.create(stripe_id="basic", amount=decimal.Decimal("10"), interval="monthly", interval_count=1)
+        customer = Customer.objects.create(stripe_id="foo")
+        now = timezone.now()
+        ended = now - datetime.timedelta(days=3)
+        Subscription.objects.create(stripe_id="sub_1", customer=customer, status="canceled", start=now, plan=pro, quantity=1, ended_at=ended)
+        Subscription.objects.create(stripe_id="sub_2", customer=customer, status="active", start=now, plan=basic, quantity=1, current_period_end=now)
+        sub = Subscription.objects.create(stripe_id="sub_3", customer=customer, status="active", start=now, plan=pro, quantity=1, current_period_end=now + datetime.timedelta(days=30))
+        customer = Customer.objects.get(pk=customer.pk)
+        self.assertEquals(customer.active_subscription_count, 2)
+        self.assertEquals(customer.current_period_end_max, sub.current_period_end)
+        self.assertEquals(customer.subscription_ended_at_max, ended)
+        self.assertEquals(customer.primary_plan, pro)
+        sub.delete()
+        customer = Customer.objects.get(pk=customer.pk)
+        self.assertEquals(customer.active_subscription_count, 1)
+        self.assertEquals(customer.current_period_end_max, now)
+        self.assertEquals(customer.primary_plan, basic)
+
+    def test_event_message_column_type(self):
+        field = Event._meta.get_field("webhook_message")
+        postgresql = Mock(vendor="postgresql", data_types={"TextField": "text"})
+        self.assertEquals(field.db_type(postgresql), "text")
+        with override_settings(PINAX_STRIPE_EVENT_JSONB=True):
+            self.assertEquals(field.db_type(postgresql), "jsonb")
+            self.assertEquals(field.db_type(connection), "text")
+
 
 class StripeObjectTests(TestCase):
 
@@ -117,3 +160,41 @@ class StripeObjectTests(TestCase):
     def test_stripe_subscription(self, RetrieveMock):
         Subscription(customer=Customer(stripe_id="foo")).stripe_subscription
         self.assertTrue(RetrieveMock().subscriptions.retrieve.called)
+
+
+@unittest.skipUnless(connection.vendor == "sqlite", "EXPLAIN QUERY PLAN is specific to SQLite")
+class QueryPlanTests(TestCase):
+    """
+    Checks that the queries the library runs most are answered from an index
+    rather than by scanning the whole table
+    """
+
+    def assertUsesIndex(self, queryset):
+        sql, params = queryset.query.sql_with_params()
+        with connection.cursor() as cursor:
+            cursor.execute("EXPLAIN QUERY PLAN " + sql, params)
+            steps = [row[-1] for row in cursor.fetchall()]
+        for step in steps:
+            self.assertFalse(step.startswith("SCAN"), steps)
+            self.assertIn("USING", step, steps)
+
+    def test_pending_events(self):
+        self.assertUsesIndex(events.pending_events())
+
+    def test_paid_charges_during(self):
+        now = timezone.now()
+        self.assertUsesIndex(Charge.objects.filter(paid=True, charge_created__gte=now, charge_created__lt=now))
+        self.assertUsesIndex(Charge.objects.filter(charge_created__gte=now, charge_created__lt=now))
+
+    def test_invoice_items_for_invoice(self):
+        self.assertUsesIndex(InvoiceItem.objects.filter(invoice_id=1, stripe_id__in=["ii_1", "ii_2"]))
+
+    def test_customer_subscriptions_by_status(self):
+        self.assertUsesIndex(Subscription.objects.filter(customer_id=1, status="active"))
+
+    def test_active_customers(self):
+        self.assertUsesIndex(Customer.objects.active())
+
+    def test_transfers_during(self):
+        now = timezone.now()
+        self.assertUsesIndex(Transfer.objects.filter(date__gte=now, date__lt=now))
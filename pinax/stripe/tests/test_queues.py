@@ -0,0 +1,76 @@
+from django.db import connection
+from django.test import TestCase
+
+from mock import patch
+
+from ..models import Event, EventProcessingException
+from ..queues import InlineEventQueue, ThreadPoolEventQueue
+
+
+class InlineEventQueueTests(TestCase):
+
+    @patch("pinax.stripe.actions.events.process_event")
+    def test_enqueue_processes_immediately(self, ProcessMock):
+        event = Event.objects.create(stripe_id="evt_001", kind="account.updated", webhook_message={})
+        InlineEventQueue().enqueue(event)
+        ProcessMock.assert_called_once_with(event)
+
+
+class ThreadPoolEventQueueTests(TestCase):
+
+    def setUp(self):
+        self.queue = ThreadPoolEventQueue(workers=2)
+        self.event = Event.objects.create(stripe_id="evt_001", kind="account.updated", webhook_message={})
+
+    def test_workers_default_to_setting(self):
+        self.assertEquals(ThreadPoolEventQueue().workers, 4)
+
+    @patch("django.db.transaction.on_commit", create=True)
+    @patch("pinax.stripe.queues.ThreadPoolEventQueue.start")
+    def test_enqueue_defers_until_commit(self, StartMock, OnCommitMock):
+        self.queue.enqueue(self.event)
+        self.assertTrue(StartMock.called)
+        self.assertTrue(self.queue.queue.empty())
+        OnCommitMock.call_args[0][0]()
+        self.assertEquals(self.queue.queue.get_nowait(), self.event.pk)
+
+    @patch("pinax.stripe.queues.connection")
+    @patch("pinax.stripe.actions.events.process_event")
+    def test_process(self, ProcessMock, ConnectionMock):
+        self.queue.process(self.event.pk)
+        ProcessMock.assert_called_once_with(self.event)
+        self.assertTrue(ConnectionMock.close.called)
+
+    @patch("pinax.stripe.queues.connection")
+    @patch("pinax.stripe.actions.events.process_event")
+    def test_process_exception_is_logged(self, ProcessMock, ConnectionMock):
+        ProcessMock.side_effect = ValueError("boom")
+        self.queue.process(self.event.pk)
+        self.assertTrue(EventProcessingException.objects.filter(event=self.event, message="boom").exists())
+        self.assertTrue(ConnectionMock.close.called)
+
+    @patch("pinax.stripe.queues.connection")
+    @patch("pinax.stripe.actions.events.process_event")
+    def test_process_skips_processed(self, ProcessMock, ConnectionMock):
+        # e.g. process_events claimed it first
+        Event.objects.filter(pk=self.event.pk).update(processed=True)
+        self.queue.process(self.event.pk)
+        self.assertFalse(ProcessMock.called)
+        self.assertTrue(ConnectionMock.close.called)
+
+    @patch("pinax.stripe.queues.connection")
+    @patch("pinax.stripe.actions.events.process_event")
+    def test_process_claims_event(self, ProcessMock, ConnectionMock):
+        with patch.object(connection.features, "has_select_for_update", True):
+            with patch("django.db.models.query.QuerySet.select_for_update", autospec=True, side_effect=lambda qs, **kwargs: qs) as LockMock:
+                self.queue.process(self.event.pk)
+        self.assertTrue(LockMock.called)
+        ProcessMock.assert_called_once_with(self.event)
+
+    @patch("threading.Thread")
+    def test_start_tops_up_workers(self, ThreadMock):
+        ThreadMock.return_value.is_alive.return_value = True
+        self.queue.start()
+        self.queue.start()
+        self.assertEquals(ThreadMock.call_count, 2)
+        self.assertTrue(ThreadMock.return_value.start.called)
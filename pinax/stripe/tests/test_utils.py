@@ -1,10 +1,31 @@
 import datetime
 import decimal
+import hashlib
+import hmac
+import time
 
 from django.test import TestCase
 from django.utils import timezone
 
-from ..utils import convert_tstamp, convert_amount_for_api, convert_amount_for_db
+from mock import Mock, patch
+
+from ..models import Event, Plan
+from ..utils import (
+    RateLimitedHttpClient,
+    RateLimiter,
+    apply_message_diff,
+    bulk_upsert,
+    compact_events,
+    iter_pages,
+    convert_tstamp,
+    convert_amount_for_api,
+    convert_amount_for_db,
+    during_filter,
+    message_diff,
+    month_range,
+    update_with_defaults,
+    verify_webhook_signature
+)
 
 
 class TestTimestampConversion(TestCase):
@@ -38,6 +59,30 @@ class TestTimestampConversion(TestCase):
         )
 
 
+class MonthRangeTests(TestCase):
+
+    def test_month_range(self):
+        self.assertEquals(month_range(2016, 2), (
+            datetime.datetime(2016, 2, 1, tzinfo=timezone.utc),
+            datetime.datetime(2016, 3, 1, tzinfo=timezone.utc)
+        ))
+
+    def test_month_range_december(self):
+        self.assertEquals(month_range(2016, 12)[1], datetime.datetime(2017, 1, 1, tzinfo=timezone.utc))
+
+    def test_during_filter(self):
+        start = datetime.datetime(2016, 2, 1, tzinfo=timezone.utc)
+        self.assertEquals(during_filter("date", start=start), {"date__gte": start})
+        self.assertEquals(during_filter("date", 2016, 2), {
+            "date__gte": start,
+            "date__lt": datetime.datetime(2016, 3, 1, tzinfo=timezone.utc)
+        })
+
+    def test_during_filter_month_and_window(self):
+        with self.assertRaises(ValueError):
+            during_filter("date", 2016, 2, start=datetime.datetime(2016, 2, 1, tzinfo=timezone.utc))
+
+
 class ConvertAmountForDBTests(TestCase):
 
     def test_convert_amount_for_db(self):
@@ -72,3 +117,261 @@ class ConvertAmountForApiTests(TestCase):
         expected = 999
         actual = convert_amount_for_api(decimal.Decimal("9.99"), currency=None)
         self.assertEquals(expected, actual)
+
+
+def sign(payload, secret, timestamp):
+    if not isinstance(payload, bytes):
+        payload = payload.encode("utf-8")
+    signature = hmac.new(
+        secret.encode("utf-8"),
+        "{0}.".format(timestamp).encode("utf-8") + payload,
+        hashlib.sha256
+    ).hexdigest()
+    return "t={0},v1={1}".format(timestamp, signature)
+
+
+class VerifyWebhookSignatureTests(TestCase):
+
+    def setUp(self):
+        self.payload = '{"id": "evt_001"}'
+        self.now = int(time.time())
+
+    def test_valid_signature(self):
+        header = sign(self.payload, "whsec_123", self.now)
+        self.assertTrue(verify_webhook_signature(self.payload, header, "whsec_123", tolerance=300))
+
+    def test_non_ascii_payload(self):
+        payload = u'{"id": "evt_001", "description": "Caf\u00e9 \u2603"}'.encode("utf-8")
+        header = sign(payload, "whsec_123", self.now)
+        self.assertTrue(verify_webhook_signature(payload, header, "whsec_123", tolerance=300))
+        self.assertFalse(verify_webhook_signature(payload.replace(b"Caf", b"caf"), header, "whsec_123"))
+
+    def test_one_of_several_signatures_matches(self):
+        header = sign(self.payload, "whsec_123", self.now) + ",v1=deadbeef"
+        self.assertTrue(verify_webhook_signature(self.payload, header, "whsec_123"))
+
+    def test_wrong_secret(self):
+        header = sign(self.payload, "whsec_456", self.now)
+        self.assertFalse(verify_webhook_signature(self.payload, header, "whsec_123"))
+
+    def test_tampered_payload(self):
+        header = sign(self.payload, "whsec_123", self.now)
+        self.assertFalse(verify_webhook_signature('{"id": "evt_002"}', header, "whsec_123"))
+
+    def test_expired_timestamp(self):
+        header = sign(self.payload, "whsec_123", self.now - 301)
+        self.assertFalse(verify_webhook_signature(self.payload, header, "whsec_123", tolerance=300))
+
+    def test_invalid_timestamp(self):
+        self.assertFalse(verify_webhook_signature(self.payload, "t=abc,v1=deadbeef", "whsec_123", tolerance=300))
+
+    def test_missing_header(self):
+        self.assertFalse(verify_webhook_signature(self.payload, None, "whsec_123"))
+
+    def test_missing_secret(self):
+        header = sign(self.payload, "whsec_123", self.now)
+        self.assertFalse(verify_webhook_signature(self.payload, header, None))
+
+
+class UpsertTests(TestCase):
+
+    def row(self, name="Pro", amount="9.99"):
+        return dict(
+            amount=decimal.Decimal(amount),
+            currency="usd",
+            interval="month",
+            interval_count=1,
+            name=name
+        )
+
+    def test_update_with_defaults_skips_unchanged(self):
+        plan = Plan.objects.create(stripe_id="pro", **self.row())
+        with self.assertNumQueries(0):
+            update_with_defaults(plan, self.row(), False)
+
+    def test_update_with_defaults_writes_changed(self):
+        plan = Plan.objects.create(stripe_id="pro", **self.row())
+        with self.assertNumQueries(1):
+            update_with_defaults(plan, self.row(name="Pro Plus"), False)
+        self.assertEquals(Plan.objects.get(stripe_id="pro").name, "Pro Plus")
+
+    def test_bulk_upsert_creates(self):
+        plans = bulk_upsert(Plan.objects, {"pro": self.row(), "basic": self.row("Basic", "4.99")})
+        self.assertEquals(Plan.objects.count(), 2)
+        self.assertEquals(plans["basic"].amount, decimal.Decimal("4.99"))
+        self.assertIsNotNone(plans["basic"].pk)
+
+    def test_bulk_upsert_updates_only_changed(self):
+        Plan.objects.create(stripe_id="pro", **self.row())
+        Plan.objects.create(stripe_id="basic", **self.row("Basic", "4.99"))
+        with self.assertNumQueries(2):
+            plans = bulk_upsert(Plan.objects, {
+                "pro": self.row(),
+                "basic": self.row("Basic", "5.99")
+            })
+        self.assertEquals(len(plans), 2)
+        self.assertEquals(Plan.objects.get(stripe_id="basic").amount, decimal.Decimal("5.99"))
+
+    def test_bulk_upsert_creates_and_updates(self):
+        Plan.objects.create(stripe_id="pro", **self.row())
+        plans = bulk_upsert(Plan.objects, {
+            "pro": self.row("Pro Plus"),
+            "team": self.row("Team", "19.99")
+        })
+        self.assertEquals(plans["pro"].name, "Pro Plus")
+        self.assertEquals(Plan.objects.get(stripe_id="pro").name, "Pro Plus")
+        self.assertEquals(Plan.objects.get(stripe_id="team").name, "Team")
+
+    def test_bulk_upsert_unchanged(self):
+        Plan.objects.create(stripe_id="pro", **self.row())
+        with self.assertNumQueries(1):
+            bulk_upsert(Plan.objects, {"pro": self.row()})
+
+    def test_bulk_upsert_updates_many_in_one_query(self):
+        for i in range(5):
+            Plan.objects.create(stripe_id="plan{0}".format(i), **self.row("Plan {0}".format(i)))
+        with self.assertNumQueries(2):
+            bulk_upsert(Plan.objects, dict(
+                ("plan{0}".format(i), self.row("Plan {0}".format(i), "1{0}.99".format(i)))
+                for i in range(5)
+            ))
+        self.assertEquals(
+            list(Plan.objects.order_by("stripe_id").values_list("amount", flat=True)),
+            [decimal.Decimal("1{0}.99".format(i)) for i in range(5)]
+        )
+
+    def test_bulk_upsert_updates_once_per_set_of_changed_fields(self):
+        for i in range(4):
+            Plan.objects.create(stripe_id="plan{0}".format(i), **self.row())
+        with self.assertNumQueries(4):
+            plans = bulk_upsert(Plan.objects, {
+                "plan0": self.row("Pro Plus"),
+                "plan1": self.row("Pro Max"),
+                "plan2": self.row(amount="19.99"),
+                "plan3": self.row("Team", "29.99")
+            })
+        self.assertEquals(len(plans), 4)
+        self.assertEquals(
+            list(Plan.objects.order_by("stripe_id").values_list("name", "amount")),
+            [
+                ("Pro Plus", decimal.Decimal("9.99")),
+                ("Pro Max", decimal.Decimal("9.99")),
+                ("Pro", decimal.Decimal("19.99")),
+                ("Team", decimal.Decimal("29.99")),
+            ]
+        )
+
+    def test_bulk_upsert_updates_json(self):
+        Plan.objects.create(stripe_id="pro", **self.row())
+        Plan.objects.create(stripe_id="team", **self.row())
+        bulk_upsert(Plan.objects, {
+            "pro": dict(self.row(), metadata={"tier": "1"}),
+            "team": dict(self.row(), metadata={"tier": "2"})
+        })
+        self.assertEquals(Plan.objects.get(stripe_id="team").metadata, {"tier": "2"})
+
+    def test_bulk_upsert_updates_in_batches(self):
+        for i in range(3):
+            Plan.objects.create(stripe_id="plan{0}".format(i), **self.row())
+        with patch("django.db.backends.base.operations.BaseDatabaseOperations.bulk_batch_size", return_value=2):
+            with patch("django.db.backends.sqlite3.operations.DatabaseOperations.bulk_batch_size", return_value=2):
+                with self.assertNumQueries(3):
+                    bulk_upsert(Plan.objects, dict(
+                        ("plan{0}".format(i), self.row("Plan {0}".format(i))) for i in range(3)
+                    ))
+        self.assertEquals(
+            list(Plan.objects.order_by("stripe_id").values_list("name", flat=True)),
+            ["Plan 0", "Plan 1", "Plan 2"]
+        )
+
+    def test_bulk_upsert_on_conflict(self):
+        # SQLite understands the same INSERT ... ON CONFLICT ... RETURNING
+        Plan.objects.create(stripe_id="pro", **self.row())
+        with patch("pinax.stripe.utils._can_upsert", return_value=True):
+            with patch.object(Plan.objects, "filter", return_value=Plan.objects.none()):
+                plans = bulk_upsert(Plan.objects, {
+                    "pro": self.row("Pro Plus"),
+                    "team": self.row("Team", "19.99")
+                })
+        self.assertEquals(Plan.objects.count(), 2)
+        self.assertEquals(plans["pro"].pk, Plan.objects.get(stripe_id="pro").pk)
+        self.assertEquals(plans["team"].pk, Plan.objects.get(stripe_id="team").pk)
+        self.assertEquals(Plan.objects.get(stripe_id="pro").name, "Pro Plus")
+
+
+class MessageDiffTests(TestCase):
+
+    def test_identical(self):
+        self.assertEquals(message_diff({"id": "evt_1"}, {"id": "evt_1"}), {})
+
+    def test_round_trip(self):
+        original = {"id": "evt_1", "data": {"object": {"id": "ch_1"}}, "request": "req_1"}
+        changed = {"id": "evt_1", "data": {"object": {"id": "ch_1", "paid": True}}, "pending_webhooks": 0}
+        diff = message_diff(original, changed)
+        self.assertEquals(sorted(diff["set"]), ["data", "pending_webhooks"])
+        self.assertEquals(diff["unset"], ["request"])
+        self.assertEquals(apply_message_diff(original, diff), changed)
+        self.assertEquals(original["request"], "req_1")
+
+    def test_compact_events(self):
+        Event.objects.create(stripe_id="evt_1", webhook_message={"id": "evt_1", "pending_webhooks": 1}, validated_message={"id": "evt_1", "pending_webhooks": 0})
+        Event.objects.create(stripe_id="evt_2", webhook_message={"id": "evt_2"}, validated_message={"id": "evt_2"})
+        Event.objects.create(stripe_id="evt_3", webhook_message={"id": "evt_3"})
+        self.assertEquals(compact_events(Event, batch_size=1), 2)
+        events = dict((event.stripe_id, event) for event in Event.objects.all())
+        self.assertIsNone(events["evt_1"].validated_message)
+        self.assertEquals(events["evt_1"].validated_diff, {"set": {"pending_webhooks": 0}})
+        self.assertEquals(events["evt_1"].message, {"id": "evt_1", "pending_webhooks": 0})
+        self.assertEquals(events["evt_2"].message, {"id": "evt_2"})
+        self.assertIsNone(events["evt_3"].message)
+        self.assertEquals(compact_events(Event), 0)
+
+
+class RateLimiterTests(TestCase):
+
+    @patch("time.sleep")
+    @patch("time.time")
+    def test_wait_spaces_out_calls(self, TimeMock, SleepMock):
+        TimeMock.return_value = 100.0
+        limiter = RateLimiter(4)
+        limiter.wait()
+        self.assertFalse(SleepMock.called)
+        limiter.wait()
+        SleepMock.assert_called_once_with(0.25)
+
+    def test_http_client_waits_before_requests(self):
+        client = Mock(name="client")
+        limiter = Mock()
+        wrapped = RateLimitedHttpClient(client, limiter)
+        wrapped.request("get", "https://api.stripe.com/v1/customers", {})
+        self.assertTrue(limiter.wait.called)
+        client.request.assert_called_once_with("get", "https://api.stripe.com/v1/customers", {})
+        self.assertEquals(wrapped.name, client.name)
+
+
+class IterPagesTests(TestCase):
+
+    def test_iter_pages(self):
+        resource = Mock()
+        resource.list.side_effect = [
+            {"data": [{"id": "cus_1"}, {"id": "cus_2"}], "has_more": True},
+            {"data": [{"id": "cus_3"}], "has_more": False}
+        ]
+        pages = list(iter_pages(resource, limit=2, status="all"))
+        self.assertEquals(pages, [[{"id": "cus_1"}, {"id": "cus_2"}], [{"id": "cus_3"}]])
+        resource.list.assert_called_with(limit=2, starting_after="cus_2", status="all")
+
+    def test_iter_pages_without_list(self):
+        # As with stripe<1.28
+        resource = Mock(spec=["all"])
+        resource.all.side_effect = [
+            {"data": [{"id": "cus_1"}], "has_more": True},
+            {"data": [{"id": "cus_2"}], "has_more": False}
+        ]
+        self.assertEquals(list(iter_pages(resource, limit=1)), [[{"id": "cus_1"}], [{"id": "cus_2"}]])
+        resource.all.assert_called_with(limit=1, starting_after="cus_1")
+
+    def test_iter_pages_empty(self):
+        resource = Mock()
+        resource.list.return_value = {"data": [], "has_more": False}
+        self.assertEquals(list(iter_pages(resource)), [])
@@ -1,11 +1,14 @@
 import decimal
 import json
+import time
 
 import six
 
+from django.core.exceptions import ImproperlyConfigured
 from django.dispatch import Signal
 from django.test import TestCase
 from django.test.client import Client
+from django.test.utils import override_settings
 
 try:
     from django.urls import reverse
@@ -17,8 +20,11 @@ import stripe
 from mock import patch
 
 from . import TRANSFER_CREATED_TEST_DATA, TRANSFER_PENDING_TEST_DATA
-from ..models import Event, Transfer, EventProcessingException, Customer
-from ..webhooks import registry, AccountUpdatedWebhook, ChargeCapturedWebhook, CustomerUpdatedWebhook, CustomerSourceCreatedWebhook, CustomerSourceDeletedWebhook, CustomerSubscriptionCreatedWebhook, InvoiceCreatedWebhook
+from .test_utils import sign
+from ..conf import settings
+from .. import cache
+from ..models import Event, Transfer, EventProcessingException, Customer, Plan
+from ..webhooks import registry, AccountUpdatedWebhook, ChargeCapturedWebhook, ChargeDisputeCreatedWebhook, CustomerUpdatedWebhook, CustomerSourceCreatedWebhook, CustomerSourceDeletedWebhook, CustomerSubscriptionCreatedWebhook, CustomerSubscriptionDeletedWebhook, CustomerSubscriptionUpdatedWebhook, InvoiceCreatedWebhook, PlanUpdatedWebhook
 
 
 class WebhookRegistryTest(TestCase):
@@ -91,7 +97,7 @@ class WebhookTests(TestCase):
         self.assertTrue(Event.objects.filter(kind="transfer.created").exists())
 
     def test_webhook_duplicate_event(self):
-        data = {"id": 123}
+        data = {"id": 123, "type": "account.updated", "livemode": True}
         Event.objects.create(stripe_id=123, livemode=True)
         msg = json.dumps(data)
         resp = Client().post(
@@ -102,6 +108,131 @@ class WebhookTests(TestCase):
         self.assertEquals(resp.status_code, 200)
         self.assertTrue(EventProcessingException.objects.filter(message="Duplicate event record").exists())
 
+    @override_settings(PINAX_STRIPE_WEBHOOK_DEDUPE_CACHE="memory")
+    @patch("django.db.transaction.on_commit", create=True, side_effect=lambda func: func())
+    @patch("pinax.stripe.actions.events.process_event")
+    def test_webhook_duplicate_event_remembered(self, ProcessMock, OnCommitMock):
+        self.addCleanup(cache.forget_event, "evt_remembered")
+        msg = json.dumps({"id": "evt_remembered", "type": "account.updated", "livemode": True})
+        resp = Client().post(reverse("pinax_stripe_webhook"), six.u(msg), content_type="application/json")
+        self.assertEquals(resp.status_code, 200)
+        with self.assertNumQueries(0):
+            resp = Client().post(reverse("pinax_stripe_webhook"), six.u(msg), content_type="application/json")
+        self.assertEquals(resp.status_code, 200)
+        self.assertEquals(ProcessMock.call_count, 1)
+
+    @override_settings(PINAX_STRIPE_WEBHOOK_DEDUPE_CACHE="memory")
+    @patch("django.db.transaction.on_commit", create=True)
+    @patch("pinax.stripe.actions.events.process_event")
+    def test_webhook_not_remembered_until_commit(self, ProcessMock, OnCommitMock):
+        # e.g. the request's transaction is rolled back
+        self.addCleanup(cache.forget_event, "evt_uncommitted")
+        msg = json.dumps({"id": "evt_uncommitted", "type": "account.updated", "livemode": True})
+        Client().post(reverse("pinax_stripe_webhook"), six.u(msg), content_type="application/json")
+        self.assertTrue(OnCommitMock.called)
+        self.assertFalse(cache.event_received("evt_uncommitted"))
+
+    @override_settings(PINAX_STRIPE_WEBHOOK_DEDUPE_CACHE="memory")
+    @patch("django.db.transaction.on_commit", create=True, side_effect=lambda func: func())
+    @patch("pinax.stripe.actions.events.add_event")
+    def test_webhook_failure_not_remembered(self, AddEventMock, OnCommitMock):
+        self.addCleanup(cache.forget_event, "evt_failed")
+        AddEventMock.side_effect = ValueError
+        msg = json.dumps({"id": "evt_failed", "type": "account.updated", "livemode": True})
+        with self.assertRaises(ValueError):
+            Client().post(reverse("pinax_stripe_webhook"), six.u(msg), content_type="application/json")
+        self.assertFalse(cache.event_received("evt_failed"))
+
+    @override_settings(PINAX_STRIPE_WEBHOOK_VALIDATION="signature", PINAX_STRIPE_WEBHOOK_SECRET="whsec_123")
+    @patch("stripe.Event.retrieve")
+    def test_webhook_with_valid_signature(self, StripeEventMock):
+        msg = json.dumps(TRANSFER_CREATED_TEST_DATA)
+        resp = Client().post(
+            reverse("pinax_stripe_webhook"),
+            six.u(msg),
+            content_type="application/json",
+            HTTP_STRIPE_SIGNATURE=sign(msg, "whsec_123", int(time.time()))
+        )
+        self.assertEquals(resp.status_code, 200)
+        self.assertFalse(StripeEventMock.called)
+        event = Event.objects.get(stripe_id=TRANSFER_CREATED_TEST_DATA["id"])
+        self.assertTrue(event.valid)
+        self.assertTrue(event.processed)
+        self.assertEquals(event.validated_message, TRANSFER_CREATED_TEST_DATA)
+
+    @override_settings(PINAX_STRIPE_EVENT_COMPACT_STORAGE=True)
+    @patch("stripe.Event.retrieve")
+    def test_webhook_compact_storage(self, StripeEventMock):
+        StripeEventMock.return_value.to_dict.return_value = dict(TRANSFER_CREATED_TEST_DATA, pending_webhooks=0)
+        msg = json.dumps(TRANSFER_CREATED_TEST_DATA)
+        resp = Client().post(
+            reverse("pinax_stripe_webhook"),
+            six.u(msg),
+            content_type="application/json"
+        )
+        self.assertEquals(resp.status_code, 200)
+        event = Event.objects.get(stripe_id=TRANSFER_CREATED_TEST_DATA["id"])
+        self.assertTrue(event.valid)
+        self.assertTrue(event.processed)
+        self.assertIsNone(event.validated_message)
+        self.assertEquals(event.validated_diff, {"set": {"pending_webhooks": 0}})
+        self.assertEquals(event.message, dict(TRANSFER_CREATED_TEST_DATA, pending_webhooks=0))
+        self.assertTrue(event.transfers.exists())
+
+    @override_settings(PINAX_STRIPE_WEBHOOK_VALIDATION="both", PINAX_STRIPE_WEBHOOK_SECRET="whsec_123")
+    @patch("stripe.Event.retrieve")
+    def test_webhook_with_invalid_signature(self, StripeEventMock):
+        msg = json.dumps(TRANSFER_CREATED_TEST_DATA)
+        resp = Client().post(
+            reverse("pinax_stripe_webhook"),
+            six.u(msg),
+            content_type="application/json",
+            HTTP_STRIPE_SIGNATURE=sign(msg, "whsec_456", int(time.time()))
+        )
+        self.assertEquals(resp.status_code, 400)
+        self.assertFalse(Event.objects.exists())
+        self.assertFalse(EventProcessingException.objects.exists())
+
+    @override_settings(PINAX_STRIPE_WEBHOOK_VALIDATION="signature", PINAX_STRIPE_WEBHOOK_SECRET=None)
+    def test_webhook_signature_without_secret(self):
+        msg = json.dumps(TRANSFER_CREATED_TEST_DATA)
+        with self.assertRaises(ImproperlyConfigured):
+            Client().post(
+                reverse("pinax_stripe_webhook"),
+                six.u(msg),
+                content_type="application/json",
+                HTTP_STRIPE_SIGNATURE=sign(msg, "whsec_123", int(time.time()))
+            )
+
+    @override_settings(PINAX_STRIPE_WEBHOOK_VALIDATION="signature", PINAX_STRIPE_WEBHOOK_SECRET="whsec_123")
+    @patch("pinax.stripe.actions.events.process_event")
+    def test_webhook_with_valid_signature_non_ascii(self, ProcessMock):
+        data = {"id": "evt_non_ascii", "type": "account.updated", "livemode": True, "description": u"Caf\u00e9 \u2603"}
+        body = json.dumps(data, ensure_ascii=False).encode("utf-8")
+        resp = Client().post(
+            reverse("pinax_stripe_webhook"),
+            body,
+            content_type="application/json",
+            HTTP_STRIPE_SIGNATURE=sign(body, "whsec_123", int(time.time()))
+        )
+        self.assertEquals(resp.status_code, 200)
+        self.assertEquals(Event.objects.get(stripe_id="evt_non_ascii").webhook_message, data)
+
+    @override_settings(PINAX_STRIPE_WEBHOOK_VALIDATION="both", PINAX_STRIPE_WEBHOOK_SECRET="whsec_123")
+    @patch("stripe.Event.retrieve")
+    def test_webhook_with_signature_and_retrieve(self, StripeEventMock):
+        StripeEventMock.return_value.to_dict.return_value = TRANSFER_CREATED_TEST_DATA
+        msg = json.dumps(TRANSFER_CREATED_TEST_DATA)
+        resp = Client().post(
+            reverse("pinax_stripe_webhook"),
+            six.u(msg),
+            content_type="application/json",
+            HTTP_STRIPE_SIGNATURE=sign(msg, "whsec_123", int(time.time()))
+        )
+        self.assertEquals(resp.status_code, 200)
+        self.assertTrue(StripeEventMock.called)
+        self.assertTrue(Event.objects.get(stripe_id=TRANSFER_CREATED_TEST_DATA["id"]).valid)
+
     def test_webhook_event_mismatch(self):
         event = Event(kind="account.updated")
         WH = registry.get("account.application.deauthorized")
@@ -152,6 +283,48 @@ class ChargeWebhookTest(TestCase):
         ChargeCapturedWebhook(event).process_webhook()
         self.assertTrue(SyncMock.called)
 
+    @override_settings(PINAX_STRIPE_WEBHOOK_TRUST_PAYLOAD=True)
+    @patch("stripe.Charge.retrieve")
+    @patch("pinax.stripe.actions.charges.sync_charge_from_stripe_data")
+    def test_process_webhook_trusted_payload(self, SyncMock, RetrieveMock):
+        charge = dict(id="ch_XXXXXX", object="charge", source=dict(id="card_XXXXXX"))
+        event = Event.objects.create(kind=ChargeCapturedWebhook.name, webhook_message={}, valid=True, processed=False)
+        event.validated_message = dict(api_version=settings.PINAX_STRIPE_API_VERSION, created=int(time.time()), data=dict(object=charge))
+        ChargeCapturedWebhook(event).process_webhook()
+        SyncMock.assert_called_once_with(charge)
+        self.assertFalse(RetrieveMock.called)
+
+    @override_settings(PINAX_STRIPE_WEBHOOK_TRUST_PAYLOAD=True, PINAX_STRIPE_WEBHOOK_TRUST_PAYLOAD_MAX_AGE=60)
+    @patch("stripe.Charge.retrieve")
+    @patch("pinax.stripe.actions.charges.sync_charge_from_stripe_data")
+    def test_process_webhook_trusted_payload_too_old(self, SyncMock, RetrieveMock):
+        # e.g. a late retry or a replay, which may be older than what is synced
+        charge = dict(id="ch_XXXXXX", object="charge", source=dict(id="card_XXXXXX"))
+        event = Event.objects.create(kind=ChargeCapturedWebhook.name, webhook_message={}, valid=True, processed=False)
+        event.validated_message = dict(api_version=settings.PINAX_STRIPE_API_VERSION, created=int(time.time()) - 61, data=dict(object=charge))
+        ChargeCapturedWebhook(event).process_webhook()
+        RetrieveMock.assert_called_once_with("ch_XXXXXX")
+        SyncMock.assert_called_once_with(RetrieveMock.return_value)
+
+    @override_settings(PINAX_STRIPE_WEBHOOK_TRUST_PAYLOAD=True)
+    @patch("stripe.Charge.retrieve")
+    @patch("pinax.stripe.actions.charges.sync_charge_from_stripe_data")
+    def test_process_webhook_trusted_payload_other_api_version(self, SyncMock, RetrieveMock):
+        charge = dict(id="ch_XXXXXX", object="charge", source=dict(id="card_XXXXXX"))
+        event = Event.objects.create(kind=ChargeCapturedWebhook.name, webhook_message={}, valid=True, processed=False)
+        event.validated_message = dict(api_version="2014-01-31", data=dict(object=charge))
+        ChargeCapturedWebhook(event).process_webhook()
+        RetrieveMock.assert_called_once_with("ch_XXXXXX")
+        SyncMock.assert_called_once_with(RetrieveMock.return_value)
+
+    @patch("stripe.Charge.retrieve")
+    @patch("pinax.stripe.actions.charges.sync_charge_from_stripe_data")
+    def test_process_webhook_dispute(self, SyncMock, RetrieveMock):
+        event = Event.objects.create(kind=ChargeDisputeCreatedWebhook.name, webhook_message={}, valid=True, processed=False)
+        event.validated_message = dict(data=dict(object=dict(id="dp_XXXXXX", object="dispute", charge="ch_XXXXXX")))
+        ChargeDisputeCreatedWebhook(event).process_webhook()
+        RetrieveMock.assert_called_once_with("ch_XXXXXX")
+
 
 class CustomerUpdatedWebhookTest(TestCase):
 
@@ -161,6 +334,15 @@ class CustomerUpdatedWebhookTest(TestCase):
         CustomerUpdatedWebhook(event).process_webhook()
         self.assertTrue(SyncMock.called)
 
+    @override_settings(PINAX_STRIPE_WEBHOOK_TRUST_PAYLOAD=True)
+    @patch("pinax.stripe.actions.customers.sync_customer")
+    def test_process_webhook_trusted_payload(self, SyncMock):
+        cu = dict(id="cus_XXXXXX", sources=dict(data=[]), subscriptions=dict(data=[]))
+        event = Event.objects.create(kind=CustomerUpdatedWebhook.name, webhook_message={}, valid=True, processed=False)
+        event.validated_message = dict(api_version=settings.PINAX_STRIPE_API_VERSION, created=int(time.time()), data=dict(object=cu))
+        CustomerUpdatedWebhook(event).process_webhook()
+        SyncMock.assert_called_once_with(None, cu=cu)
+
 
 class CustomerSourceCreatedWebhookTest(TestCase):
 
@@ -186,7 +368,40 @@ class CustomerSubscriptionCreatedWebhookTest(TestCase):
 
     @patch("stripe.Customer.retrieve")
     @patch("pinax.stripe.actions.customers.sync_customer")
-    def test_process_webhook(self, SyncMock, RetrieveMock):
+    @patch("pinax.stripe.actions.customers.sync_customer_details")
+    def test_process_webhook(self, SyncDetailsMock, SyncMock, RetrieveMock):
+        event = Event.objects.create(kind=CustomerSubscriptionCreatedWebhook.name, customer=Customer.objects.create(), webhook_message={}, valid=True, processed=False)
+        CustomerSubscriptionCreatedWebhook(event).process_webhook()
+        SyncDetailsMock.assert_called_once_with(event.customer, cu=RetrieveMock.return_value)
+        self.assertFalse(SyncMock.called)
+
+    @patch("stripe.Customer.retrieve")
+    @patch("pinax.stripe.actions.subscriptions.sync_subscription_from_stripe_data")
+    @patch("pinax.stripe.actions.customers.sync_customer_details")
+    def test_process_webhook_syncs_current_subscription(self, SyncDetailsMock, SyncSubscriptionMock, RetrieveMock):
+        # e.g. an older event processed after a newer one
+        current = {"id": "sub_1", "status": "active"}
+        RetrieveMock.return_value = {"id": "cus_1", "subscriptions": {"data": [{"id": "sub_2"}, current]}}
+        message = {"data": {"object": {"id": "sub_1", "status": "trialing"}}}
+        event = Event.objects.create(kind=CustomerSubscriptionUpdatedWebhook.name, customer=Customer.objects.create(stripe_id="cus_1"), webhook_message=message, validated_message=message, valid=True, processed=False)
+        CustomerSubscriptionUpdatedWebhook(event).process_webhook()
+        SyncSubscriptionMock.assert_called_once_with(event.customer, current)
+        self.assertEquals(RetrieveMock.call_count, 1)
+
+    @patch("stripe.Customer.retrieve")
+    @patch("pinax.stripe.actions.subscriptions.sync_subscription_from_stripe_data")
+    @patch("pinax.stripe.actions.customers.sync_customer_details")
+    def test_process_webhook_unlisted_subscription(self, SyncDetailsMock, SyncSubscriptionMock, RetrieveMock):
+        RetrieveMock.return_value = {"id": "cus_1", "subscriptions": {"data": []}}
+        message = {"data": {"object": {"id": "sub_1", "status": "canceled"}}}
+        event = Event.objects.create(kind=CustomerSubscriptionDeletedWebhook.name, customer=Customer.objects.create(stripe_id="cus_1"), webhook_message=message, validated_message=message, valid=True, processed=False)
+        CustomerSubscriptionDeletedWebhook(event).process_webhook()
+        SyncSubscriptionMock.assert_called_once_with(event.customer, message["data"]["object"])
+
+    @override_settings(PINAX_STRIPE_SUBSCRIPTION_WEBHOOK_FULL_CUSTOMER_SYNC=True)
+    @patch("stripe.Customer.retrieve")
+    @patch("pinax.stripe.actions.customers.sync_customer")
+    def test_process_webhook_full_customer_sync(self, SyncMock, RetrieveMock):
         event = Event.objects.create(kind=CustomerSubscriptionCreatedWebhook.name, customer=Customer.objects.create(), webhook_message={}, valid=True, processed=False)
         CustomerSubscriptionCreatedWebhook(event).process_webhook()
         self.assertTrue(SyncMock.called)
@@ -208,6 +423,17 @@ class InvoiceCreatedWebhookTest(TestCase):
         self.assertTrue(SyncMock.called)
 
 
+class PlanUpdatedWebhookTest(TestCase):
+
+    def test_process_webhook(self):
+        plan = Plan.objects.create(stripe_id="pro2", interval="month", interval_count=1, amount=decimal.Decimal("19.99"))
+        cache.pks(Plan, ["pro2"])
+        event = Event.objects.create(kind=PlanUpdatedWebhook.name, webhook_message={}, valid=True, processed=False)
+        PlanUpdatedWebhook(event).process_webhook()
+        with self.assertNumQueries(1):
+            self.assertEquals(cache.pks(Plan, ["pro2"]), {"pro2": plan.pk})
+
+
 class TestTransferWebhooks(TestCase):
 
     @patch("stripe.Event.retrieve")
@@ -2,10 +2,26 @@ from __future__ import unicode_literals
 
 import datetime
 import decimal
+import hashlib
+import hmac
+import threading
+import time
 
+from django.db import IntegrityError, connections, transaction
 from django.utils import timezone
+from django.utils.dateparse import parse_date, parse_datetime
 from django.conf import settings
 
+from . import cache
+
+try:
+    from django.db.models import Case, Func, Value, When
+except ImportError:  # Django < 1.8
+    Case = None
+else:
+    class _Cast(Func):
+        template = "CAST(%(expressions)s AS %(db_type)s)"
+
 
 def convert_tstamp(response, field_name=None):
     tz = timezone.utc if settings.USE_TZ else None
@@ -22,6 +38,89 @@ def convert_tstamp(response, field_name=None):
         )
 
 
+def parse_since(value):
+    """
+    Parses the value of a --since style option
+
+    Args:
+        value: a Unix timestamp, an ISO 8601 datetime or an ISO 8601 date
+
+    Returns:
+        an aware datetime, in the current timezone if value did not specify one
+
+    Raises:
+        ValueError: if value cannot be parsed
+    """
+    try:
+        return datetime.datetime.fromtimestamp(int(value), timezone.utc)
+    except ValueError:
+        pass
+    since = parse_datetime(value)
+    if since is None:
+        date = parse_date(value)
+        if date is None:
+            raise ValueError("Could not parse --since value: {0}".format(value))
+        since = datetime.datetime.combine(date, datetime.time())
+    if timezone.is_naive(since):
+        since = timezone.make_aware(since, timezone.get_current_timezone())
+    return since
+
+
+def month_range(year, month):
+    """
+    Returns the half-open range of datetimes covering a month
+
+    Args:
+        year: 4-digit year
+        month: month as a integer, 1=January through 12=December
+
+    Returns:
+        a (start, end) tuple where start is midnight on the first of the
+        month and end is midnight on the first of the next month, in the
+        current timezone
+    """
+    start = datetime.datetime(year, month, 1)
+    end = datetime.datetime(year + month // 12, month % 12 + 1, 1)
+    if settings.USE_TZ:
+        tz = timezone.get_current_timezone()
+        start, end = timezone.make_aware(start, tz), timezone.make_aware(end, tz)
+    return start, end
+
+
+def during_filter(field, year=None, month=None, start=None, end=None):
+    """
+    Returns the filter arguments selecting the rows whose datetime field falls
+    within a month or within a window. They compare the column with a range
+    rather than extracting parts of it, so an index on it can be used.
+
+    Args:
+        field: the name or lookup path of the datetime field
+        year: 4-digit year, together with month
+        month: month as a integer, 1=January through 12=December
+        start: the start of the window, inclusive; None for no lower bound
+        end: the end of the window, exclusive; None for no upper bound
+
+    Returns:
+        a dict of keyword arguments for QuerySet.filter
+
+    Raises:
+        ValueError: unless either both year and month, or start or end, are
+                    given
+    """
+    if year is not None or month is not None:
+        if year is None or month is None or start is not None or end is not None:
+            raise ValueError("Provide either a year and month, or a start and/or end")
+        start, end = month_range(year, month)
+    elif start is None and end is None:
+        raise ValueError("Provide either a year and month, or a start and/or end")
+    filters = {}
+    if start is not None:
+        filters["{0}__gte".format(field)] = start
+    if end is not None:
+        filters["{0}__lt".format(field)] = end
+    return filters
+
+
 # currencies those amount=1 means 100 cents
 # https://support.stripe.com/questions/which-zero-decimal-currencies-does-stripe-support
 ZERO_DECIMAL_CURRENCIES = [
@@ -42,14 +141,375 @@ def convert_amount_for_api(amount, currency="usd"):
     return int(amount * 100) if currency.lower() not in ZERO_DECIMAL_CURRENCIES else int(amount)
 
 
+def changed_fields(obj, defaults):
+    """
+    Returns the names of the fields whose values in defaults differ from the
+    ones on obj. Related objects are compared by primary key so that no
+    extra queries are needed to load them.
+    """
+    changed = []
+    for key, value in defaults.items():
+        field = obj._meta.get_field(key)
+        if field.attname != field.name:
+            current = getattr(obj, field.attname)
+            value = getattr(value, "pk", value)
+        else:
+            current = getattr(obj, key)
+        if current != value:
+            changed.append(key)
+    return changed
+
+
 def update_with_defaults(obj, defaults, created):
     if not created:
-        for key in defaults:
+        changed = changed_fields(obj, defaults)
+        for key in changed:
             setattr(obj, key, defaults[key])
-        obj.save()
+        if changed:
+            obj.save(update_fields=changed)
     return obj
 
 
+_bulk = threading.local()
+
+
+def bulk_upserting():
+    """
+    Returns whether the current thread is writing objects in bulk_upsert, so
+    that post_save receivers can leave work the caller does for the whole
+    batch
+    """
+    return getattr(_bulk, "active", False)
+
+
+def _can_upsert(queryset, key):
+    connection = connections[queryset.db]
+    return (
+        connection.vendor == "postgresql" and
+        connection.pg_version >= 90500 and
+        queryset.model._meta.get_field(key).unique
+    )
+
+
+def _upsert(queryset, rows, objs, key):
+    """
+    Inserts objects with INSERT ... ON CONFLICT DO UPDATE, so that the ones
+    created elsewhere in the meantime are updated by the same statement
+    """
+    model = queryset.model
+    connection = connections[queryset.db]
+    quote = connection.ops.quote_name
+    fields = [field for field in model._meta.concrete_fields if not field.primary_key]
+    updated = set(name for defaults in rows.values() for name in defaults)
+    params = []
+    for obj in objs:
+        params.extend(field.get_db_prep_save(field.pre_save(obj, True), connection) for field in fields)
+    placeholders = "({0})".format(", ".join(["%s"] * len(fields)))
+    sql = "INSERT INTO {table} ({columns}) VALUES {values} ON CONFLICT ({key}) DO UPDATE SET {updates} RETURNING {pk}, {key}".format(
+        table=quote(model._meta.db_table),
+        columns=", ".join(quote(field.column) for field in fields),
+        values=", ".join([placeholders] * len(objs)),
+        key=quote(model._meta.get_field(key).column),
+        updates=", ".join(
+            "{0} = EXCLUDED.{0}".format(quote(field.column))
+            for field in fields if field.name in updated
+        ),
+        pk=quote(model._meta.pk.column)
+    )
+    with connection.cursor() as cursor:
+        cursor.execute(sql, params)
+        pks = dict((value, pk) for pk, value in cursor.fetchall())
+    for obj in objs:
+        obj.pk = pks[getattr(obj, key)]
+    return {getattr(obj, key): obj for obj in objs}
+
+
+def _bulk_create(queryset, rows, objs, key):
+    if _can_upsert(queryset, key):
+        return _upsert(queryset, rows, objs, key)
+    manager = queryset.model._default_manager
+    try:
+        with transaction.atomic():
+            if len(objs) == 1:
+                objs[0].save()
+            else:
+                manager.bulk_create(objs)
+    except IntegrityError:
+        # Some were created elsewhere in the meantime, so go one at a time
+        created = {}
+        for obj in objs:
+            value = getattr(obj, key)
+            obj, was_created = queryset.get_or_create(defaults=rows[value], **{key: value})
+            created[value] = update_with_defaults(obj, rows[value], was_created)
+        return created
+    if objs[0].pk is None:
+        # Not every backend returns primary keys from a bulk insert
+        objs = queryset.filter(**{"{0}__in".format(key): [getattr(obj, key) for obj in objs]})
+    return {getattr(obj, key): obj for obj in objs}
+
+
+def _case(field, objs, connection):
+    case = Case(
+        *[When(pk=obj.pk, then=Value(getattr(obj, field.attname), output_field=field)) for obj in objs],
+        output_field=field
+    )
+    if connection.vendor == "postgresql":
+        # Otherwise a CASE of untyped parameters is text, which is not
+        # assignable to every column type
+        return _Cast(case, db_type=field.db_type(connection), output_field=field)
+    return case
+
+
+def _bulk_save(queryset, changes):
+    """
+    Writes the changed fields back with one UPDATE per set of changed fields,
+    picking each object's value with a CASE on its primary key
+    """
+    if Case is None:
+        for obj, changed in changes.items():
+            obj.save(update_fields=changed)
+        return
+    model = queryset.model
+    connection = connections[queryset.db]
+    groups = {}
+    for obj, changed in changes.items():
+        groups.setdefault(tuple(sorted(changed)), []).append(obj)
+    for names, objs in groups.items():
+        fields = [model._meta.get_field(name) for name in names]
+        # Each object takes a parameter per field for its primary key and one
+        # for its value, and one more in the WHERE clause
+        batch_size = max(connection.ops.bulk_batch_size([None] * (2 * len(fields) + 1), objs), 1)
+        for start in range(0, len(objs), batch_size):
+            batch = objs[start:start + batch_size]
+            model._default_manager.using(queryset.db).filter(pk__in=[obj.pk for obj in batch]).update(**dict(
+                (field.attname, _case(field, batch, connection)) for field in fields
+            ))
+
+
+def bulk_upsert(queryset, rows, key="stripe_id"):
+    """
+    Creates or updates a batch of objects in a constant number of queries
+
+    Existing objects are loaded with a single query and new ones are inserted
+    together, on PostgreSQL with ON CONFLICT DO UPDATE when the key field is
+    unique. Only the fields that actually changed are written back, with one
+    UPDATE for all of the objects sharing the same set of changed fields.
+
+    Args:
+        queryset: the queryset or manager the objects are looked up in
+        rows: a dict of field values for each object keyed by the value of
+              the key field. New objects are created in its order, so pass
+              an OrderedDict where the order matters.
+        key: the name of the field identifying an object
+
+    Returns:
+        a dict of the created or updated objects keyed like rows
+    """
+    objects = {
+        getattr(obj, key): obj
+        for obj in queryset.filter(**{"{0}__in".format(key): list(rows)})
+    }
+    to_create = []
+    changes = {}
+    for value, defaults in rows.items():
+        obj = objects.get(value)
+        if obj is None:
+            to_create.append(queryset.model(**dict(defaults, **{key: value})))
+            continue
+        changed = changed_fields(obj, defaults)
+        for field in changed:
+            setattr(obj, field, defaults[field])
+        if changed:
+            changes[obj] = changed
+    active, _bulk.active = bulk_upserting(), True
+    try:
+        if to_create:
+            created = _bulk_create(queryset, rows, to_create, key)
+            objects.update(created)
+            to_create = list(created.values())
+        if changes:
+            _bulk_save(queryset, changes)
+    finally:
+        _bulk.active = active
+    # Bulk writes do not send post_save
+    for obj in to_create + list(changes):
+        cache.invalidate(obj)
+    return objects
+
+
+def message_diff(original, changed):
+    """
+    Returns the difference between two event messages, at the level of their
+    top level keys
+
+    Args:
+        original: the message the difference is relative to
+        changed: the other message
+
+    Returns:
+        a dict with the values of the keys that were added or changed under
+        "set" and the keys that were removed under "unset", either left out
+        when there are none, so identical messages give an empty dict
+    """
+    diff = {}
+    changes = dict(
+        (key, value) for key, value in changed.items()
+        if key not in original or original[key] != value
+    )
+    removed = sorted(key for key in original if key not in changed)
+    if changes:
+        diff["set"] = changes
+    if removed:
+        diff["unset"] = removed
+    return diff
+
+
+def apply_message_diff(original, diff):
+    """
+    Returns the message the diff was made from with message_diff
+    """
+    message = dict(original)
+    for key in diff.get("unset", []):
+        message.pop(key, None)
+    message.update(diff.get("set", {}))
+    return message
+
+
+def compact_events(model, batch_size=1000):
+    """
+    Replaces the validated message of events by its difference from the
+    webhook message, a batch of events at a time
+
+    Args:
+        model: the Event model, the historical one when run from a migration
+        batch_size: the number of events to compact per transaction
+
+    Returns:
+        the number of events compacted
+    """
+    count = 0
+    last_pk = 0
+    while True:
+        batch = list(
+            model.objects.filter(
+                pk__gt=last_pk,
+                validated_message__isnull=False
+            ).order_by("pk").only("pk", "webhook_message", "validated_message")[:batch_size]
+        )
+        if not batch:
+            return count
+        with transaction.atomic():
+            for event in batch:
+                model.objects.filter(pk=event.pk).update(
+                    validated_message=None,
+                    validated_diff=message_diff(event.webhook_message or {}, event.validated_message)
+                )
+        count += len(batch)
+        last_pk = batch[-1].pk
+
+
+def iter_pages(resource, limit=100, **params):
+    """
+    Pages through a Stripe list endpoint a page at a time
+
+    Args:
+        resource: the Stripe API resource class to list, e.g. stripe.Customer
+        limit: the number of objects to request per page
+        params: any additional parameters for the list call
+
+    Returns:
+        a generator yielding the list of objects on each page
+    """
+    # stripe<1.28 has no list method, all takes the same parameters
+    list_method = getattr(resource, "list", None) or resource.all
+    page = list_method(limit=limit, **params)
+    while True:
+        data = page["data"]
+        if data:
+            yield data
+        if not data or not page["has_more"]:
+            return
+        page = list_method(limit=limit, starting_after=data[-1]["id"], **params)
+
+
+def verify_webhook_signature(payload, header, secret, tolerance=None):
+    """
+    Checks a Stripe-Signature header against the raw payload of a webhook
+
+    Args:
+        payload: the raw body of the webhook request, as bytes
+        header: the value of the Stripe-Signature header
+        secret: the signing secret of the webhook endpoint
+        tolerance: optionally, the maximum age in seconds of the signature
+
+    Returns:
+        True, if one of the v1 signatures matches, otherwise False
+    """
+    timestamp = None
+    signatures = []
+    for item in (header or "").split(","):
+        key, _, value = item.strip().partition("=")
+        if key == "t":
+            timestamp = value
+        elif key == "v1":
+            signatures.append(value)
+    if not secret or not timestamp or not signatures:
+        return False
+    try:
+        if tolerance and abs(time.time() - int(timestamp)) > tolerance:
+            return False
+        signed_payload = timestamp.encode("ascii") + b"."
+    except ValueError:
+        return False
+    if not isinstance(payload, bytes):
+        payload = payload.encode("utf-8")
+    # Signed over the bytes as received, so that no decoding is involved
+    expected = hmac.new(
+        secret.encode("utf-8"),
+        signed_payload + payload,
+        hashlib.sha256
+    ).hexdigest()
+    return any(hmac.compare_digest(expected, str(signature)) for signature in signatures)
+
+
+class RateLimiter(object):
+    """
+    Spaces out calls made from any number of threads so that no more than
+    rate calls per second are made
+    """
+
+    def __init__(self, rate):
+        self.interval = 1.0 / rate
+        self.next_at = time.time()
+        self.lock = threading.Lock()
+
+    def wait(self):
+        with self.lock:
+            now = time.time()
+            delay = self.next_at - now
+            self.next_at = max(now, self.next_at) + self.interval
+        if delay > 0:
+            time.sleep(delay)
+
+
+class RateLimitedHttpClient(object):
+    """
+    Wraps the HTTP client used by the stripe library so that every request
+    to the Stripe API waits its turn with a RateLimiter
+    """
+
+    def __init__(self, client, limiter):
+        self.client = client
+        self.limiter = limiter
+
+    def request(self, *args, **kwargs):
+        self.limiter.wait()
+        return self.client.request(*args, **kwargs)
+
+    def __getattr__(self, attr):
+        return getattr(self.client, attr)
+
+
 CURRENCY_SYMBOLS = {
     "aud": "\u0024",
     "cad": "\u0024",
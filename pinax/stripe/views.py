@@ -1,5 +1,7 @@
 import json
+import logging
 
+from django.core.exceptions import ImproperlyConfigured
 from django.http import HttpResponse
 from django.shortcuts import redirect
 from django.utils.decorators import method_decorator
@@ -10,11 +12,15 @@ from django.views.decorators.csrf import csrf_exempt
 
 import stripe
 
+from . import cache
 from .actions import events, exceptions, customers, subscriptions, sources
 from .conf import settings
 from .forms import PlanForm, PaymentMethodForm
 from .mixins import LoginRequiredMixin, CustomerMixin, PaymentsContextMixin
 from .models import Invoice, Card, Subscription
+from .utils import verify_webhook_signature
+
+logger = logging.getLogger(__name__)
 
 
 class InvoiceListView(LoginRequiredMixin, CustomerMixin, ListView):
@@ -193,15 +199,39 @@ class Webhook(View):
         data = json.loads(smart_str(self.request.body))
         return data
 
+    def verify_signature(self):
+        return verify_webhook_signature(
+            self.request.body,
+            self.request.META.get("HTTP_STRIPE_SIGNATURE"),
+            settings.PINAX_STRIPE_WEBHOOK_SECRET,
+            tolerance=settings.PINAX_STRIPE_WEBHOOK_TOLERANCE
+        )
+
     def post(self, request, *args, **kwargs):
+        if settings.PINAX_STRIPE_WEBHOOK_VALIDATION in ["signature", "both"]:
+            if not settings.PINAX_STRIPE_WEBHOOK_SECRET:
+                raise ImproperlyConfigured(
+                    "PINAX_STRIPE_WEBHOOK_SECRET is required when PINAX_STRIPE_WEBHOOK_VALIDATION is {0!r}".format(
+                        settings.PINAX_STRIPE_WEBHOOK_VALIDATION
+                    )
+                )
+            if not self.verify_signature():
+                # Not stored, as anyone can send a request with a bad signature
+                logger.warning("Rejected a webhook with a missing or invalid Stripe-Signature header")
+                return HttpResponse(status=400)
         data = self.extract_json()
-        if events.dupe_event_exists(data["id"]):
+        if cache.event_received(data["id"]):
+            # Received recently, so Stripe is retrying or delivered it twice
+            return HttpResponse()
+        event = events.add_event(
+            stripe_id=data["id"],
+            kind=data["type"],
+            livemode=data["livemode"],
+            message=data
+        )
+        if event is None:
             exceptions.log_exception(data, "Duplicate event record")
-        else:
-            events.add_event(
-                stripe_id=data["id"],
-                kind=data["type"],
-                livemode=data["livemode"],
-                message=data
-            )
+        # Only once the event is committed, so that Stripe's retries are let
+        # through if it is not
+        cache.remember_event(data["id"])
         return HttpResponse()
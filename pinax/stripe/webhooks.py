@@ -1,4 +1,5 @@
 import json
+import time
 
 from django.dispatch import Signal
 
@@ -6,6 +7,8 @@ import stripe
 
 from six import with_metaclass
 
+from . import cache
+from . import models
 from .actions import charges, customers, exceptions, invoices, transfers, sources, subscriptions
 from .conf import settings
 
@@ -66,17 +69,44 @@ class Webhook(with_metaclass(Registerable, object)):
         self.event = event
 
     def validate(self):
+        if settings.PINAX_STRIPE_WEBHOOK_VALIDATION == "signature":
+            # The webhook view has already checked the Stripe-Signature
+            # header so the payload can be trusted without a round-trip
+            self.event.message = self.event.webhook_message
+            self.event.valid = True
+            self.event.save()
+            return
         evt = stripe.Event.retrieve(self.event.stripe_id)
-        self.event.validated_message = json.loads(
+        self.event.message = json.loads(
             json.dumps(
                 evt.to_dict(),
                 sort_keys=True,
                 cls=stripe.StripeObjectEncoder
             )
         )
-        self.event.valid = self.event.webhook_message["data"] == self.event.validated_message["data"]
+        self.event.valid = self.event.webhook_message["data"] == self.event.message["data"]
         self.event.save()
 
+    def payload_is_trusted(self):
+        """
+        Whether handlers may sync straight from the object embedded in the
+        validated event instead of retrieving it again
+
+        Requires PINAX_STRIPE_WEBHOOK_TRUST_PAYLOAD and an event rendered with
+        the API version the app is configured for, as the shape of the object
+        differs between versions. The event also has to be processed within
+        PINAX_STRIPE_WEBHOOK_TRUST_PAYLOAD_MAX_AGE seconds of its creation, as
+        a late retry, a backlog or a replay may carry an older snapshot than
+        what was already synced.
+        """
+        if not settings.PINAX_STRIPE_WEBHOOK_TRUST_PAYLOAD:
+            return False
+        api_version = self.event.message.get("api_version") or self.event.api_version
+        if api_version != settings.PINAX_STRIPE_API_VERSION:
+            return False
+        created = self.event.message.get("created")
+        return created is not None and time.time() - created <= settings.PINAX_STRIPE_WEBHOOK_TRUST_PAYLOAD_MAX_AGE
+
     def send_signal(self):
         signal = registry.get_signal(self.name)
         if signal:
@@ -87,9 +117,10 @@ class Webhook(with_metaclass(Registerable, object)):
         if not self.event.valid or self.event.processed:
             return
         try:
-            customers.link_customer(self.event)
-            self.process_webhook()
-            self.send_signal()
+            with cache.unit_of_work():
+                customers.link_customer(self.event)
+                self.process_webhook()
+                self.send_signal()
             self.event.processed = True
             self.event.save()
         except stripe.StripeError as e:
@@ -167,9 +198,17 @@ class BitcoinReceiverTransactionCreatedWebhook(Webhook):
 class ChargeWebhook(Webhook):
 
     def process_webhook(self):
-        charges.sync_charge_from_stripe_data(
-            stripe.Charge.retrieve(self.event.message["data"]["object"]["id"])
-        )
+        charges.sync_charge_from_stripe_data(self.stripe_charge())
+
+    def stripe_charge(self):
+        obj = self.event.message["data"]["object"]
+        if obj.get("object") == "dispute":
+            # charge.dispute.* events carry the dispute, not the charge
+            return stripe.Charge.retrieve(obj["charge"])
+        # A source that is not expanded means the payload is partial
+        if self.payload_is_trusted() and isinstance(obj.get("source"), dict):
+            return obj
+        return stripe.Charge.retrieve(obj["id"])
 
 
 class ChargeCapturedWebhook(ChargeWebhook):
@@ -255,7 +294,13 @@ class CustomerUpdatedWebhook(Webhook):
     description = "Occurs whenever any property of a customer changes."
 
     def process_webhook(self):
-        customers.sync_customer(self.event.customer)
+        cu = None
+        if self.payload_is_trusted():
+            obj = self.event.message["data"]["object"]
+            # Customers rendered without their sources or subscriptions are partial
+            if "sources" in obj and "subscriptions" in obj:
+                cu = obj
+        customers.sync_customer(self.event.customer, cu=cu)
 
 
 class CustomerDiscountCreatedWebhook(Webhook):
@@ -278,7 +323,7 @@ class CustomerSourceWebhook(Webhook):
     def process_webhook(self):
         sources.sync_payment_source_from_stripe_data(
             self.event.customer,
-            self.event.validated_message["data"]["object"]
+            self.event.message["data"]["object"]
         )
 
 
@@ -292,7 +337,7 @@ class CustomerSourceDeletedWebhook(CustomerSourceWebhook):
     description = "Occurs whenever a source is removed from a customer."
 
     def process_webhook(self):
-        sources.delete_card_object(self.event.validated_message["data"]["object"]["id"])
+        sources.delete_card_object(self.event.message["data"]["object"]["id"])
 
 
 class CustomerSourceUpdatedWebhook(CustomerSourceWebhook):
@@ -302,11 +347,36 @@ class CustomerSourceUpdatedWebhook(CustomerSourceWebhook):
 
 class CustomerSubscriptionWebhook(Webhook):
 
+    def current_subscription(self, cu):
+        """
+        Returns the subscription as listed on the retrieved customer, which
+        unlike the event payload is current even if the event is processed
+        late or out of order, or the payload if it is not listed, e.g. as it
+        has been canceled
+        """
+        subscription = self.event.message["data"]["object"]
+        for data in (cu.get("subscriptions") or {}).get("data", []):
+            if data["id"] == subscription["id"]:
+                return data
+        return subscription
+
     def process_webhook(self):
-        if self.event.validated_message:
+        if self.event.customer and not settings.PINAX_STRIPE_SUBSCRIPTION_WEBHOOK_FULL_CUSTOMER_SYNC:
+            # Only the customer fields a subscription change can affect and
+            # the subscription itself, all from the one retrieved customer
+            cu = self.event.customer.stripe_customer
+            customers.sync_customer_details(self.event.customer, cu=cu)
+            if self.event.message:
+                subscriptions.sync_subscription_from_stripe_data(
+                    self.event.customer,
+                    self.current_subscription(cu)
+                )
+            return
+
+        if self.event.message:
             subscriptions.sync_subscription_from_stripe_data(
                 self.event.customer,
-                self.event.validated_message["data"]["object"]
+                self.event.message["data"]["object"]
             )
 
         if self.event.customer:
@@ -337,7 +407,7 @@ class InvoiceWebhook(Webhook):
 
     def process_webhook(self):
         invoices.sync_invoice_from_stripe_data(
-            self.event.validated_message["data"]["object"],
+            self.event.message["data"]["object"],
             send_receipt=settings.PINAX_STRIPE_SEND_EMAIL_RECEIPTS
         )
 
@@ -397,17 +467,23 @@ class OrderUpdatedWebhook(Webhook):
     description = "Occurs whenever an order is updated."
 
 
-class PlanCreatedWebhook(Webhook):
+class PlanWebhook(Webhook):
+
+    def process_webhook(self):
+        cache.clear_pks(models.Plan)
+
+
+class PlanCreatedWebhook(PlanWebhook):
     name = "plan.created"
     description = "Occurs whenever a plan is created."
 
 
-class PlanDeletedWebhook(Webhook):
+class PlanDeletedWebhook(PlanWebhook):
     name = "plan.deleted"
     description = "Occurs whenever a plan is deleted."
 
 
-class PlanUpdatedWebhook(Webhook):
+class PlanUpdatedWebhook(PlanWebhook):
     name = "plan.updated"
     description = "Occurs whenever a plan is updated."
 
@@ -67,7 +67,8 @@ setup(
         "pinax.stripe": [
             "templates/pinax/stripe/email/body_base.txt",
             "templates/pinax/stripe/email/body.txt",
-            "templates/pinax/stripe/email/subject.txt"
+            "templates/pinax/stripe/email/subject.txt",
+            "templates/admin/pinax_stripe/keyset_change_list.html"
         ]
     },
     classifiers=[